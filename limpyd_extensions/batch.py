@@ -0,0 +1,447 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+from future.builtins import object
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+from redis.exceptions import WatchError
+
+from limpyd import fields as limpyd_fields
+from limpyd.contrib.database import PipelineDatabase
+from limpyd.utils import normalize
+
+from .utils import in_pipeline
+
+
+_local = threading.local()
+
+
+def current_batch():
+    """
+    Return the batch currently capturing writes in the current thread, if any.
+    """
+    return getattr(_local, 'batch', None)
+
+
+@contextmanager
+def batch():
+    """
+    A context manager capturing the writes done in the `with` block on batchable
+    fields (related fields and dynamic fields provided by limpyd_extensions), on
+    any number of instances, to coalesce them and send them at the end of the
+    block, in one transaction by database (with a WATCH on keys for which
+    current values must be read to update indexes).
+    Redundant writes are removed: only the last of many `sadd`/`srem` (or
+    `zadd`/`zrem`) of the same value is kept, only the last `set` of a single
+    value field, and the inventory of each dynamic version is updated once.
+    Writes that cannot be coalesced (deletion of a whole field, commands
+    returning a value, commands on unique fields...) flush the pending writes
+    then are executed directly, and captured commands return None.
+    Reads done in the block don't see the pending writes.
+    If an exception is raised in the block, pending writes are discarded.
+    A batch started in an existing one is merged with it.
+    """
+    existing = current_batch()
+    if existing is not None:
+        yield existing
+        return
+
+    current = _local.batch = Batch()
+    try:
+        yield current
+    finally:
+        # also on KeyboardInterrupt/SystemExit, to not keep capturing writes
+        _local.batch = None
+    current.flush()
+
+
+def defer_in_batch(key, func, database):
+    """
+    If a batch is running in the current thread, defer the call of `func` (a
+    callable without arguments doing only writes) to the flush of the batch,
+    replacing the one previously deferred with the same key, if any, and
+    return True. Else return False.
+    """
+    current = current_batch()
+    if current is None:
+        return False
+    current.defer(key, func, database)
+    return True
+
+
+class _Step(object):
+    """
+    Writes on a field captured by a batch. The field is the first one used for
+    this key, but writes done via other field objects for the same key (the
+    same field of the same instance) are added to the same step.
+    """
+
+    commands = set()
+
+    # set to True for steps needing to read the current value of indexable
+    # fields before the writes
+    needs_read = False
+
+    def __init__(self, field):
+        self.field = field
+
+    @classmethod
+    def handles(cls, field, name, args, kwargs):
+        """
+        Tell if the step can capture the given command for the given field.
+        """
+        return name in cls.commands
+
+    def run(self, name, *args, **kwargs):
+        """
+        Run a command on the field, bypassing its locks (we are in a
+        transaction) but still updating its indexes.
+        """
+        return getattr(self.field, '_call_%s' % name, self.field._traverse_command)(
+            name, *args, **kwargs)
+
+    def read(self):
+        pass
+
+
+class _MembersStep(_Step):
+    """
+    Coalesce additions/removals of members in a set (or sorted set): for each
+    member, only the last operation is kept.
+    """
+
+    def __init__(self, field):
+        super(_MembersStep, self).__init__(field)
+        self.members = OrderedDict()
+
+    def _added(self):
+        return [member for member, value in self.members.items() if value is not None]
+
+    def _removed(self):
+        return [member for member, value in self.members.items() if value is None]
+
+
+class _SetStep(_MembersStep):
+    commands = {'sadd', 'srem'}
+
+    @classmethod
+    def handles(cls, field, name, args, kwargs):
+        return isinstance(field, limpyd_fields.SetField) and name in cls.commands and not kwargs
+
+    def add(self, name, args, kwargs):
+        for value in args:
+            self.members['%s' % normalize(value)] = True if name == 'sadd' else None
+
+    def write(self):
+        added = self._added()
+        if added:
+            self.run('sadd', *added)
+        removed = self._removed()
+        if removed:
+            self.run('srem', *removed)
+
+
+class _SortedSetStep(_MembersStep):
+    commands = {'zadd', 'zrem'}
+
+    @classmethod
+    def handles(cls, field, name, args, kwargs):
+        if not isinstance(field, limpyd_fields.SortedSetField) or name not in cls.commands:
+            return False
+        return name == 'zrem' and not kwargs or name == 'zadd'
+
+    def add(self, name, args, kwargs):
+        if name == 'zadd':
+            args, kwargs = self.field.coerce_zadd_args(*args, **kwargs)
+            for value, score in kwargs['mapping'].items():
+                self.members['%s' % normalize(value)] = score
+        else:
+            for value in args:
+                self.members['%s' % normalize(value)] = None
+
+    def write(self):
+        added = self._added()
+        if added:
+            self.run('zadd', OrderedDict((member, self.members[member]) for member in added))
+        removed = self._removed()
+        if removed:
+            self.run('zrem', *removed)
+
+
+class _ListStep(_Step):
+    """
+    Keep pushes and removals (of all occurrences) of values in a list, in order.
+    """
+    commands = {'lpush', 'rpush', 'lrem'}
+
+    @classmethod
+    def handles(cls, field, name, args, kwargs):
+        if not isinstance(field, limpyd_fields.ListField) or name not in cls.commands or kwargs:
+            return False
+        # lrem only if we remove all occurrences, to know what to deindex
+        return name != 'lrem' or (len(args) == 2 and not args[0])
+
+    def __init__(self, field):
+        super(_ListStep, self).__init__(field)
+        self.calls = []
+
+    def add(self, name, args, kwargs):
+        self.calls.append((name, args))
+
+    def write(self):
+        for name, args in self.calls:
+            self.run(name, *args)
+
+
+class _ValueStep(_Step):
+    """
+    Keep only the last value set on a single value field (string or instance
+    hash field). Its current value is read (in the WATCH part of the
+    transaction) to update the indexes.
+    """
+    commands = {'set', 'hset'}
+
+    @classmethod
+    def handles(cls, field, name, args, kwargs):
+        if isinstance(field, limpyd_fields.InstanceHashField):
+            return name == 'hset' and len(args) == 1 and not kwargs
+        if isinstance(field, limpyd_fields.StringField):
+            return name == 'set' and len(args) == 1 and not kwargs
+        return False
+
+    def __init__(self, field):
+        super(_ValueStep, self).__init__(field)
+        self.needs_read = field.indexable
+        self.name = None
+        self.value = None
+        self.current = None
+
+    def add(self, name, args, kwargs):
+        self.name = name
+        self.value = args[0]
+
+    def read(self):
+        self.current = self.field.proxy_get()
+
+    def write(self):
+        field = self.field
+        if field.indexable and normalize(self.current) != normalize(self.value):
+            if self.current is not None:
+                field.deindex(self.current)
+            if self.value is not None:
+                field.index(self.value)
+        field._traverse_command(self.name, self.value)
+
+
+class _HashStep(_Step):
+    """
+    Keep only the last value set (or deletion) for each key of a hash field.
+    The current values of these keys are read (in the WATCH part of the
+    transaction) to update the indexes.
+    """
+    commands = {'hset', 'hmset', 'hdel'}
+
+    @classmethod
+    def handles(cls, field, name, args, kwargs):
+        if not isinstance(field, limpyd_fields.HashField) or name not in cls.commands:
+            return False
+        if name == 'hset':
+            return len(args) == 2 and not kwargs
+        return name == 'hmset' or not kwargs
+
+    def __init__(self, field):
+        super(_HashStep, self).__init__(field)
+        self.needs_read = field.indexable
+        self.values = OrderedDict()
+        self.current = {}
+
+    def add(self, name, args, kwargs):
+        if name == 'hset':
+            self.values[args[0]] = args[1]
+        elif name == 'hmset':
+            for mapping in args:
+                self.values.update(mapping)
+            self.values.update(kwargs)
+        else:
+            for key in args:
+                self.values[key] = None
+
+    def read(self):
+        keys = list(self.values.keys())
+        self.current = dict(zip(keys, self.field.hmget(*keys)))
+
+    def write(self):
+        field = self.field
+        if field.indexable:
+            changed = [key for key, value in self.values.items()
+                       if normalize(self.current[key]) != normalize(value)]
+            deindexed = {key: self.current[key] for key in changed if self.current[key] is not None}
+            if deindexed:
+                field.deindex(deindexed)
+            indexed = {key: self.values[key] for key in changed if self.values[key] is not None}
+            if indexed:
+                field.index(indexed)
+        to_set = OrderedDict((key, value) for key, value in self.values.items() if value is not None)
+        if to_set:
+            field._traverse_command('hmset', to_set)
+        to_delete = [key for key, value in self.values.items() if value is None]
+        if to_delete:
+            field._traverse_command('hdel', *to_delete)
+
+
+class _RawStep(_Step):
+    """
+    Keep, in order, any other command on a non-indexable field, as such a
+    command doesn't need to read anything.
+    """
+
+    @classmethod
+    def handles(cls, field, name, args, kwargs):
+        return not field.indexable
+
+    def __init__(self, field):
+        super(_RawStep, self).__init__(field)
+        self.calls = []
+
+    def add(self, name, args, kwargs):
+        self.calls.append((name, args, kwargs))
+
+    def write(self):
+        for name, args, kwargs in self.calls:
+            self.run(name, *args, **kwargs)
+
+
+class Batch(object):
+    """
+    Writes captured by the `batch` context manager, by field, and calls
+    deferred until the flush, by key.
+    """
+
+    step_classes = [_SetStep, _SortedSetStep, _ListStep, _ValueStep, _HashStep, _RawStep]
+
+    # commands never captured: the ones deleting a whole field (it would break
+    # the deletion of instances) and the ones whose returned value matters
+    uncaptured_commands = {
+        'delete', 'getset', 'setnx', 'hsetnx', 'lpop', 'rpop', 'spop',
+        'zpopmin', 'zpopmax', 'lpushx', 'rpushx', 'linsert',
+    }
+
+    def __init__(self):
+        self._steps = OrderedDict()
+        self._deferred = OrderedDict()
+
+    def __len__(self):
+        return sum(len(steps) for steps in self._steps.values()) + len(self._deferred)
+
+    def capture(self, field, name, args, kwargs):
+        """
+        Try to capture the command `name` called with `args` and `kwargs` on the
+        given field, and return True if it was captured.
+        """
+        if name in self.uncaptured_commands or field.unique:
+            return False
+        if isinstance(field, limpyd_fields.InstanceHashField) and name == 'hdel':
+            return False  # it's the deletion of the field
+
+        instance = getattr(field, '_instance', None)
+        if instance is None or not instance._pk:
+            return False
+        database = field.database
+        if not isinstance(database, PipelineDatabase) or in_pipeline(database):
+            return False
+
+        for step_class in self.step_classes:
+            if step_class.handles(field, name, args, kwargs):
+                break
+        else:
+            return False
+
+        # same as done by limpyd before a modifier: check that the instance exists
+        if not instance.connected:
+            instance.connect()
+
+        steps = self._steps.setdefault((database, field.key, field.name), [])
+        if not steps or steps[-1].__class__ is not step_class:
+            steps.append(step_class(field))
+        steps[-1].add(name, args, kwargs)
+        return True
+
+    def defer(self, key, func, database):
+        """
+        Defer the call of `func` to the flush, replacing the one previously
+        deferred with the same key, if any.
+        """
+        self._deferred.pop((database, key), None)
+        self._deferred[(database, key)] = func
+
+    def flush(self):
+        """
+        Send all the pending writes, in one transaction by database, and call
+        the deferred functions in it, after the writes.
+        """
+        steps, self._steps = self._steps, OrderedDict()
+        deferred, self._deferred = self._deferred, OrderedDict()
+
+        by_database = OrderedDict()
+        for (database, key, name), field_steps in steps.items():
+            by_database.setdefault(database, ([], []))[0].extend(field_steps)
+        for (database, key), func in deferred.items():
+            by_database.setdefault(database, ([], []))[1].append(func)
+
+        # writes done during the flush must not be captured
+        previous, _local.batch = getattr(_local, 'batch', None), None
+        try:
+            for database, (database_steps, calls) in by_database.items():
+                self._write(database, database_steps, calls)
+        finally:
+            _local.batch = previous
+
+    def _write(self, database, steps, calls):
+        """
+        Send the writes of the given steps, and call the given functions, in a
+        transaction, reading first, under WATCH, the values needed to update
+        indexes (and starting again if one of them was updated in the meantime)
+        """
+        to_read = [step for step in steps if step.needs_read]
+        try:
+            with database.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        if to_read:
+                            pipe.watch(*set(step.field.key for step in to_read))
+                            for step in to_read:
+                                step.read()
+                        pipe.multi()
+                        for step in steps:
+                            step.write()
+                        for func in calls:
+                            func()
+                        pipe.execute()
+                        break
+                    except WatchError:
+                        continue
+        finally:
+            for step in steps:
+                if step.field.indexable:
+                    step.field._reset_indexes_rollback_caches(step.field._instance._pk)
+
+
+class BatchableFieldMixin(object):
+    """
+    A mixin for fields whose writes can be captured by the `batch` context
+    manager.
+    """
+
+    def _call_command(self, name, *args, **kwargs):
+        """
+        In a batch, capture the modifiers if possible, else flush the pending
+        writes before running the command.
+        """
+        current = current_batch()
+        if current is not None and name in self.available_modifiers:
+            if current.capture(self, name, args, kwargs):
+                return None
+            current.flush()
+        return super(BatchableFieldMixin, self)._call_command(name, *args, **kwargs)
@@ -2,5 +2,10 @@ from __future__ import unicode_literals
 
 from . import model
 from . import collection
+from . import inventory
+from . import buffer
+from . import cache
 from . import fields
 from . import related
+from . import export
+from . import memory
@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+from future.builtins import object
+
+import atexit
+from collections import OrderedDict
+import threading
+from time import time
+
+from limpyd.contrib.database import PipelineDatabase
+
+from ..utils import in_pipeline
+
+
+class CounterBuffer(object):
+    """
+    An in-process buffer, to pass as the "buffer" argument of dynamic string or
+    hash fields, coalescing their increments (incr, incrby, decr, decrby,
+    hincrby) by version (and hash key), to send them later, all in one
+    pipeline, with only one inventory update by version.
+    The buffer is flushed when it holds `max_size` different counters, when
+    a new increment is added at least `interval` seconds after the previous
+    flush, when `flush` is called, and at exit if `flush_at_exit` is True.
+    Increments waiting in the buffer are not seen by reads, and the buffered
+    commands return None instead of the new value.
+    The buffer can be shared between threads.
+    """
+
+    def __init__(self, max_size=1000, interval=1.0, flush_at_exit=True):
+        self.max_size = max_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._increments = OrderedDict()
+        self._last_flush = time()
+        if flush_at_exit:
+            atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._increments)
+
+    def _merge(self, entries):
+        """
+        Add the given (entry_key, field, amount) entries to the buffer. Must be
+        called with the lock acquired.
+        """
+        for entry_key, field, amount in entries:
+            if entry_key in self._increments:
+                self._increments[entry_key][1] += amount
+            else:
+                self._increments[entry_key] = [field, amount]
+
+    def add(self, field, amount, hash_key=None):
+        """
+        Add the given amount to the counter of the given dynamic version (and
+        hash key for a hash field), and flush the buffer if needed.
+        """
+        with self._lock:
+            self._merge([((field.key, hash_key), field, amount)])
+            must_flush = len(self._increments) >= self.max_size \
+                or time() - self._last_flush >= self.interval
+        if must_flush:
+            self.flush()
+
+    def _send(self, database, entries):
+        """
+        Send the given (entry_key, field, amount) entries of one database, in
+        one transaction if possible, with the inventory updated only once for
+        each version. Return the entries whose increment failed, and the first
+        error met (None if all were applied).
+        """
+        failed, error = [], None
+        positions, tracked = [], set()
+
+        def apply(entry, pipe=None):
+            (key, hash_key), field, amount = entry
+            start = len(pipe.command_stack) if pipe is not None else None
+            # also when increments cancel out, to have the value that
+            # unbuffered calls would have left ("0")
+            field._apply_buffered_increment(amount, hash_key)
+            if pipe is not None:
+                positions.append((entry, start, len(pipe.command_stack)))
+            if key not in tracked:
+                field._track_version()
+                tracked.add(key)
+
+        if in_pipeline(database) or not isinstance(database, PipelineDatabase):
+            # commands are sent one by one (or by the pipeline we are already
+            # in, failing as a whole)
+            for entry in entries:
+                try:
+                    apply(entry)
+                except Exception as e:
+                    failed.append(entry)
+                    error = error or e
+            return failed, error
+
+        with database.pipeline(transaction=True) as pipe:
+            for entry in entries:
+                apply(entry, pipe)
+            # a failing command doesn't prevent the others of the transaction
+            # to be applied, so we use the result of each one
+            results = pipe.execute(raise_on_error=False)
+
+        for entry, start, end in positions:
+            errors = [result for result in results[start:end] if isinstance(result, Exception)]
+            if errors:
+                failed.append(entry)
+                error = error or errors[0]
+        return failed, error
+
+    def flush(self):
+        """
+        Send all the coalesced increments, in one transaction by database, with
+        the inventory updated only once for each version. The increments that
+        failed (all the ones of a transaction that could not be sent) are put
+        back in the buffer, and the first error is raised once all databases
+        are done.
+        """
+        with self._lock:
+            increments, self._increments = self._increments, OrderedDict()
+            self._last_flush = time()
+
+        by_database = OrderedDict()
+        for entry_key, (field, amount) in increments.items():
+            by_database.setdefault(field.database, []).append((entry_key, field, amount))
+
+        failed, error = [], None
+        for database, entries in by_database.items():
+            try:
+                database_failed, database_error = self._send(database, entries)
+            except Exception as e:
+                database_failed, database_error = entries, e
+            failed.extend(database_failed)
+            error = error or database_error
+
+        if failed:
+            with self._lock:
+                self._merge(failed)
+        if error is not None:
+            raise error
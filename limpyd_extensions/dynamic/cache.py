@@ -0,0 +1,221 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+from future.builtins import object
+
+from collections import OrderedDict
+from copy import copy
+import threading
+from time import time
+
+from limpyd.utils import normalize
+
+
+class VersionCache(object):
+    """
+    An in-process cache for reads of dynamic versions, to pass as the "cache"
+    argument of dynamic fields, useful for data read a lot more often than
+    written (per-locale configuration...).
+    It's a LRU cache holding at most `max_size` results, each one expiring
+    after `ttl` seconds if set. Entries of a version are invalidated after each
+    write done on it by the current process. To also invalidate them when
+    written by other clients, pass `tracking=True` (needs redis-server >= 6):
+    the redis client-side caching (CLIENT TRACKING, in broadcasting mode for
+    the keys of the models using the cache) will then send the invalidations
+    to a dedicated connection, which is read before each lookup.
+    Hits, misses, evictions and invalidations are counted, see `stats`.
+    """
+
+    INVALIDATION_CHANNEL = '__redis__:invalidate'
+
+    def __init__(self, max_size=1000, ttl=None, tracking=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tracking = tracking
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._entries_by_key = {}
+        self._prefixes = set()
+        # for each redis key read by a fetch in progress: the number of these
+        # fetches, and of the invalidations of the key since they started
+        self._in_flight = {}
+        self._tracked_prefixes = None
+        self._pubsub = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        """
+        Return a dict with the counters of the cache.
+        """
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hit_rate,
+        }
+
+    def register_model(self, model):
+        """
+        Called when a field using this cache is attached to a model, to track
+        the keys of this model.
+        """
+        self._prefixes.add('%s:' % model._name)
+
+    def fetch(self, field, command, args, kwargs, func):
+        """
+        Return the result of `command` called with `args` and `kwargs` on the
+        given dynamic version, from the cache if possible, else by calling
+        `func` and saving its result, except if the keys of the version were
+        invalidated during the call (the result may then be outdated).
+        """
+        try:
+            entry_key = (field.key, field.name, command, args, tuple(sorted(kwargs.items())))
+            hash(entry_key)
+        except TypeError:
+            return func()
+
+        if self.tracking:
+            self._read_invalidations(field.connection)
+
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                result, expire_at, keys = entry
+                if expire_at is None or expire_at > time():
+                    self.hits += 1
+                    # move it at the end to be the most recently used
+                    del self._entries[entry_key]
+                    self._entries[entry_key] = entry
+                    return copy(result)
+                self._remove(entry_key)
+            self.misses += 1
+            keys = field._version_keys()
+            invalidations = []
+            for key in keys:
+                in_flight = self._in_flight.setdefault(key, [0, 0])
+                in_flight[0] += 1
+                invalidations.append(in_flight[1])
+
+        try:
+            result = func()
+        finally:
+            with self._lock:
+                # a result read before a write done meanwhile is not kept
+                stale = False
+                for key, count in zip(keys, invalidations):
+                    in_flight = self._in_flight[key]
+                    stale = stale or in_flight[1] != count
+                    in_flight[0] -= 1
+                    if not in_flight[0]:
+                        del self._in_flight[key]
+
+        if stale:
+            return copy(result)
+
+        with self._lock:
+            self._entries[entry_key] = (result, time() + self.ttl if self.ttl else None, keys)
+            for key in keys:
+                self._entries_by_key.setdefault(key, set()).add(entry_key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+        return copy(result)
+
+    def _remove(self, entry_key):
+        """
+        Remove an entry from the cache. Must be called with the lock acquired.
+        """
+        entry = self._entries.pop(entry_key, None)
+        for key in entry[2] if entry is not None else ():
+            entry_keys = self._entries_by_key.get(key)
+            if entry_keys is not None:
+                entry_keys.discard(entry_key)
+                if not entry_keys:
+                    del self._entries_by_key[key]
+
+    def invalidate(self, *keys):
+        """
+        Remove from the cache all the entries for the given redis keys.
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._in_flight:
+                    self._in_flight[key][1] += 1
+                for entry_key in list(self._entries_by_key.get(key, ())):
+                    self._remove(entry_key)
+                    self.invalidations += 1
+
+    def clear(self):
+        """
+        Remove all the entries from the cache.
+        """
+        with self._lock:
+            self.invalidations += len(self._entries)
+            for in_flight in self._in_flight.values():
+                in_flight[1] += 1
+            self._entries.clear()
+            self._entries_by_key.clear()
+
+    def _read_invalidations(self, connection):
+        """
+        Start tracking if not done yet (or if new prefixes were registered), then
+        apply the invalidations received since the last call.
+        """
+        if self._tracked_prefixes != self._prefixes:
+            self._start_tracking(connection)
+
+        while True:
+            message = self._pubsub.get_message()
+            if message is None:
+                break
+            if message['type'] != 'message':
+                continue
+            if message['data'] is None:
+                # the database was flushed
+                self.clear()
+            else:
+                self.invalidate(*[normalize(key) for key in message['data']])
+
+    def _start_tracking(self, connection):
+        """
+        Open a connection subscribed to the invalidation channel, and enable on
+        it the tracking of the keys of the models using this cache, with
+        invalidations redirected to itself.
+        """
+        with self._lock:
+            if self._pubsub is not None:
+                self._pubsub.close()
+            self.clear()
+
+            prefixes = set(self._prefixes)
+            pubsub = connection.pubsub(ignore_subscribe_messages=True)
+            pubsub.connection = connection.connection_pool.get_connection('pubsub', None)
+
+            def enable_tracking(pubsub_connection):
+                # called at each (re)connection, before subscribing
+                self.clear()
+                pubsub_connection.send_command('CLIENT', 'ID')
+                client_id = pubsub_connection.read_response()
+                command = ['CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id, 'BCAST']
+                for prefix in sorted(prefixes):
+                    command.extend(['PREFIX', prefix])
+                pubsub_connection.send_command(*command)
+                pubsub_connection.read_response()
+
+            enable_tracking(pubsub.connection)
+            pubsub.connection.register_connect_callback(enable_tracking)
+            pubsub.connection.register_connect_callback(pubsub.on_connect)
+            pubsub.subscribe(self.INVALIDATION_CHANNEL)
+
+            self._pubsub = pubsub
+            self._tracked_prefixes = prefixes
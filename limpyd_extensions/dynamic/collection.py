@@ -2,10 +2,72 @@
 from __future__ import unicode_literals
 from future.builtins import object
 
+from future.utils import string_types
+
 from limpyd.contrib.collection import ExtendedCollectionManager
+from limpyd.indexes import NumberRangeIndex
+from limpyd.model import RedisModel
+from limpyd.utils import normalize
+
+
+class _SetsUnion(tuple):
+    """
+    Keys of redis sets passed to `intersect_union`: their union is computed
+    with SUNIONSTORE when the collection is fetched.
+    """
 
 
 class CollectionManagerForModelWithDynamicFieldMixin(object):
+
+    # return the generation of a dynamic version and if the result of a
+    # filter is kept for this generation, in one call
+    filter_cache_lookup_script = {
+        'lua': """
+            local generation = redis.call('get', KEYS[1]) or '0'
+            local key = ARGV[1] .. generation .. ARGV[2]
+            return {generation, redis.call('exists', key)}
+        """,
+    }
+
+    # member of the list keeping an empty result of a filter (an empty list
+    # cannot exist in redis)
+    filter_cache_empty_marker = '__limpyd_empty_result__'
+
+    # (sorted set, version, desc) used by `dynamic_sort_by` to sort by the
+    # scores of a number range index
+    _dynamic_sort_zset = None
+
+    def clone(self):
+        new = super(CollectionManagerForModelWithDynamicFieldMixin, self).clone()
+        new._dynamic_sort_zset = self._dynamic_sort_zset
+        return new
+
+    def intersect_union(self, *keys):
+        """
+        Intersect the collection with the union of the redis sets with the
+        given keys, computed by redis (SUNIONSTORE in a temporary key, deleted
+        after use) each time the collection is fetched.
+        Return a new collection.
+        """
+        if not keys:
+            raise ValueError('At least one key is needed')
+        return self.intersect(_SetsUnion(keys))
+
+    def _prepare_sets(self, sets):
+        """
+        Compute the unions added by `intersect_union` in temporary keys, and
+        let the other sets be prepared as usual.
+        """
+        unions = [set_ for set_ in sets if isinstance(set_, _SetsUnion)]
+        all_sets, tmp_keys = super(CollectionManagerForModelWithDynamicFieldMixin, self)._prepare_sets(
+            [set_ for set_ in sets if not isinstance(set_, _SetsUnion)])
+        for keys in unions:
+            tmp_key = self._unique_key('tmp')
+            self.connection.sunionstore(tmp_key, list(keys))
+            all_sets.add(tmp_key)
+            tmp_keys.add(tmp_key)
+        return all_sets, tmp_keys
+
     def dynamic_filter(self, field_name, dynamic_part, value, index_suffix=''):
         """
         Add a filter to the collection, using a dynamic field. The key part of
@@ -14,19 +76,147 @@ class CollectionManagerForModelWithDynamicFieldMixin(object):
         The index_suffix allow to specify which index to use. It's an empty string
         by default for the default equal index (could be "__eq" or "eq" to have the
         exact same result)
+        If the dynamic field has a "filter_cache_ttl", the result of the filter
+        is kept in a temporary set (see `_cached_dynamic_filter`).
         Finally return the collection, by calling self.filter
         """
         field_name_parts = field_name.split('__')
         real_field_name = field_name_parts.pop(0)
-        dynamic_field_name = self.model.get_field(real_field_name).get_name_for(dynamic_part)
+        field = self.model.get_field(real_field_name)
+        dynamic_field_name = field.get_name_for(dynamic_part)
         field_name_parts.insert(0, dynamic_field_name)
         filter_name = '__'.join(field_name_parts)
-        if not index_suffix:
+        if not index_suffix or index_suffix in ('eq', '__eq'):
             index_suffix = ''
         elif not index_suffix.startswith('__'):
             index_suffix = '__' + index_suffix
+        if field._filter_cache_ttl and isinstance(value, string_types + (int, float, RedisModel)):
+            return self._cached_dynamic_filter(field, dynamic_field_name,
+                                               filter_name + index_suffix, value)
         return self.filter(**{filter_name + index_suffix: value})
 
+    def _cached_dynamic_filter(self, field, dynamic_field_name, filter_key, value):
+        """
+        Intersect the collection with a list holding the pks matching the
+        filter, computed and stored by redis (with `store`) if not already kept
+        for the current generation of the dynamic version (incremented on each
+        write on it), and kept for the "filter_cache_ttl" of the field. Hits and misses are counted in the
+        `filter_cache_stats` of the field.
+        """
+        version = self.model.get_field(dynamic_field_name)
+        value = version.from_python(value)
+        prefix = version._filter_cache_key_prefix()
+        suffix = ':%s:%s' % (filter_key, value)
+        generation, exists = self.model.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=self.__class__.filter_cache_lookup_script,
+            keys=[version._filter_cache_generation_key()],
+            args=[prefix, suffix],
+        )
+        key = '%s%s%s' % (prefix, normalize(generation), suffix)
+
+        if exists:
+            field._filter_cache_stats['hits'] += 1
+        else:
+            field._filter_cache_stats['misses'] += 1
+            # computed and stored by redis, without reading the pks
+            stored = self.model.collection(**{filter_key: value}).sort(by='nosort').store(
+                key, ttl=field._filter_cache_ttl)
+            if not stored._stored_len:
+                pipeline = self.connection.pipeline(transaction=False)
+                pipeline.rpush(key, self.filter_cache_empty_marker)
+                pipeline.expire(key, field._filter_cache_ttl)
+                pipeline.execute()
+
+        # the pks collection excludes the marker of empty results
+        return self.intersect(key, self.model.get_field('pk').collection_key)
+
+    def dynamic_sort_by(self, field_name, dynamic_part, desc=False, alpha=False):
+        """
+        Sort the collection by the value of the dynamic version of the dynamic
+        field `field_name` for the given dynamic part, with the redis SORT
+        command using the sort wildcard of the version (`alpha` to sort
+        lexicographically), so limits given by slicing are applied by redis.
+        If the version has a NumberRangeIndex, its sorted set (pks scored by
+        values) is instead combined with the collection via ZUNIONSTORE and
+        ZINTERSTORE (instances without the version are kept with a score of 0,
+        as with SORT), and the result read with ZRANGE/ZREVRANGE, also with
+        limits.
+        Finally return the collection.
+        """
+        dynamic_field_name = self.model.get_field(field_name).get_name_for(dynamic_part)
+        version = self.model.get_field(dynamic_field_name)
+        indexes = [index for index in version._indexes if isinstance(index, NumberRangeIndex)] \
+            if version.indexable and not alpha else []
+        if not indexes:
+            return self.sort(by='%s%s' % ('-' if desc else '', dynamic_field_name), alpha=alpha)
+
+        index_key = indexes[0].get_storage_key(None)
+        clone = self.intersect(index_key)
+        clone._dynamic_sort_zset = (index_key, version, desc)
+        # keep the order of the sorted set when slicing
+        clone._sort = {'by': 'nosort'}
+        return clone
+
+    def _combine_sets(self, sets, final_set):
+        """
+        When sorted by a number range index with `dynamic_sort_by`, combine
+        the sets of the collection with the sorted set of the index, without
+        excluding the instances missing from it: a ZUNIONSTORE of one of the
+        sets (weight 0) with the index gives a score of 0 to these instances,
+        then a ZINTERSTORE with all the sets (weight 0) restricts the result
+        to the collection while keeping the scores.
+        """
+        if self._dynamic_sort_zset is None:
+            return super(CollectionManagerForModelWithDynamicFieldMixin, self)._combine_sets(
+                sets, final_set)
+
+        index_key = self._dynamic_sort_zset[0]
+        others = [key for key in sets if key != index_key]
+        self.connection.zunionstore(final_set, {others[0]: 0, index_key: 1})
+        weights = dict((key, 0) for key in others)
+        weights[final_set] = 1
+        self.connection.zinterstore(final_set, weights)
+        return final_set
+
+    def _final_redis_call(self, final_set, sort_options):
+        """
+        When sorted by a number range index with `dynamic_sort_by`, read the
+        result of `_combine_sets` with ZRANGE/ZREVRANGE, applying the limits,
+        except if values are asked, then sorting with SORT on the version.
+        """
+        if self._dynamic_sort_zset is None:
+            return super(CollectionManagerForModelWithDynamicFieldMixin, self)._final_redis_call(
+                final_set, sort_options)
+
+        index_key, version, desc = self._dynamic_sort_zset
+        sort_options = dict(sort_options or {})
+        # the order is reversed by limpyd to get items from the end
+        if sort_options.get('desc'):
+            desc = not desc
+        if 'get' in sort_options or 'store' in sort_options:
+            sort_options['by'] = version.sort_wildcard
+            sort_options['desc'] = desc
+            return self.connection.sort(final_set, **sort_options)
+
+        start = sort_options.get('start', 0)
+        num = sort_options.get('num', -1)
+        stop = -1 if num < 0 else start + num - 1
+        command = self.connection.zrevrange if desc else self.connection.zrange
+        return command(final_set, start, stop)
+
+    def having_version(self, field_name, dynamic_part):
+        """
+        Restrict the collection to the instances having a dynamic version of
+        the dynamic field `field_name` for the given dynamic part, using the
+        reverse index of the field (it must be declared with
+        "reverse_index=True").
+        Finally return the collection, by calling self.intersect
+        """
+        field = self.model.get_field(field_name)
+        return self.intersect(field._get_reverse_index_key(dynamic_part))
+
 
 class CollectionManagerForModelWithDynamicField(CollectionManagerForModelWithDynamicFieldMixin, ExtendedCollectionManager):
     """
@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+from limpyd.exceptions import ImplementationError
+from limpyd.model import RedisModel
+
+from .fields import DynamicHashField, DynamicSortedSetField
+
+try:
+    import numpy
+except ImportError:  # numpy is an optional dependency
+    numpy = None
+
+
+def _check_numpy():
+    """
+    Raise an ImportError if numpy is not installed.
+    """
+    if numpy is None:
+        raise ImportError('numpy is needed to export dynamic versions: install '
+                          'it with "pip install redis-limpyd-extensions[numpy]"')
+
+
+def _get_versions(field, field_class, instances, dynamic_parts):
+    """
+    Check that `field` is the base field of a dynamic field of the given class,
+    and return the list of the (pk, dynamic part) tuples for all the given
+    instances (or pks) and dynamic parts, with the list of their keys.
+    """
+    if not isinstance(field, field_class) or field.dynamic_version_of is not None:
+        raise ImplementationError('Only the base field of a %s can be exported'
+                                  % field_class.__name__)
+    model = field._model
+    pks = [instance.pk.get() if isinstance(instance, RedisModel) else instance
+           for instance in instances]
+    names = [field.get_name_for(dynamic_part) for dynamic_part in dynamic_parts]
+    dynamic_parts = [model.get_class_field(name).dynamic_part for name in names]
+
+    versions, keys = [], []
+    for pk in pks:
+        for name, dynamic_part in zip(names, dynamic_parts):
+            versions.append((pk, dynamic_part))
+            keys.append(field.make_key(model._name, pk, name))
+    return versions, keys
+
+
+def _run_by_chunks(connection, keys, chunk_size, add_command):
+    """
+    Yield, for each key, the result of the command added to a pipeline by
+    `add_command(pipeline, index, key)`, with one pipeline by chunk of
+    `chunk_size` keys.
+    """
+    for start in range(0, len(keys), chunk_size):
+        pipeline = connection.pipeline(transaction=False)
+        for index, key in enumerate(keys[start:start + chunk_size], start):
+            add_command(pipeline, index, key)
+        for result in pipeline.execute():
+            yield result
+
+
+def export_sorted_sets(field, instances, dynamic_parts, chunk_size=100):
+    """
+    Read the dynamic versions of a DynamicSortedSetField (the base field of
+    the model) for all the given instances (or pks) and dynamic parts, into
+    numpy arrays. Return a dict with:
+    - "versions": the list of the (pk, dynamic part) tuples
+    - "version": an array with, for each member, the index of its version
+    - "members": an array (of objects) of all the members
+    - "scores": an array (of floats) of their scores
+    Sizes of versions are read first to preallocate the arrays, then members
+    and scores, with one pipeline by chunk of `chunk_size` versions.
+    """
+    _check_numpy()
+    versions, keys = _get_versions(field, DynamicSortedSetField, instances, dynamic_parts)
+    connection = field.connection
+
+    sizes = list(_run_by_chunks(connection, keys, chunk_size,
+                                lambda pipeline, index, key: pipeline.zcard(key)))
+    total = sum(sizes)
+    version = numpy.empty(total, dtype=numpy.int64)
+    members = numpy.empty(total, dtype=object)
+    scores = numpy.empty(total, dtype=numpy.float64)
+
+    # versions updated in the meantime are truncated to their read size
+    position = 0
+    results = _run_by_chunks(connection, keys, chunk_size,
+                             lambda pipeline, index, key: pipeline.zrange(
+                                 key, 0, sizes[index] - 1, withscores=True))
+    for index, result in enumerate(results):
+        if not sizes[index]:
+            continue
+        end = position + len(result)
+        version[position:end] = index
+        members[position:end] = [member for member, score in result]
+        scores[position:end] = [score for member, score in result]
+        position = end
+
+    return {
+        'versions': versions,
+        'version': version[:position],
+        'members': members[:position],
+        'scores': scores[:position],
+    }
+
+
+def export_hashes(field, instances, dynamic_parts, hash_keys=None, chunk_size=100):
+    """
+    Read the numeric values of the dynamic versions of a DynamicHashField (the
+    base field of the model) for all the given instances (or pks) and dynamic
+    parts, into numpy arrays. Return a dict with:
+    - "versions": the list of the (pk, dynamic part) tuples
+    - "version": an array with, for each entry, the index of its version
+    - "keys": an array (of objects) of the keys of the entries in the hashes
+    - "values": an array (of floats) of their values
+    If `hash_keys` is given, only these keys are read (with HMGET), and for each
+    version, all of them are in the result, in this order, with NaN values for
+    the missing ones. Else all the entries are read (with HGETALL), the sizes of
+    the versions being read first to preallocate the arrays. There is one
+    pipeline by chunk of `chunk_size` versions.
+    """
+    _check_numpy()
+    versions, keys = _get_versions(field, DynamicHashField, instances, dynamic_parts)
+    connection = field.connection
+
+    if hash_keys is not None:
+        hash_keys = list(hash_keys)
+        width = len(hash_keys)
+        total = len(keys) * width
+        values = numpy.empty(total, dtype=numpy.float64)
+        results = _run_by_chunks(connection, keys, chunk_size,
+                                 lambda pipeline, index, key: pipeline.hmget(key, hash_keys))
+        for index, result in enumerate(results):
+            values[index * width:(index + 1) * width] = [
+                numpy.nan if value is None else value for value in result]
+        return {
+            'versions': versions,
+            'version': numpy.repeat(numpy.arange(len(keys), dtype=numpy.int64), width),
+            'keys': numpy.array(hash_keys * len(keys), dtype=object),
+            'values': values,
+        }
+
+    sizes = list(_run_by_chunks(connection, keys, chunk_size,
+                                lambda pipeline, index, key: pipeline.hlen(key)))
+    total = sum(sizes)
+    version = numpy.empty(total, dtype=numpy.int64)
+    entries_keys = numpy.empty(total, dtype=object)
+    values = numpy.empty(total, dtype=numpy.float64)
+
+    # versions updated in the meantime are truncated to their read size
+    position = 0
+    results = _run_by_chunks(connection, keys, chunk_size,
+                             lambda pipeline, index, key: pipeline.hgetall(key))
+    for index, result in enumerate(results):
+        items = list(result.items())[:sizes[index]]
+        if not items:
+            continue
+        end = position + len(items)
+        version[position:end] = index
+        entries_keys[position:end] = [key for key, value in items]
+        values[position:end] = [value for key, value in items]
+        position = end
+
+    return {
+        'versions': versions,
+        'version': version[:position],
+        'keys': entries_keys[:position],
+        'values': values[:position],
+    }
@@ -3,15 +3,80 @@ from __future__ import unicode_literals
 from future.builtins import object
 
 from copy import copy
+from datetime import datetime
+from multiprocessing import Pool
+import os
+from random import randrange
 import re
+from time import time
+
+from future.utils import string_types
+
+from redis.exceptions import WatchError
 
 from limpyd import fields as limpyd_fields
 from limpyd.exceptions import ImplementationError
 
+from ..batch import BatchableFieldMixin, current_batch, defer_in_batch
+from ..utils import in_pipeline, pipelined
+from .inventory import BitmapInventory, SetInventory, SortedSetInventory
 from .model import ModelWithDynamicFieldMixin
 
 
-class DynamicFieldMixin(object):
+def _reindex_chunk(model, field_name, pks, done_key):
+    """
+    Index all the dynamic versions of the field `field_name` for the instances
+    of `model` with the given pks: read their inventories, then, with a WATCH
+    on the keys of all their versions, read their values and index them
+    (incrementing the generation of the kept results of `dynamic_filter`, if
+    any) and mark the instances as done in `done_key` in a transaction, retried
+    if one of these versions was written in the meantime. Called directly or in
+    a worker process. Return the number of instances.
+    """
+    versions = []
+    for pk in pks:
+        instance = model.lazy_connect(pk)
+        base_field = instance.get_field(field_name)
+        for dynamic_part in base_field._inventory.scan_versions():
+            versions.append(base_field.get_for(dynamic_part))
+
+    database = model.database
+    with database.pipeline(transaction=True) as pipeline:
+        while True:
+            try:
+                keys = [key for version in versions for key in version._version_keys()]
+                if keys:
+                    pipeline.watch(*keys)
+                # calls are executed directly while watching
+                values = [version.proxy_get() for version in versions]
+                pipeline.multi()
+                invalidated = set()
+                for version, value in zip(versions, values):
+                    if value:
+                        version.index(value)
+                        # results of `dynamic_filter` kept before may miss this value
+                        if version._filter_cache_ttl and version.name not in invalidated:
+                            invalidated.add(version.name)
+                            version._invalidate_filter_cache()
+                database.connection.sadd(done_key, *pks)
+                pipeline.execute()
+                break
+            except WatchError:
+                continue
+            finally:
+                for version in versions:
+                    version._reset_indexes_rollback_caches(version._instance._pk)
+    return len(pks)
+
+
+def _reindex_chunk_star(args):
+    """
+    Call `_reindex_chunk` with a tuple of arguments, for `Pool.imap_unordered`.
+    """
+    return _reindex_chunk(*args)
+
+
+class DynamicFieldMixin(BatchableFieldMixin):
     """
     This mixin adds a main functionnality to each domain it's attached to: the
     ability to have an unlimited number of fields. If a field is asked in the
@@ -27,11 +92,66 @@ class DynamicFieldMixin(object):
     the "format" argument can be passed when declaring the dynamic field on the
     model. Both pattern and format must match. If not defined, the default
     format is 'basefieldname_%s'.
+    If a "ttl" argument is passed (a number of seconds), each dynamic version
+    will expire this number of seconds after its last write, and the inventory
+    will be a sorted set scored by expiry times (expired versions can then be
+    removed from it with `sweep_expired_versions`).
+    The "inventory" argument allows to choose the kind of inventory: "set" (the
+    default), or "bitmap", a lot more compact, to use when dynamic parts are
+    non-negative integers (and the default pattern is then ^basefieldname_\\d+$)
+    The "buffer" argument accepts a `CounterBuffer`, to coalesce increments of
+    dynamic string and hash fields in the process before sending them.
+    The "cache" argument accepts a `VersionCache`, to keep in the process the
+    results of reads on dynamic versions, invalidated on writes.
+    With "reverse_index=True", a set of the pks of the instances having a
+    dynamic version is maintained for each dynamic part, along the inventory
+    (see `instances_having` and the `having_version` collection filter).
+    With "hyperloglog=True", the dynamic parts used are added to a HyperLogLog
+    for the whole model, and to one for each day (UTC), to get approximate
+    counts of distinct dynamic parts (see `approximate_parts_count`). The days
+    are kept "hyperloglog_retention" days (90 by default, None to keep them).
+    For indexable fields, a "filter_cache_ttl" (a number of seconds) can be
+    passed to keep the results of `dynamic_filter` on the field in temporary
+    sets, invalidated by any write on the filtered dynamic version.
     """
 
+    # commands that can be coalesced in a buffer, with the sign of the amount
+    buffered_commands = {
+        'incr': 1,
+        'incrby': 1,
+        'decr': -1,
+        'decrby': -1,
+        'hincrby': 1,
+    }
+
+    # read commands whose results can be kept in a cache
+    cached_commands = {
+        'get', 'hget', 'hmget', 'hgetall', 'hkeys', 'hvals', 'hlen', 'hexists',
+        'smembers', 'sismember', 'scard', 'lrange', 'lindex', 'llen',
+        'zrange', 'zrevrange', 'zscore', 'zcard',
+    }
+
+    inventory_classes = {
+        'set': SetInventory,
+        'bitmap': BitmapInventory,
+    }
+
+    # remove the pk ARGV[2] from the reverse index KEYS[2] of the dynamic part
+    # ARGV[1], only if this part is not in the inventory KEYS[1] (it may have
+    # been written again since it was swept)
+    sweep_reverse_index_script = {
+        'lua': """
+            if not redis.call('zscore', KEYS[1], ARGV[1]) then
+                redis.call('srem', KEYS[2], ARGV[2])
+            end
+        """,
+    }
+
     def __init__(self, *args, **kwargs):
         """
-        Handle the new optional "pattern" attribute
+        Handle the new optional "pattern", "format", "ttl", "inventory",
+        "buffer", "cache", "reverse_index", "hyperloglog",
+        "hyperloglog_retention" and "filter_cache_ttl" attributes
         """
         self._pattern = kwargs.pop('pattern', None)
         if self._pattern:
@@ -39,10 +159,51 @@ class DynamicFieldMixin(object):
 
         self._format = kwargs.pop('format', None)
 
+        self._ttl = kwargs.pop('ttl', None)
+
+        self._inventory_type = kwargs.pop('inventory', 'set')
+        if self._inventory_type not in self.inventory_classes:
+            raise ImplementationError('Invalid inventory "%s" for a dynamic field' % self._inventory_type)
+        if self._ttl and self._inventory_type != 'set':
+            raise ImplementationError('A dynamic field with a ttl can only use the '
+                                      'default inventory')
+
+        self._buffer = kwargs.pop('buffer', None)
+
+        self._cache = kwargs.pop('cache', None)
+
+        self._reverse_index = kwargs.pop('reverse_index', False)
+
+        self._hyperloglog = kwargs.pop('hyperloglog', False)
+        self._hyperloglog_retention = kwargs.pop('hyperloglog_retention', 90)
+
+        self._filter_cache_ttl = kwargs.pop('filter_cache_ttl', None)
+        self._filter_cache_stats = {'hits': 0, 'misses': 0}
+
         self.dynamic_version_of = None
 
         super(DynamicFieldMixin, self).__init__(*args, **kwargs)
 
+        if self._buffer is not None:
+            if self.indexable:
+                raise ImplementationError('A buffered dynamic field cannot be '
+                                          'indexable')
+            if not isinstance(self, (limpyd_fields.StringField, limpyd_fields.HashField)):
+                raise ImplementationError('Only dynamic string and hash fields '
+                                          'can be buffered')
+
+        if self._ttl:
+            if self.indexable:
+                raise ImplementationError('A dynamic field with a ttl cannot be '
+                                          'indexable: indexes would not expire')
+            if isinstance(self, limpyd_fields.InstanceHashField):
+                raise ImplementationError('A dynamic InstanceHashField cannot have '
+                                          'a ttl: its key is shared with other fields')
+
+        if self._filter_cache_ttl and not self.indexable:
+            raise ImplementationError('A dynamic field with a filter cache must '
+                                      'be indexable')
+
     def _attach_to_model(self, model):
         """
         Check that the model can handle dynamic fields
@@ -58,6 +219,9 @@ class DynamicFieldMixin(object):
         if self.dynamic_version_of is not None:
             return
 
+        if self._cache is not None:
+            self._cache.register_model(model)
+
         if hasattr(model, self.name):
             return
 
@@ -74,7 +238,10 @@ class DynamicFieldMixin(object):
             return self.dynamic_version_of.pattern
 
         if not self._pattern:
-            self._pattern = re.compile('^%s_(.+)$' % self.name)
+            if self._inventory_type == 'bitmap':
+                self._pattern = re.compile(r'^%s_(0|[1-9]\d*)$' % self.name)
+            else:
+                self._pattern = re.compile('^%s_(.+)$' % self.name)
         return self._pattern
 
     @property
@@ -100,15 +267,32 @@ class DynamicFieldMixin(object):
     def _accept_name(self, field_name):
         """
         Return True if the given field name can be accepted by this dynamic field
+        (and its dynamic part by its inventory)
         """
-        return bool(self.pattern.match(field_name))
+        match = self.pattern.match(field_name)
+        if not match:
+            return False
+        if not match.groups():
+            return True
+        return self.inventory_classes[self._inventory_type].accepts(match.groups()[0])
 
     def __copy__(self):
         """
-        Copy the _pattern attribute to the new copy of this field
+        Copy the _pattern, _ttl, _inventory_type, _buffer, _cache,
+        _reverse_index, _hyperloglog, _hyperloglog_retention, _filter_cache_ttl
+        and _filter_cache_stats attributes to the new copy of this field (stats are shared)
         """
         new_copy = super(DynamicFieldMixin, self).__copy__()
         new_copy._pattern = self._pattern
+        new_copy._ttl = self._ttl
+        new_copy._inventory_type = self._inventory_type
+        new_copy._buffer = self._buffer
+        new_copy._cache = self._cache
+        new_copy._reverse_index = self._reverse_index
+        new_copy._hyperloglog = self._hyperloglog
+        new_copy._hyperloglog_retention = self._hyperloglog_retention
+        new_copy._filter_cache_ttl = self._filter_cache_ttl
+        new_copy._filter_cache_stats = self._filter_cache_stats
         return new_copy
 
     def _create_dynamic_version(self):
@@ -128,14 +312,19 @@ class DynamicFieldMixin(object):
     @property
     def _inventory(self):
         """
-        Return (and create if needed) the internal inventory field, a SetField
-        used to track all dynamic versions used on a specific instance.
+        Return (and create if needed) the internal inventory field, used to
+        track all dynamic versions used on a specific instance: by default a
+        SetField, or a SortedSetField scored by expiry times if the field has a
+        ttl, or a bitmap if asked via the "inventory" argument.
         """
         if self.dynamic_version_of:
             return self.dynamic_version_of._inventory
 
         if not hasattr(self, '_inventory_field'):
-            self._inventory_field = limpyd_fields.SetField()
+            if self._ttl:
+                self._inventory_field = SortedSetInventory(ttl=self._ttl)
+            else:
+                self._inventory_field = self.inventory_classes[self._inventory_type]()
             self._inventory_field._attach_to_model(self._model)
             self._inventory_field._attach_to_instance(self._instance)
             self._inventory_field.lockable = True
@@ -148,20 +337,146 @@ class DynamicFieldMixin(object):
         If a command is called for the main field, without dynamic part, an
         ImplementationError is raised: commands can only be applied on dynamic
         versions.
-        On dynamic versions, if the command is a modifier, we add the version in
-        the inventory.
+        On dynamic versions, if the command is a modifier, we track the version
+        (see `_track_version`), except for increments on a buffered field, which
+        are simply added to the buffer.
+        If the field has a cache, reads are fetched from it (except in a
+        pipeline or a batch), and writes invalidate it, as well as the results
+        of `dynamic_filter` kept if the field has a "filter_cache_ttl" (in the
+        transaction tracking the version).
         """
         if self.dynamic_version_of is None:
             raise ImplementationError('The main version of a dynamic field cannot accept commands')
+        if self._buffer is not None and name in self.buffered_commands \
+                and name in self.available_modifiers:
+            return self._buffer_increment(name, *args, **kwargs)
+        call = super(DynamicFieldMixin, self)._call_command
+        if self._cache is not None and name in self.cached_commands \
+                and not in_pipeline(self.database) and current_batch() is None:
+            return self._cache.fetch(self, name, args, kwargs,
+                                     lambda: call(name, *args, **kwargs))
         try:
-            result = super(DynamicFieldMixin, self)._call_command(name, *args, **kwargs)
+            result = call(name, *args, **kwargs)
         except:
             raise
         else:
-            if name in self.available_modifiers and name not in ('delete', 'hdel'):
-                self._inventory.sadd(self.dynamic_part)
+            if name in self.available_modifiers:
+                self._invalidate_cache()
+                # the generation is incremented in the same transaction as the
+                # tracking, not in its own round trip
+                with pipelined(self.database, transaction=bool(self._filter_cache_ttl)):
+                    if self._filter_cache_ttl:
+                        self._invalidate_filter_cache()
+                    if name not in ('delete', 'hdel'):
+                        self._track_version()
             return result
 
+    def _invalidate_cache(self):
+        """
+        Remove the cached reads of the current dynamic version, if the field has
+        a cache. In a batch, it is deferred to the flush.
+        """
+        if self._cache is None:
+            return
+        if defer_in_batch((self.key, self.name, 'cache'), self._invalidate_cache, self.database):
+            return
+        self._cache.invalidate(*self._version_keys())
+
+    def _filter_cache_generation_key(self):
+        """
+        Return the key of the counter incremented on each write on the current
+        dynamic version, used in the keys of the results of `dynamic_filter`.
+        """
+        return self.make_key(self._model._name, self.name, 'filter-cache-generation')
+
+    def _filter_cache_key_prefix(self):
+        """
+        Return the start of the keys of the results of `dynamic_filter` on the
+        current dynamic version, to be followed by the generation.
+        """
+        return '%s:' % self.make_key(self._model._name, self.name, 'filter-cache')
+
+    def _invalidate_filter_cache(self):
+        """
+        Increment the generation of the current dynamic version, so results of
+        `dynamic_filter` kept before are not used anymore (they will expire).
+        In a batch, it is deferred to the flush.
+        """
+        if defer_in_batch((self.key, self.name, 'filter-cache'), self._invalidate_filter_cache, self.database):
+            return
+        self.connection.incr(self._filter_cache_generation_key())
+
+    @property
+    def filter_cache_stats(self):
+        """
+        Return a dict with the numbers of hits and misses of the results of
+        `dynamic_filter` kept for this field (counted in the current process).
+        """
+        return dict(self._filter_cache_stats)
+
+    def _buffer_increment(self, name, *args, **kwargs):
+        """
+        Add the increment asked by the `name` command (one of
+        `buffered_commands`) to the buffer of the field.
+        """
+        hash_key = None
+        if name == 'hincrby':
+            if args:
+                hash_key, args = args[0], args[1:]
+            else:
+                hash_key = kwargs['key']
+        amount = args[0] if args else kwargs.get('amount', 1)
+        self._buffer.add(self, self.buffered_commands[name] * int(amount), hash_key)
+
+    def _apply_buffered_increment(self, amount, hash_key=None):
+        """
+        Send an increment coalesced by the buffer, without tracking the version
+        (the buffer does it only once for each version).
+        """
+        call = super(DynamicFieldMixin, self)._call_command
+        self._invalidate_cache()
+        if hash_key is None:
+            return call('incrby', amount)
+        return call('hincrby', hash_key, amount)
+
+    def _version_keys(self):
+        """
+        Return the list of keys holding the data of the current dynamic version.
+        """
+        return [self.key]
+
+    def _track_version(self, expire_at=None):
+        """
+        Called after each write on a dynamic version: add it to the inventory
+        (and the instance to the reverse index, and the dynamic part to the
+        HyperLogLogs, if any, the one of the day expiring after the retention)
+        and, if the field has a ttl, set the expiry of its keys, all in one
+        pipeline. In a batch, it is deferred to the flush (and
+        done only once).
+        If `expire_at` (a timestamp) is given, for a field with a ttl, the keys
+        are considered to already expire at this time: their expiry is not set,
+        and the inventory is scored with it.
+        """
+        if defer_in_batch((self.key, self.name, 'inventory'),
+                          lambda: self._track_version(expire_at), self.database):
+            return
+        with pipelined(self.database):
+            if self._ttl and expire_at is None:
+                for key in self._version_keys():
+                    self.connection.expire(key, self._ttl)
+            if self._ttl:
+                self._inventory.add_version(self.dynamic_part, expire_at)
+            else:
+                self._inventory.add_version(self.dynamic_part)
+            if self._reverse_index:
+                self.connection.sadd(self._reverse_index_key(self.dynamic_part), self._instance._pk)
+            if self._hyperloglog:
+                day_key = self._hyperloglog_key(datetime.utcnow().date())
+                for key in (self._hyperloglog_key(), day_key):
+                    self.connection.pfadd(key, self.dynamic_part)
+                if self._hyperloglog_retention:
+                    self.connection.expire(day_key, self._hyperloglog_retention * 86400)
+
     def delete(self):
         """
         If a dynamic version, delete it the standard way and remove it from the
@@ -171,7 +486,92 @@ class DynamicFieldMixin(object):
             self._delete_dynamic_versions()
         else:
             super(DynamicFieldMixin, self).delete()
-            self._inventory.srem(self.dynamic_part)
+            self._untrack_version()
+
+    def _untrack_version(self):
+        """
+        Called after the deletion of a dynamic version: remove it from the
+        inventory (and the instance from the reverse index if any). In a batch,
+        it is deferred to the flush.
+        """
+        if defer_in_batch((self.key, self.name, 'inventory'), self._untrack_version, self.database):
+            return
+        with pipelined(self.database):
+            self._inventory.remove_versions(self.dynamic_part)
+            if self._reverse_index:
+                self.connection.srem(self._reverse_index_key(self.dynamic_part), self._instance._pk)
+
+    def _reverse_index_key(self, dynamic_part):
+        """
+        Return the key of the set holding the pks of the instances having a
+        dynamic version for the given dynamic part.
+        """
+        return self.make_key(self._model._name, self._base_field().name,
+                             'instances', dynamic_part)
+
+    def _get_reverse_index_key(self, dynamic_part):
+        """
+        Check that the field maintains a reverse index, and return its key for
+        the given dynamic part (or instance for related fields).
+        """
+        if not self._reverse_index:
+            raise ImplementationError('The field "%s" has no reverse index' % self.name)
+        version = self._model.get_class_field(self.get_name_for(dynamic_part))
+        return self._reverse_index_key(version.dynamic_part)
+
+    def _hyperloglog_key(self, day=None):
+        """
+        Return the key of the HyperLogLog of the dynamic parts used for the
+        whole model, or only the given day (a date or a "YYYY-MM-DD" string).
+        """
+        parts = [self._model._name, self._base_field().name, 'parts']
+        if day is not None:
+            parts.append(day if isinstance(day, string_types) else day.strftime('%Y-%m-%d'))
+        return self.make_key(*parts)
+
+    def _check_hyperloglog(self):
+        """
+        Raise an ImplementationError if the field has no HyperLogLog.
+        """
+        if not self._hyperloglog:
+            raise ImplementationError('The field "%s" has no HyperLogLog' % self.name)
+
+    def approximate_parts_count(self, *days):
+        """
+        Return the approximate number of distinct dynamic parts used on the
+        whole model (only on the given days, dates or "YYYY-MM-DD" strings, if
+        any). Only for fields with "hyperloglog=True".
+        """
+        self._check_hyperloglog()
+        if not days:
+            return self.connection.pfcount(self._hyperloglog_key())
+        return self.connection.pfcount(*[self._hyperloglog_key(day) for day in days])
+
+    def approximate_parts_count_by_day(self, *days):
+        """
+        Return a dict with, for each of the given days (dates or "YYYY-MM-DD"
+        strings), the approximate number of distinct dynamic parts used on
+        this day, read in one pipeline. Only for fields with "hyperloglog=True".
+        """
+        self._check_hyperloglog()
+        pipeline = self.connection.pipeline(transaction=False)
+        for day in days:
+            pipeline.pfcount(self._hyperloglog_key(day))
+        return dict(zip(days, pipeline.execute()))
+
+    def instances_having(self, dynamic_part):
+        """
+        Return the set of the pks of the instances having a dynamic version for
+        the given dynamic part. Only for fields with a reverse index.
+        """
+        return self.connection.smembers(self._get_reverse_index_key(dynamic_part))
+
+    def count_instances_having(self, dynamic_part):
+        """
+        Return the number of instances having a dynamic version for the given
+        dynamic part. Only for fields with a reverse index.
+        """
+        return self.connection.scard(self._get_reverse_index_key(dynamic_part))
 
     def _delete_dynamic_versions(self):
         """
@@ -182,7 +582,7 @@ class DynamicFieldMixin(object):
             raise ImplementationError(u'"_delete_dynamic_versions" can only be '
                                       u'executed on the base field')
         inventory = self._inventory
-        for dynamic_part in inventory.smembers():
+        for dynamic_part in inventory.versions():
             name = self.get_name_for(dynamic_part)
             # create the field
             new_field = self._create_dynamic_version()
@@ -201,6 +601,9 @@ class DynamicFieldMixin(object):
         the given dynamic part. Use the "format" attribute to create the final
         name.
         """
+        if not self.inventory_classes[self._inventory_type].accepts(dynamic_part):
+            raise ValueError('Invalid dynamic part "%s" for the field "%s"' % (
+                             dynamic_part, self.name))
         name = self.format % dynamic_part
         if not self._accept_name(name):
             raise ImplementationError('It seems that pattern and format do not '
@@ -230,9 +633,130 @@ class DynamicFieldMixin(object):
         return self.database.scan_keys(pattern, count)
 
     def sscan(self, match=None, count=None):
-        return self._inventory.sscan(match, count)
+        return self._inventory.scan_versions(match, count)
     scan_versions = sscan
 
+    def reindex_dynamic_versions(self, chunk_size=1000, processes=None, progress=None,
+                                 resume=False):
+        """
+        Index the current values of all the dynamic versions of all the
+        instances, for example after making an existing dynamic field
+        indexable, or adding an index class (existing entries are kept).
+        The pks still to do (the ones not in a "done" set, with SDIFFSTORE) are
+        read by chunks of `chunk_size` with SSCAN, and for each chunk, the
+        inventories are read, then the values of the versions in one pipeline,
+        and they are indexed in another one, with the pks added to the "done"
+        set. With `processes`, chunks are done in parallel by a pool of this
+        number of processes.
+        If given, `progress` is called after each chunk with the number of
+        instances done and the total number to do.
+        If interrupted, call it again with `resume=True` to skip the instances
+        already done (else all are done again). The "done" set is deleted at
+        the end. Return the number of instances reindexed.
+        """
+        if self.dynamic_version_of is not None or hasattr(self, '_instance'):
+            raise ImplementationError('"reindex_dynamic_versions" can only be '
+                                      'executed on the base field of the model')
+        if not self.indexable or self.unique:
+            raise ImplementationError('"reindex_dynamic_versions" can only be '
+                                      'executed on an indexable, non-unique, field')
+
+        done_key = self.make_key(self._model._name, self.name, 'reindex', 'done')
+        todo_key = self.make_key(self._model._name, self.name, 'reindex', 'todo')
+        connection = self.connection
+        if not resume:
+            connection.delete(done_key)
+        total = connection.sdiffstore(todo_key, [self._model.get_field('pk').collection_key, done_key])
+
+        def chunks():
+            pks = []
+            for pk in connection.sscan_iter(todo_key, count=chunk_size):
+                pks.append(pk)
+                if len(pks) >= chunk_size:
+                    yield (self._model, self.name, pks, done_key)
+                    pks = []
+            if pks:
+                yield (self._model, self.name, pks, done_key)
+
+        done = 0
+        pool = Pool(processes) if processes else None
+        try:
+            results = pool.imap_unordered(_reindex_chunk_star, chunks()) if pool \
+                else (_reindex_chunk_star(chunk) for chunk in chunks())
+            for count in results:
+                done += count
+                if progress is not None:
+                    progress(done, total)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        connection.delete(todo_key, done_key)
+        return done
+
+    def sweep_expired_versions(self, chunk_size=1000):
+        """
+        Remove the expired dynamic parts from the inventories of a field with a
+        ttl. On a field bound to an instance, only its inventory is swept, else
+        the inventories of all the instances of the model, reading pks by chunks
+        of `chunk_size`, with only one pipeline for each chunk.
+        Return the number of dynamic parts removed.
+        """
+        if self.dynamic_version_of is not None:
+            raise ImplementationError('"sweep_expired_versions" can only be '
+                                      'executed on the base field')
+        if not self._ttl:
+            raise ImplementationError('"sweep_expired_versions" can only be '
+                                      'executed on a field with a ttl')
+
+        if hasattr(self, '_instance'):
+            expired = self._sweep_inventories([self._instance.pk.get()])
+            return sum(len(parts) for parts in expired.values())
+
+        removed = 0
+        pks = []
+        collection_key = self._model.get_field('pk').collection_key
+        for pk in self.connection.sscan_iter(collection_key, count=chunk_size):
+            pks.append(pk)
+            if len(pks) >= chunk_size:
+                removed += sum(len(parts) for parts in self._sweep_inventories(pks).values())
+                pks = []
+        if pks:
+            removed += sum(len(parts) for parts in self._sweep_inventories(pks).values())
+        return removed
+
+    def _sweep_inventories(self, pks):
+        """
+        Remove the expired dynamic parts from the inventories of the instances
+        with the given pks, and return them as a dict (by pk).
+        For each inventory, ZRANGEBYSCORE and ZREMRANGEBYSCORE are used with the
+        same boundary, in a transaction, so a version written again in the
+        meantime is kept, and not reported.
+        If the field has a reverse index, the instances are then removed from
+        it for their expired dynamic parts, in another pipeline, only if these
+        parts were not written again since (checked by a lua script).
+        """
+        until = time()
+        keys = [self.make_key(self._model._name, pk, self.name) for pk in pks]
+        pipeline = self.connection.pipeline(transaction=True)
+        for key in keys:
+            pipeline.zrangebyscore(key, '-inf', until)
+            pipeline.zremrangebyscore(key, '-inf', until)
+        results = pipeline.execute()
+        expired = dict(zip(pks, results[::2]))
+        if self._reverse_index and any(expired.values()):
+            with pipelined(self.database):
+                for pk, key in zip(pks, keys):
+                    for dynamic_part in expired[pk]:
+                        self.database.call_script(
+                            # be sure to use the script dict at the class level
+                            # to avoid registering it many times
+                            script_dict=DynamicFieldMixin.sweep_reverse_index_script,
+                            keys=[key, self._reverse_index_key(dynamic_part)],
+                            args=[dynamic_part, pk],
+                        )
+        return expired
 
 
 class DynamicStringField(DynamicFieldMixin, limpyd_fields.StringField):
@@ -257,3 +781,147 @@ class DynamicSortedSetField(DynamicFieldMixin, limpyd_fields.SortedSetField):
 
 class DynamicHashField(DynamicFieldMixin, limpyd_fields.HashField):
     pass
+
+
+class ShardedCounterFieldMixin(object):
+    """
+    A mixin for dynamic string and hash fields used as counters incremented by
+    many clients, to avoid hot keys: the data of each dynamic version is spread
+    on many keys (the "shards" argument, default to 8), each increment being
+    done on one of them, chosen randomly, or by process if the "shard_by"
+    argument is "process". Reads sum the values of all the shards in one round
+    trip, and increments return the new value of the used shard.
+    Setting a value resets all shards. These fields cannot be indexable.
+    """
+
+    sharded_increments = {'incr', 'incrby', 'decr', 'decrby', 'incrbyfloat',
+                          'hincrby', 'hincrbyfloat'}
+
+    def __init__(self, *args, **kwargs):
+        """
+        Handle the new optional "shards" and "shard_by" attributes
+        """
+        self.shards = kwargs.pop('shards', 8)
+        self.shard_by = kwargs.pop('shard_by', 'random')
+        if self.shard_by not in ('random', 'process'):
+            raise ImplementationError('"shard_by" must be "random" or "process"')
+
+        super(ShardedCounterFieldMixin, self).__init__(*args, **kwargs)
+
+        if self.indexable:
+            raise ImplementationError('A sharded field cannot be indexable')
+
+    def __copy__(self):
+        """
+        Copy the shards and shard_by attributes to the new copy of this field
+        """
+        new_copy = super(ShardedCounterFieldMixin, self).__copy__()
+        new_copy.shards = self.shards
+        new_copy.shard_by = self.shard_by
+        return new_copy
+
+    def _pick_shard(self):
+        """
+        Return the number of the shard to use for an increment.
+        """
+        if self.shard_by == 'process':
+            return os.getpid() % self.shards
+        return randrange(self.shards)
+
+    def _shard_key(self, shard):
+        return self.make_key(self.key, 'shard', shard)
+
+    def _version_keys(self):
+        """
+        The data of a dynamic version is in all its shards.
+        """
+        return [self._shard_key(shard) for shard in range(self.shards)]
+
+    @staticmethod
+    def _sum(values):
+        """
+        Return the sum of the given values got from redis (None if no value), as
+        a string like the value of a non-sharded field.
+        """
+        values = [value for value in values if value is not None]
+        if not values:
+            return None
+        if any('.' in value or 'e' in value for value in values):
+            return '%s' % sum(float(value) for value in values)
+        return '%s' % sum(int(value) for value in values)
+
+    def _read_shards(self, command, *args):
+        """
+        Call the given command, with the given arguments, on all shards, in one
+        pipeline, and return the list of results.
+        """
+        pipeline = self.connection.pipeline(transaction=False)
+        for key in self._version_keys():
+            getattr(pipeline, command)(key, *args)
+        return pipeline.execute()
+
+    def _traverse_command(self, name, *args, **kwargs):
+        """
+        Route increments to one shard and other commands to all shards.
+        """
+        if name not in self.available_commands:
+            raise AttributeError("%s is not an available command for %s" %
+                                 (name, self.__class__.__name__))
+        if name in self.sharded_increments:
+            key = self._shard_key(self._pick_shard())
+            result = getattr(self.connection, name)(key, *args, **kwargs)
+        else:
+            result = getattr(self, '_sharded_%s' % name)(*args, **kwargs)
+        return self.post_command(sender=self, name=name, result=result, args=args, kwargs=kwargs)
+
+    def _sharded_delete(self):
+        return self.connection.delete(*self._version_keys())
+
+
+class DynamicShardedStringField(ShardedCounterFieldMixin, DynamicStringField):
+
+    available_getters = {'get', }
+    available_modifiers = {'delete', 'set', 'incr', 'incrby', 'decr', 'decrby', 'incrbyfloat', }
+
+    def _sharded_get(self):
+        return self._sum(self.connection.mget(self._version_keys()))
+
+    def _sharded_set(self, value, ex=None, px=None):
+        keys = self._version_keys()
+        with pipelined(self.database):
+            self.connection.delete(*keys[1:])
+            self.connection.set(keys[0], value, ex=ex, px=px)
+        return True
+
+
+class DynamicShardedHashField(ShardedCounterFieldMixin, DynamicHashField):
+
+    available_getters = {'hget', 'hmget', 'hgetall', }
+    available_modifiers = {'delete', 'hdel', 'hmset', 'hincrby', 'hincrbyfloat', }
+
+    def _sharded_hget(self, key):
+        return self._sum(self._read_shards('hget', key))
+
+    def _sharded_hmget(self, keys):
+        results = self._read_shards('hmget', keys)
+        return [self._sum(values) for values in zip(*results)]
+
+    def _sharded_hgetall(self):
+        values = {}
+        for result in self._read_shards('hgetall'):
+            for key, value in result.items():
+                values.setdefault(key, []).append(value)
+        return {key: self._sum(key_values) for key, key_values in values.items()}
+
+    def _sharded_hdel(self, *keys):
+        with pipelined(self.database):
+            for key in self._version_keys():
+                self.connection.hdel(key, *keys)
+
+    def _sharded_hmset(self, mapping):
+        keys = self._version_keys()
+        with pipelined(self.database):
+            for key in keys[1:]:
+                self.connection.hdel(key, *mapping.keys())
+            self.connection.hmset(keys[0], mapping)
+        return True
@@ -0,0 +1,159 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+from fnmatch import fnmatchcase
+import re
+from time import time
+
+from limpyd import fields as limpyd_fields
+
+from ..utils import pipelined
+
+
+class SetInventory(limpyd_fields.SetField):
+    """
+    The default inventory of a dynamic field: a set with all the dynamic parts
+    used on a specific instance.
+    """
+
+    @classmethod
+    def accepts(cls, dynamic_part):
+        """
+        Tell if the given dynamic part can be stored in this kind of inventory
+        """
+        return True
+
+    def add_version(self, dynamic_part):
+        return self.sadd(dynamic_part)
+
+    def remove_versions(self, *dynamic_parts):
+        return self.srem(*dynamic_parts)
+
+    def has_version(self, dynamic_part):
+        return self.sismember(dynamic_part)
+
+    def count_versions(self):
+        return self.scard()
+
+    def versions(self):
+        return self.smembers()
+
+    def scan_versions(self, match=None, count=None):
+        return self.sscan(match, count)
+
+
+class SortedSetInventory(limpyd_fields.SortedSetField):
+    """
+    The inventory used by dynamic fields having a ttl: a sorted set with all the
+    dynamic parts used on a specific instance, scored by their expiry time, so
+    expired versions are ignored, and can be cheaply removed (see
+    `DynamicFieldMixin.sweep_expired_versions`).
+    The inventory key itself expires with the last written version.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._ttl = kwargs.pop('ttl')
+        super(SortedSetInventory, self).__init__(*args, **kwargs)
+
+    def add_version(self, dynamic_part, expire_at=None):
+        """
+        Add the dynamic part, scored by its expiry time: the given one, if the
+        keys of the version already expire, else in `ttl` seconds.
+        """
+        result = self.zadd({dynamic_part: time() + self._ttl if expire_at is None else expire_at})
+        self.expire(self._ttl)
+        return result
+
+    def remove_versions(self, *dynamic_parts):
+        return self.zrem(*dynamic_parts)
+
+    def has_version(self, dynamic_part):
+        score = self.zscore(dynamic_part)
+        return score is not None and score > time()
+
+    def count_versions(self):
+        return self.zcount('(%s' % time(), '+inf')
+
+    def versions(self):
+        return set(self.zrangebyscore('(%s' % time(), '+inf'))
+
+    def scan_versions(self, match=None, count=None):
+        now = time()
+        for dynamic_part, expire_at in self.zscan(match, count):
+            if expire_at > now:
+                yield dynamic_part
+
+
+class BitmapInventory(limpyd_fields.StringField):
+    """
+    An inventory for dynamic fields whose dynamic parts are non-negative
+    integers (user ids, day numbers...): a bitmap where the bit at the offset
+    of each used dynamic part is set, giving O(1) membership, about one bit of
+    memory for each possible dynamic part, and fast enumeration.
+    As the size of the bitmap depends on the highest dynamic part, it is only
+    suitable for dense enough integers.
+    """
+
+    re_dynamic_part = re.compile(r'^(?:0|[1-9]\d*)$')
+
+    # SETBIT only accepts offsets lower than 2**32 (bitmaps up to 512MB)
+    max_dynamic_part = 2 ** 32 - 1
+
+    # number of 32 bits words read in one call when enumerating versions
+    scan_words_count = 256
+
+    @classmethod
+    def accepts(cls, dynamic_part):
+        """
+        Only canonical non-negative integers (no sign, no leading zero) are
+        accepted, to have only one possible representation for a bit offset,
+        and up to `max_dynamic_part`, the highest offset accepted by redis.
+        """
+        if not isinstance(dynamic_part, int):
+            if not cls.re_dynamic_part.match('%s' % dynamic_part):
+                return False
+            dynamic_part = int(dynamic_part)
+        return 0 <= dynamic_part <= cls.max_dynamic_part
+
+    def add_version(self, dynamic_part):
+        return self.setbit(int(dynamic_part), 1)
+
+    def remove_versions(self, *dynamic_parts):
+        with pipelined(self.database):
+            for dynamic_part in dynamic_parts:
+                self.setbit(int(dynamic_part), 0)
+
+    def has_version(self, dynamic_part):
+        return bool(self.getbit(int(dynamic_part)))
+
+    def count_versions(self):
+        return self.bitcount()
+
+    def versions(self):
+        return set(self.scan_versions())
+
+    def scan_versions(self, match=None, count=None):
+        """
+        Iterate on the dynamic parts in the bitmap, in ascending order. Each
+        chunk of `count` 32 bits words is read with one BITFIELD call (which
+        returns integers, safe whatever the response decoding), and BITPOS is
+        used to jump over empty regions.
+        The optional `match` is a glob-style pattern, like for SSCAN.
+        """
+        count = count or self.scan_words_count
+        position = self.bitpos(1)
+        while position >= 0:
+            first_word = position // 32
+            bitfield = self.connection.bitfield(self.key)
+            for word in range(first_word, first_word + count):
+                bitfield.get('u32', '#%d' % word)
+            for index, value in enumerate(bitfield.execute()):
+                if not value:
+                    continue
+                offset = (first_word + index) * 32
+                for bit in range(32):
+                    if value & (1 << (31 - bit)):
+                        dynamic_part = '%d' % (offset + bit)
+                        if match is None or fnmatchcase(dynamic_part, match):
+                            yield dynamic_part
+            position = self.bitpos(1, (first_word + count) * 4)
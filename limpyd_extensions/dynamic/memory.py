@@ -0,0 +1,252 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+from time import sleep as time_sleep
+
+from limpyd import fields as limpyd_fields
+from limpyd.exceptions import ImplementationError
+from limpyd.indexes import BaseRangeIndex, EqualIndex
+
+from .fields import DynamicFieldMixin
+
+
+def _index_keys(field, value):
+    """
+    Return the list of the keys of the indexes of `field` holding the given
+    value (as read with `proxy_get`), each one with the command giving the
+    number of pks in it. Only EqualIndex (sets) and range indexes (sorted
+    sets) are supported, other indexes are ignored.
+    """
+    if isinstance(field, limpyd_fields.HashField):
+        all_args = list(value.items())
+    elif isinstance(field, limpyd_fields.MultiValuesField):
+        all_args = [(member, ) for member in value]
+    else:
+        all_args = [(value, )]
+
+    keys = []
+    for index in field._indexes:
+        if isinstance(index, BaseRangeIndex):
+            command = 'zcard'
+        elif type(index) is EqualIndex:
+            command = 'scard'
+        else:
+            continue
+        for args in all_args:
+            key = (index.get_storage_key(*args), command)
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+def _new_stats(dynamic=False):
+    """
+    Return the dict used to count the keys and memory of a field in the
+    sample (with the number of versions of each instance for dynamic fields).
+    """
+    stats = {'keys': 0, 'memory': 0, 'data': 0, 'inventory': 0, 'indexes': 0}
+    if dynamic:
+        stats['versions'] = []
+    return stats
+
+
+def _sample_chunk(model, fields, related_fields, pks, report, samples):
+    """
+    Add to `report` the keys and memory used by the given fields (and the
+    reverse relations of the given related fields) of the instances of
+    `model` with the given pks: dynamic versions are listed from the
+    inventories, then the values of the indexable fields are read in one
+    pipeline, and MEMORY USAGE is called on all the keys in another one, with
+    the cardinality of the shared keys (indexes), to count only the share of
+    each instance. Return True if the instances have an instance hash.
+    """
+    entries = []  # tuples (stats, kind, key, cardinality command)
+    to_read = []  # tuples (stats, field)
+    instancehash_fields = False
+    instances = [model.lazy_connect(pk) for pk in pks]
+
+    # the dynamic parts of the versions of dynamic related fields linking
+    # instances to the current ones
+    parts = iter(())
+    dynamic_related_fields = [field for field in related_fields if isinstance(field, DynamicFieldMixin)]
+    if dynamic_related_fields:
+        pipeline = model.get_connection().pipeline(transaction=False)
+        for instance in instances:
+            for related_field in dynamic_related_fields:
+                pipeline.smembers(related_field._parts_key(instance._pk))
+        parts = iter(pipeline.execute())
+
+    for instance in instances:
+        instancehash_done = False
+        for base_field in fields:
+            stats = report['fields'][base_field.name]
+            field = instance.get_field(base_field.name)
+            if isinstance(field, DynamicFieldMixin):
+                versions = [field.get_for(dynamic_part)
+                            for dynamic_part in field._inventory.scan_versions()]
+                stats['versions'].append(len(versions))
+                entries.append((stats, 'inventory', field._inventory.key, None))
+                for version in versions:
+                    if not isinstance(version, limpyd_fields.InstanceHashField):
+                        for key in version._version_keys():
+                            entries.append((stats, 'data', key, None))
+                    if version._reverse_index:
+                        entries.append((stats, 'indexes',
+                                        version._reverse_index_key(version.dynamic_part), 'scard'))
+                    if version.indexable:
+                        to_read.append((stats, version))
+            else:
+                if not isinstance(field, limpyd_fields.InstanceHashField):
+                    entries.append((stats, 'data', field.key, None))
+                if field.indexable:
+                    to_read.append((stats, field))
+            if isinstance(field, limpyd_fields.InstanceHashField) and not instancehash_done:
+                entries.append((report['instancehash'], 'data', instance.key, None))
+                instancehash_done = instancehash_fields = True
+
+        for related_field in related_fields:
+            stats = report['related'][related_field.related_name]
+            if isinstance(related_field, DynamicFieldMixin):
+                versions = [related_field._model.get_field(related_field.get_name_for(dynamic_part))
+                            for dynamic_part in next(parts)]
+                stats['versions'].append(len(versions))
+                entries.append((stats, 'inventory', related_field._parts_key(instance._pk), None))
+            else:
+                versions = [related_field]
+            for version in versions:
+                key = version.get_index(index_class=EqualIndex).get_storage_key(instance._pk)
+                entries.append((stats, 'data', key, None))
+
+    if to_read:
+        with model.database.pipeline(transaction=False) as pipeline:
+            for stats, field in to_read:
+                field.proxy_get()
+            values = pipeline.execute()
+        for (stats, field), value in zip(to_read, values):
+            if value:
+                for key, command in _index_keys(field, value):
+                    entries.append((stats, 'indexes', key, command))
+
+    pipeline = model.get_connection().pipeline(transaction=False)
+    for stats, kind, key, command in entries:
+        pipeline.memory_usage(key, samples=samples)
+        if command:
+            getattr(pipeline, command)(key)
+    results = iter(pipeline.execute())
+
+    for stats, kind, key, command in entries:
+        memory = next(results)
+        cardinality = next(results) if command else 1
+        if not memory:  # the key does not exist
+            continue
+        if command:
+            # shared by `cardinality` instances
+            memory = float(memory) / (cardinality or 1)
+        else:
+            stats['keys'] += 1
+        stats[kind] += memory
+        stats['memory'] += memory
+
+    return instancehash_fields
+
+
+def _extrapolate(stats, ratio):
+    """
+    Return the stats of a field, extrapolated from the sample to all the
+    instances with `ratio`.
+    """
+    result = dict((name, int(round(stats[name] * ratio)))
+                  for name in ('keys', 'memory', 'data', 'inventory', 'indexes'))
+    if 'versions' in stats:
+        counts = sorted(stats['versions'])
+        result['versions'] = int(round(sum(counts) * ratio))
+        result['versions_per_instance'] = {
+            'min': counts[0] if counts else 0,
+            'max': counts[-1] if counts else 0,
+            'mean': float(sum(counts)) / len(counts) if counts else 0.0,
+            'median': counts[len(counts) // 2] if counts else 0,
+        }
+    return result
+
+
+def memory_usage_report(model, sample_size=100, field_names=None, chunk_size=100,
+                        sleep=0, samples=None):
+    """
+    Estimate the memory used in redis by the instances of the given model,
+    for each field (for dynamic fields: all the versions, and the inventory)
+    and each reverse relation (the sets of the instances of another model
+    linked to an instance, one for each version of a dynamic related field,
+    found in the set of their dynamic parts kept by the index), by calling
+    MEMORY USAGE on the keys of `sample_size` instances picked at random
+    (SRANDMEMBER), and extrapolating to all the instances. Keys shared by
+    many instances (index entries, reverse indexes of dynamic parts) are
+    counted for the share of each instance (memory divided by the number of
+    pks in them). Only EqualIndex and range indexes are counted.
+    Instances are read by chunks of `chunk_size`, with one pipeline for the
+    values of the indexable fields, and one for the memory of the keys. To
+    limit the load on a server in production, the process sleeps for `sleep`
+    seconds between chunks, and `samples` can be passed to MEMORY USAGE to
+    limit the number of nested values it reads (redis uses 5 by default).
+    Return a dict with:
+    - "instances": the number of instances of the model
+    - "sampled": the number of instances read
+    - "memory": the total memory, in bytes
+    - "fields": for each field (only the given ones if `field_names` is set),
+      a dict with the number of keys of the instances ("keys"), the memory of
+      these keys ("data"), of the inventory ("inventory"), of the indexes
+      ("indexes"), and their sum ("memory"), and for dynamic fields, the
+      number of versions ("versions"), and the "min", "max", "mean" and
+      "median" numbers of versions by instance ("versions_per_instance")
+    - "instancehash": the same for the hash holding all the InstanceHashField
+      (and their dynamic versions) of each instance, if any
+    - "related": the same for each related collection (by related name), the
+      "inventory" being the set of dynamic parts for dynamic related fields
+    """
+    if chunk_size < 1 or sample_size < 1:
+        raise ImplementationError('"sample_size" and "chunk_size" must be positive')
+
+    fields = [
+        model.get_field(name) for name in model._fields
+        if not model._field_is_pk(name)
+        # dynamic versions are found via the inventories of the base fields
+        and getattr(model.get_field(name), 'dynamic_version_of', None) is None
+        and (field_names is None or name in field_names)
+    ]
+    related_fields = [
+        model.database._models[model_name].get_field(field_name)
+        for model_name, field_name, _ in getattr(model.database, '_relations', {}).get(model._name.lower(), [])
+    ]
+    report = {
+        'fields': dict((field.name, _new_stats(isinstance(field, DynamicFieldMixin)))
+                       for field in fields),
+        'instancehash': _new_stats(),
+        'related': dict((field.related_name, _new_stats(isinstance(field, DynamicFieldMixin)))
+                        for field in related_fields),
+    }
+
+    connection = model.get_connection()
+    collection_key = model.get_field('pk').collection_key
+    total = connection.scard(collection_key)
+    pks = connection.srandmember(collection_key, sample_size) if total else []
+
+    has_instancehash = False
+    for start in range(0, len(pks), chunk_size):
+        if start and sleep:
+            time_sleep(sleep)
+        if _sample_chunk(model, fields, related_fields, pks[start:start + chunk_size], report, samples):
+            has_instancehash = True
+
+    ratio = float(total) / len(pks) if pks else 0
+    result = {
+        'instances': total,
+        'sampled': len(pks),
+        'fields': dict((name, _extrapolate(stats, ratio))
+                       for name, stats in report['fields'].items()),
+        'instancehash': _extrapolate(report['instancehash'], ratio) if has_instancehash else None,
+        'related': dict((name, _extrapolate(stats, ratio))
+                        for name, stats in report['related'].items()),
+    }
+    result['memory'] = sum(stats['memory'] for stats in result['fields'].values()) \
+        + sum(stats['memory'] for stats in result['related'].values()) \
+        + (result['instancehash']['memory'] if has_instancehash else 0)
+    return result
@@ -2,12 +2,73 @@
 from __future__ import unicode_literals
 from future.builtins import object
 
+from multiprocessing import Pool
+from time import time
 
 from limpyd import fields as limpyd_fields
+from limpyd.exceptions import ImplementationError, UniquenessError
 
+from ..utils import pipelined
 from .collection import CollectionManagerForModelWithDynamicField
 
 
+def _bulk_write(field, value):
+    """
+    Write the value(s) of a field of a new instance, and index them, without
+    reading anything (there is no current value to deindex).
+    """
+    if isinstance(field, limpyd_fields.HashField):
+        if field.indexable:
+            field.index(value)
+        field._traverse_command('hmset', value)
+    elif isinstance(field, limpyd_fields.SingleValueField):
+        value = field.from_python(value)
+        if field.indexable:
+            field.index(value)
+        field._traverse_command(field.proxy_setter, value)
+    elif isinstance(field, limpyd_fields.SortedSetField):
+        field._call_zadd('zadd', dict((field.from_python(member), score)
+                                      for member, score in value.items()))
+    else:
+        command = 'sadd' if isinstance(field, limpyd_fields.SetField) else 'rpush'
+        field._add(command, *[field.from_python(member) for member in value])
+
+
+def _bulk_create_chunk(model, pks, rows):
+    """
+    Create instances of `model` with the given pks (already reserved, in the
+    collection) and rows (dicts of values by field name, dynamic fields already
+    expanded), with only one pipeline. Called directly or in a worker process.
+    """
+    from .fields import DynamicFieldMixin  # here to avoid circular import
+
+    indexable_fields = []
+    with pipelined(model.database):
+        for pk, row in zip(pks, rows):
+            instance = model.lazy_connect(pk)
+            instance._connected = True
+            for name, value in row.items():
+                field = instance.get_field(name)
+                _bulk_write(field, value)
+                if field.indexable:
+                    indexable_fields.append(field)
+                if isinstance(field, DynamicFieldMixin):
+                    field._invalidate_cache()
+                    field._track_version()
+                    if field._filter_cache_ttl:
+                        field._invalidate_filter_cache()
+    for field in indexable_fields:
+        field._reset_indexes_rollback_caches(field._instance._pk)
+    return pks
+
+
+def _bulk_create_chunk_star(args):
+    """
+    Call `_bulk_create_chunk` with a tuple of arguments, for `Pool.map`.
+    """
+    return _bulk_create_chunk(*args)
+
+
 class ModelWithDynamicFieldMixin(object):
     """
     This mixin must be used to declare each model that is intended to use a
@@ -17,6 +78,23 @@ class ModelWithDynamicFieldMixin(object):
     _dynamic_fields_cache = {}
     collection_manager = CollectionManagerForModelWithDynamicField
 
+    # copy, with their ttl, the keys given by pairs (source, destination)
+    clone_keys_script = {
+        'lua': """
+            local copied = 0
+            for i = 1, #KEYS, 2 do
+                local dump = redis.call('dump', KEYS[i])
+                if dump then
+                    local ttl = redis.call('pttl', KEYS[i])
+                    if ttl < 0 then ttl = 0 end
+                    redis.call('restore', KEYS[i + 1], ttl, dump, 'REPLACE')
+                    copied = copied + 1
+                end
+            end
+            return copied
+        """,
+    }
+
     @classmethod
     def _get_dynamic_field_for(cls, field_name):
         """
@@ -156,6 +234,203 @@ class ModelWithDynamicFieldMixin(object):
 
         return new_field
 
+    @classmethod
+    def bulk_create(cls, rows, chunk_size=1000, processes=None):
+        """
+        Create many instances, each one from a dict of values by field name,
+        like the arguments of the constructor. For a dynamic field, the value
+        can also be a dict of values by dynamic part (`{'score': {'2026': 10}}`
+        is the same as `{'score_2026': 10}`).
+        The pks (given in rows, or generated at once for an AutoPKField) are
+        reserved first, by chunks, with one pipeline of SADD for each chunk,
+        then instances are created by chunks of `chunk_size`
+        rows, each chunk writing pks, fields, indexes and inventories in one
+        pipeline, without reading anything. With `processes`, chunks are
+        written in parallel by a pool of this number of processes (each one
+        with its own connections).
+        Unique fields (except the pk) are not supported.
+        Return the list of the pks of the new instances.
+        """
+        from .fields import DynamicFieldMixin  # here to avoid circular import
+
+        pk_field = cls.get_field('pk')
+        prepared_rows, pks = [], []
+        for row in rows:
+            prepared_row = {}
+            for name, value in row.items():
+                if name in ('pk', pk_field.name):
+                    pks.append(value)
+                    continue
+                field = cls.get_field(name)
+                if isinstance(field, DynamicFieldMixin) and field.dynamic_version_of is None:
+                    for dynamic_part, part_value in value.items():
+                        prepared_row[field.get_name_for(dynamic_part)] = part_value
+                else:
+                    prepared_row[name] = value
+            prepared_rows.append(prepared_row)
+
+        for name in set(name for row in prepared_rows for name in row):
+            if cls.get_field(name).unique:
+                raise ImplementationError('The unique field "%s" cannot be used '
+                                          'with bulk_create' % name)
+
+        connection = cls.get_connection()
+        if pk_field._auto_increment:
+            if pks:
+                raise ValueError('The pk for %s is "auto-increment", you must not '
+                                 'fill it' % cls.__name__)
+            last_pk = connection.incrby(cls.make_key(cls._name, 'max_pk'), len(prepared_rows))
+            pks = [pk_field.normalize(pk) for pk in range(last_pk - len(prepared_rows) + 1, last_pk + 1)]
+        else:
+            if len(pks) != len(prepared_rows):
+                raise ValueError('The pk for %s is not "auto-increment", you must '
+                                 'fill it' % cls.__name__)
+            pks = [pk_field.normalize(pk) for pk in pks]
+            if len(set(pks)) != len(pks):
+                raise UniquenessError('Some pks are used many times for model %s'
+                                      % cls.__name__)
+
+        # reserve the pks by adding them to the collection (SADD tells if a pk
+        # already exists, even if created concurrently), and release the ones
+        # added here if one was already there
+        added = []
+        for start in range(0, len(pks), chunk_size):
+            pipeline = connection.pipeline(transaction=False)
+            for pk in pks[start:start + chunk_size]:
+                pipeline.sadd(pk_field.collection_key, pk)
+            results = pipeline.execute()
+            added.extend(pk for pk, result in zip(pks[start:start + chunk_size], results) if result)
+            if len(added) < start + len(results):
+                existing = [pk for pk, result in zip(pks[start:start + chunk_size], results)
+                            if not result]
+                for added_start in range(0, len(added), chunk_size):
+                    connection.srem(pk_field.collection_key, *added[added_start:added_start + chunk_size])
+                raise UniquenessError('PKField %s already exists for model %s'
+                                      % (existing[0], cls.__name__))
+
+        chunks = [(cls, pks[start:start + chunk_size], prepared_rows[start:start + chunk_size])
+                  for start in range(0, len(pks), chunk_size)]
+        if not processes:
+            for chunk in chunks:
+                _bulk_create_chunk(*chunk)
+        else:
+            pool = Pool(processes)
+            try:
+                pool.map(_bulk_create_chunk_star, chunks)
+            finally:
+                pool.close()
+                pool.join()
+
+        return pks
+
+    def clone(self, new_pk=None, chunk_size=1000):
+        """
+        Create a new instance, with the given pk (not for an AutoPKField), with
+        a copy of all the fields and all the dynamic versions of the current
+        one. Keys are copied by redis (DUMP/RESTORE, keeping their ttl, in a
+        lua script called for each chunk of `chunk_size` keys), then the values
+        of the indexable fields and versions (and the remaining ttl of the
+        versions of fields with a ttl) are read in one pipeline, and, in
+        another one, indexed, and the versions added to the inventories (scored
+        by their copied expiry time for fields with a ttl).
+        Models with unique fields (except the pk) are not supported.
+        Return the new instance.
+        """
+        from .fields import DynamicFieldMixin  # here to avoid circular import
+
+        cls = self.__class__
+        fields = [self.get_field(name) for name in cls._fields if not cls._field_is_pk(name)]
+        if any(field.unique for field in fields):
+            raise ImplementationError('Instances of a model with unique fields '
+                                      'cannot be cloned')
+
+        # create the new pk
+        pk_field = cls.get_field('pk')
+        connection = cls.get_connection()
+        if pk_field._auto_increment:
+            if new_pk is not None:
+                raise ValueError('The pk for %s is "auto-increment", you must not '
+                                 'fill it' % cls.__name__)
+            new_pk = connection.incr(cls.make_key(cls._name, 'max_pk'))
+        elif new_pk is None:
+            raise ValueError('The pk for %s is not "auto-increment", you must '
+                             'fill it' % cls.__name__)
+        new_pk = pk_field.normalize(new_pk)
+        if not connection.sadd(pk_field.collection_key, new_pk):
+            raise UniquenessError('PKField %s already exists for model %s'
+                                  % (new_pk, cls.__name__))
+        new_instance = cls.lazy_connect(new_pk)
+        new_instance._connected = True
+
+        # list the keys to copy, and the fields to index
+        keys, to_index, versions = [], [], []
+        instancehash_copied = False
+        for field in fields:
+            if isinstance(field, DynamicFieldMixin):
+                if field.dynamic_version_of is not None:
+                    continue  # versions are found via the inventory
+                new_field = new_instance.get_field(field.name)
+                for dynamic_part in field._inventory.scan_versions():
+                    version, new_version = field.get_for(dynamic_part), new_field.get_for(dynamic_part)
+                    if not isinstance(field, limpyd_fields.InstanceHashField):
+                        keys.extend(zip(version._version_keys(), new_version._version_keys()))
+                    versions.append(new_version)
+                    if new_version.indexable:
+                        to_index.append(new_version)
+                field = new_field
+            else:
+                field = new_instance.get_field(field.name)
+                if field.indexable:
+                    to_index.append(field)
+                if not isinstance(field, limpyd_fields.InstanceHashField):
+                    keys.append((self.get_field(field.name).key, field.key))
+            if isinstance(field, limpyd_fields.InstanceHashField) and not instancehash_copied:
+                keys.append((self.key, new_instance.key))
+                instancehash_copied = True
+
+        # copy the keys
+        for start in range(0, len(keys), chunk_size):
+            cls.database.call_script(
+                # be sure to use the script dict at the class level
+                # to avoid registering it many times
+                script_dict=ModelWithDynamicFieldMixin.clone_keys_script,
+                keys=[key for pair in keys[start:start + chunk_size] for key in pair],
+            )
+
+        # index the values and fill the inventories, keeping the expiry times
+        # of the versions copied with their keys
+        with_ttl = [version for version in versions if version._ttl]
+        with cls.database.pipeline(transaction=False) as pipeline:
+            for field in to_index:
+                field.proxy_get()
+            for version in with_ttl:
+                for key in version._version_keys():
+                    pipeline.pttl(key)
+            results = pipeline.execute()
+            now = time()
+        values, pttls = results[:len(to_index)], iter(results[len(to_index):])
+        expire_at, expired = {}, set()
+        for version in with_ttl:
+            pttl = max([next(pttls) for key in version._version_keys()])
+            if pttl == -2:
+                expired.add(version.name)  # in the meantime
+            elif pttl > 0:
+                expire_at[version.name] = now + pttl / 1000.0
+        with pipelined(cls.database):
+            for field, value in zip(to_index, values):
+                if value:
+                    field.index(value)
+            for version in versions:
+                if version.name in expired:
+                    continue
+                version._track_version(expire_at.get(version.name))
+                if version._filter_cache_ttl:
+                    version._invalidate_filter_cache()
+        for field in to_index:
+            field._reset_indexes_rollback_caches(new_pk)
+
+        return new_instance
+
     @classmethod
     def get_field_name_for(cls, field_name, dynamic_part):
         """
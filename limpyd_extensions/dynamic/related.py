@@ -2,8 +2,11 @@
 from __future__ import unicode_literals
 from future.builtins import object
 
-from limpyd.contrib.related import re_identifier
+from limpyd.contrib.related import MultiValuesRelatedFieldMixin, RelatedFieldMixin
+from limpyd.exceptions import ImplementationError
+from limpyd.indexes import EqualIndex
 
+from ..batch import batch
 from ..related import (FKStringField, FKInstanceHashField,
                        M2MSetField, M2MListField, M2MSortedSetField,
                        RelatedCollectionForString, RelatedCollectionForInstanceHash,
@@ -12,14 +15,61 @@ from ..related import (FKStringField, FKInstanceHashField,
 from .fields import DynamicFieldMixin
 
 
+class DynamicRelatedEqualIndex(EqualIndex):
+    """
+    The default index of dynamic related fields. For the dynamic versions, it
+    also keeps, for each related instance, a set with the dynamic parts of the
+    versions linking instances to it, to find its reverse relations without
+    scanning the keys.
+    """
+
+    # remove the pk from the index, and the dynamic part from the set of the
+    # related instance if no instance is linked to it via this version anymore
+    remove_script = {
+        'lua': """
+            redis.call('srem', KEYS[1], ARGV[1])
+            if redis.call('scard', KEYS[1]) == 0 then
+                redis.call('srem', KEYS[2], ARGV[2])
+            end
+        """,
+    }
+
+    def add(self, pk, *args, **kwargs):
+        super(DynamicRelatedEqualIndex, self).add(pk, *args, **kwargs)
+        if self.field.dynamic_version_of is not None:
+            self.connection.sadd(self.field._parts_key(self.normalize_value(args[-1])),
+                                 self.field.dynamic_part)
+
+    def remove(self, pk, *args, **kwargs):
+        if self.field.dynamic_version_of is None:
+            return super(DynamicRelatedEqualIndex, self).remove(pk, *args, **kwargs)
+        self.field.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=DynamicRelatedEqualIndex.remove_script,
+            keys=[self.get_storage_key(*args),
+                  self.field._parts_key(self.normalize_value(args[-1]))],
+            args=[pk, self.field.dynamic_part],
+        )
+        self._get_rollback_cache(pk)['deindexed_values'].add(tuple(args))
+
+
 class RelatedCollectionMixinForDynamicField(object):
+    """
+    The only related collection for all the dynamic versions of a dynamic
+    related field, taking the dynamic part as first argument of its methods.
+    """
 
     def __call__(self, dynamic_part, **filters):
         """
         Return a collection on the related model, given the current instance as
         a filter for the related field. Take the dyanmic part of the dynamic
-        field to consider as a first argument.
+        field to consider as a first argument. If it's a list (or tuple, or
+        set), it's the same as calling `for_any`.
         """
+        if isinstance(dynamic_part, (list, tuple, set)):
+            return self.for_any(dynamic_part, **filters)
+
         dynamic_field_name = self.related_field.get_name_for(dynamic_part)
 
         if not filters:
@@ -29,6 +79,85 @@ class RelatedCollectionMixinForDynamicField(object):
 
         return self.related_field._model.collection(**filters)
 
+    def for_all(self, dynamic_parts, **filters):
+        """
+        Return a collection on the related model, with the instances linked to
+        the current one via all the dynamic versions for the given dynamic
+        parts (redis does the intersection of their indexes when the
+        collection is fetched).
+        """
+        if not dynamic_parts:
+            raise ValueError('At least one dynamic part is needed')
+        for dynamic_part in dynamic_parts:
+            filters[self.related_field.get_name_for(dynamic_part)] = self.instance._pk
+        return self.related_field._model.collection(**filters)
+
+    def for_any(self, dynamic_parts, **filters):
+        """
+        Return a collection on the related model, with the instances linked to
+        the current one via any of the dynamic versions for the given dynamic
+        parts (redis does the union of their indexes, with `intersect_union`,
+        when the collection is fetched).
+        """
+        if not dynamic_parts:
+            raise ValueError('At least one dynamic part is needed')
+        keys = [self._dynamic_reverse_index_key(dynamic_part) for dynamic_part in dynamic_parts]
+        return self.related_field._model.collection(**filters).intersect_union(*keys)
+
+    def _reverse_relations(self):
+        """
+        Yield, for each dynamic version of the related field linking instances
+        to the current one, a tuple with this version and the key of its
+        reverse index for the current instance. The dynamic parts of these
+        versions are read with SSCAN from the set kept by their index for the
+        current instance (see `DynamicRelatedEqualIndex`).
+        """
+        base_field = self.related_field
+        parts_key = base_field._parts_key(self.instance._pk)
+        # read all before yielding, as the set is updated when relations are removed
+        for dynamic_part in list(base_field.connection.sscan_iter(parts_key)):
+            related_field = base_field._model.get_field(base_field.get_name_for(dynamic_part))
+            yield related_field, self._reverse_index_key(related_field)
+
+    def _dynamic_reverse_index_key(self, dynamic_part):
+        """
+        Return the key of the reverse index of the dynamic version of the
+        related field for the given dynamic part.
+        """
+        related_field = self.related_field._model.get_field(
+            self.related_field.get_name_for(dynamic_part))
+        return self._reverse_index_key(related_field)
+
+    def count(self, dynamic_part):
+        """
+        Return the number of related instances linked to the current instance
+        via the dynamic version of the field for the given dynamic part.
+        """
+        return self.related_field.connection.scard(
+            self._dynamic_reverse_index_key(dynamic_part))
+
+    def scan(self, dynamic_part, cursor=0, count=None):
+        """
+        Same as `scan` on non-dynamic related collections, for the given
+        dynamic part.
+        """
+        return self._scan(self._dynamic_reverse_index_key(dynamic_part), cursor, count)
+
+    def iter_pks(self, dynamic_part, cursor=0, count=None):
+        """
+        Same as `iter_pks` on non-dynamic related collections, for the given
+        dynamic part.
+        """
+        return self._iter_pks(self._dynamic_reverse_index_key(dynamic_part), cursor, count)
+
+    def iter_instances(self, dynamic_part, cursor=0, count=None):
+        """
+        Same as `iter_instances` on non-dynamic related collections, for the
+        given dynamic part.
+        """
+        for pk in self.iter_pks(dynamic_part, cursor, count):
+            yield self.related_field._model.lazy_connect(pk)
+
 
 class RelatedCollectionForDynamicString(RelatedCollectionMixinForDynamicField, RelatedCollectionForString):
     pass
@@ -52,17 +181,77 @@ class RelatedCollectionForDynamicSortedSet(RelatedCollectionMixinForDynamicField
 
 class DynamicRelatedFieldMixin(DynamicFieldMixin):
     """
-    As the related name must be unique for a relation between two objects, we
-    have to make a fake one for this dynamic field, based on its dynamic name.
+    Only the main version of a dynamic related field registers a relation (and
+    so a related collection on the related model): all dynamic versions share
+    it, the dynamic part being passed to the methods of the related collection.
     """
-    def _get_related_name(self):
-        if self.dynamic_version_of is not None:
-            self.related_name = '%s__%s__%s' % (
-                self.dynamic_version_of.related_name,
-                re_identifier.sub('_', self.dynamic_part),
-                id(self)
-            )
-        return super(DynamicRelatedFieldMixin, self)._get_related_name()
+
+    # command used by `bulk_set` to write the value(s) of each dynamic version
+    bulk_command = None
+
+    def __init__(self, *args, **kwargs):
+        """
+        Use `DynamicRelatedEqualIndex` as index if none is given, or instead of
+        `EqualIndex`, as it is needed to find the reverse relations. Other index
+        classes are refused (subclasses of `DynamicRelatedEqualIndex` apart).
+        """
+        index_classes = []
+        for index_class in kwargs.get('indexes') or [DynamicRelatedEqualIndex]:
+            if index_class is EqualIndex:
+                index_class = DynamicRelatedEqualIndex
+            elif not issubclass(index_class, DynamicRelatedEqualIndex):
+                raise ImplementationError('Dynamic related fields can only use '
+                                          '"DynamicRelatedEqualIndex" (or a subclass) as index')
+            index_classes.append(index_class)
+        kwargs['indexes'] = index_classes
+        super(DynamicRelatedFieldMixin, self).__init__(*args, **kwargs)
+
+    def _attach_to_model(self, model):
+        """
+        For dynamic versions, skip the registration of the relation done by
+        RelatedFieldMixin, and use the related model and name of the main
+        version.
+        """
+        if self.dynamic_version_of is None:
+            return super(DynamicRelatedFieldMixin, self)._attach_to_model(model)
+        super(RelatedFieldMixin, self)._attach_to_model(model)
+        self.related_name = self.dynamic_version_of.related_name
+        self.related_to = self.dynamic_version_of.related_to
+
+    def _after_unlink(self):
+        """
+        Called on a dynamic version after the removal of a related instance
+        being deleted (see `_unlink`), in the same pipeline: invalidate the
+        caches as any write does, and, for foreign keys, whose version is then
+        deleted, remove it from the inventory.
+        """
+        if self.dynamic_version_of is None:
+            return
+        self._invalidate_cache()
+        if self._filter_cache_ttl:
+            self._invalidate_filter_cache()
+        if not isinstance(self, MultiValuesRelatedFieldMixin):
+            self._untrack_version()
+
+    def _parts_key(self, related_pk):
+        """
+        Return the key of the set holding the dynamic parts of the versions
+        linking instances to the related instance with the given pk.
+        """
+        return self.make_key(self._model._name, self._base_field().name, 'parts', related_pk)
+
+    def rebuild_parts(self, chunk_size=1000, processes=None, progress=None, resume=False):
+        """
+        Fill the sets holding, for each related instance, the dynamic parts of
+        the versions linking instances to it (see `DynamicRelatedEqualIndex`),
+        for data written before they existed or with another index: without
+        them, deleting a related instance would leave its pk in these versions.
+        It's done by indexing again all the dynamic versions, with the same
+        arguments as `reindex_dynamic_versions`. Return the number of instances
+        done.
+        """
+        return self.reindex_dynamic_versions(chunk_size=chunk_size, processes=processes,
+                                             progress=progress, resume=resume)
 
     def get_name_for(self, dynamic_part):
         """
@@ -72,22 +261,48 @@ class DynamicRelatedFieldMixin(DynamicFieldMixin):
         dynamic_part = self.from_python(dynamic_part)
         return super(DynamicRelatedFieldMixin, self).get_name_for(dynamic_part)
 
+    def bulk_set(self, values_by_part):
+        """
+        Write, for each dynamic part (or instance) of the given dict, its
+        value(s) in the matching dynamic version: the pk (or instance) to set
+        for foreign keys, the list of pks (or instances) to add for M2M fields
+        (a dict with scores for sorted sets).
+        All the writes, with the indexes and inventory entries, are sent in one
+        transaction, using a batch.
+        """
+        if not hasattr(self, '_instance') or self.dynamic_version_of is not None:
+            raise ImplementationError('"bulk_set" can only be used on the base '
+                                      'field bound to an instance')
+        with batch():
+            for dynamic_part, values in values_by_part.items():
+                field = self.get_for(dynamic_part)
+                command = getattr(field, self.bulk_command)
+                if isinstance(values, dict) or not isinstance(field, MultiValuesRelatedFieldMixin):
+                    command(values)
+                else:
+                    command(*values)
+
 
 class DynamicFKStringField(DynamicRelatedFieldMixin, FKStringField):
     related_collection_class = RelatedCollectionForDynamicString
+    bulk_command = 'set'
 
 
 class DynamicFKInstanceHashField(DynamicRelatedFieldMixin, FKInstanceHashField):
     related_collection_class = RelatedCollectionForDynamicInstanceHash
+    bulk_command = 'hset'
 
 
 class DynamicM2MSetField(DynamicRelatedFieldMixin, M2MSetField):
     related_collection_class = RelatedCollectionForDynamicSet
+    bulk_command = 'sadd'
 
 
 class DynamicM2MListField(DynamicRelatedFieldMixin, M2MListField):
     related_collection_class = RelatedCollectionForDynamicList
+    bulk_command = 'rpush'
 
 
 class DynamicM2MSortedSetField(DynamicRelatedFieldMixin, M2MSortedSetField):
     related_collection_class = RelatedCollectionForDynamicSortedSet
+    bulk_command = 'zadd'
@@ -1,33 +1,247 @@
 # -*- coding:utf-8 -*-
 from __future__ import unicode_literals
-from future.builtins import zip
+from future.builtins import object, zip
 
+from contextlib import contextmanager
+import threading
+from time import sleep as time_sleep
 
+from redis.exceptions import WatchError
 
 from limpyd import model, fields
-# RelatedModel imported to let users import limpyd_extensions.related with
+from limpyd.collection import CollectionManager
+from limpyd.contrib.related import MultiValuesRelatedFieldMixin, RelatedFieldMixin
+from limpyd.indexes import EqualIndex
+from limpyd.exceptions import DoesNotExist, ImplementationError, LimpydException
+from limpyd.utils import make_key, normalize, unique_key
+# RelatedModel redefined to let users import limpyd_extensions.related with
 # all stuff existing or redefined from limpyd.contrib.related
-from limpyd.contrib.related import (RelatedCollection, RelatedModel,
+from limpyd.contrib.related import (RelatedCollection, RelatedModel as BaseRelatedModel,
                                     FKStringField as BaseFKStringField,
                                     FKInstanceHashField as BaseFKInstanceHashField,
                                     M2MSetField as BaseM2MSetField,
                                     M2MListField as BaseM2MListField,
                                     M2MSortedSetField as BaseM2MSortedSetFiel)
 
+from .batch import BatchableFieldMixin, batch
+from .utils import pipelined
+
+
+class ProtectedError(LimpydException):
+    """
+    Raised when deleting an instance referenced by a related field declared
+    with `on_delete='protect'`.
+    """
+    pass
+
+
+class TraversalLimitExceeded(LimpydException):
+    """
+    Raised when a level of a `RelatedTraversal` has more pks than its
+    `max_pks` limit.
+    """
+    pass
+
+
+_local = threading.local()
+
+
+class _Deletion(object):
+    """
+    The state of the deletion of an instance running in the current thread,
+    with the ones deleted in cascade: the pks of the instances being deleted,
+    by model name, and the (model name, pk) of the instances already checked
+    by `_check_protected`.
+    """
+
+    def __init__(self):
+        self.deleting = {}
+        self.checked = set()
+
+    def add(self, model_name, pk):
+        self.deleting.setdefault(model_name, set()).add(normalize(pk))
+
+    def is_deleting(self, model_name, pk):
+        return normalize(pk) in self.deleting.get(model_name, ())
+
+
+@contextmanager
+def _deletion():
+    """
+    A context manager yielding the `_Deletion` running in the current thread,
+    created by the outermost call.
+    """
+    existing = getattr(_local, 'deletion', None)
+    if existing is not None:
+        yield existing
+        return
+
+    current = _local.deletion = _Deletion()
+    try:
+        yield current
+    finally:
+        _local.deletion = None
+
+
+def _check_protected(instance, checked):
+    """
+    Raise a ProtectedError if the given instance, or one that would be deleted
+    in cascade, is referenced by a related field declared with
+    `on_delete='protect'`. The (model name, pk) of the instances checked are
+    added to `checked`.
+    """
+    checked.add((instance._name, instance._pk))
+    for name in instance.related_collections:
+        collection = getattr(instance, name)
+        on_delete = getattr(collection.related_field, 'on_delete', None)
+        if on_delete not in ('protect', 'cascade'):
+            continue
+        for related_field, key in collection._reverse_relations():
+            if on_delete == 'protect':
+                if related_field.connection.scard(key):
+                    raise ProtectedError('Cannot delete %s "%s": referenced by %s.%s' % (
+                        instance.__class__.__name__, instance._pk,
+                        related_field._model.__name__, related_field.name))
+                continue
+            related_model = related_field._model
+            for pk in collection._iter_pks(key, 0, collection.remove_chunk_size):
+                if (related_model._name, pk) not in checked:
+                    _check_protected(related_model.lazy_connect(pk), checked)
+
+
+def _delete_instances(model, pks, deletion):
+    """
+    Delete the instances of `model` with the given pks, as `delete` does, but
+    for all of them at once: their existence is checked in one pipeline, they
+    are marked as being deleted in `deletion`, then their related collections
+    apply their `on_delete` policies, and their fields are deleted, reading
+    the values to deindex in one pipeline and deleting them in another one
+    (fields with their own deletion, like dynamic fields, apart).
+    Instances of models with their own `delete` are deleted one by one.
+    """
+    collection_key = model.get_field('pk').collection_key
+    database = model.database
+    pipe = database.connection.pipeline(transaction=False)
+    for pk in pks:
+        pipe.sismember(collection_key, pk)
+    pks = [pk for pk, exists in zip(pks, pipe.execute()) if exists]
+    if not pks:
+        return
+
+    instances = []
+    for pk in pks:
+        deletion.add(model._name, pk)
+        instance = model.lazy_connect(pk)
+        instance._connected = True
+        instances.append(instance)
+
+    if model.delete not in (RelatedModel.delete, BaseRelatedModel.delete):
+        for instance in instances:
+            instance.delete()
+        return
+
+    for instance in instances:
+        for name in instance.related_collections:
+            getattr(instance, name).remove_instance()
+
+    names, other_names = [], []
+    for name in model._fields:
+        field = model.get_field(name)
+        if isinstance(field, fields.PKField):
+            continue
+        if type(field).delete in (fields.RedisField.delete, fields.InstanceHashField.delete):
+            names.append(name)
+        else:
+            other_names.append(name)
+    for instance in instances:
+        for name in other_names:
+            instance.get_field(name).delete()
+
+    locks = [fields.FieldLock(model.get_field(name)) for name in names
+             if model.get_field(name).indexable]
+    instance_fields = [instance.get_field(name) for instance in instances for name in names]
+    indexed_fields = [field for field in instance_fields if field.indexable]
+    for lock in locks:
+        lock.acquire()
+    try:
+        with database.pipeline(transaction=False) as pipeline:
+            for field in indexed_fields:
+                field.proxy_get()
+            values = pipeline.execute()
+        with pipelined(database):
+            for field, value in zip(indexed_fields, values):
+                if value is not None:
+                    field.deindex(value)
+            for field in instance_fields:
+                # only the entry of the field in the hash of an instance hash field
+                field._traverse_command('hdel' if isinstance(field, fields.InstanceHashField) else 'delete')
+            database.connection.srem(collection_key, *pks)
+    finally:
+        for field in indexed_fields:
+            field._reset_indexes_rollback_caches(field._instance._pk)
+        for lock in reversed(locks):
+            lock.release()
+
+
+class RelatedModel(BaseRelatedModel):
+    """
+    The same as `RelatedModel` from `limpyd.contrib.related`, but when an
+    instance is deleted, the `on_delete='protect'` policies of all its related
+    collections (and of the ones of the instances that would be deleted in
+    cascade) are checked before any change.
+    """
+
+    abstract = True
+
+    def delete(self):
+        with _deletion() as deletion:
+            deletion.add(self._name, self._pk)
+            if (self._name, self._pk) not in deletion.checked:
+                _check_protected(self, deletion.checked)
+            return super(RelatedModel, self).delete()
+
 
 class _RelatedCollectionWithMethods(RelatedCollection):
 
+    # number of related instances updated in one pipeline on deletion
+    remove_chunk_size = 1000
+
+    def _to_instances(self, *values):
+        """
+        Take a list of values, which must be instances or primary keys of the
+        model linked to the related collection, and return a list of
+        instances, created with `lazy_connect`: the existence of the ones given
+        by primary key is checked with only one pipeline, raising DoesNotExist
+        if one is missing.
+        """
+        related_model = self.related_field._model
+        pks = [value for value in values if not isinstance(value, model.RedisModel)]
+        if pks:
+            collection_key = related_model.get_field('pk').collection_key
+            pipe = related_model.get_connection().pipeline(transaction=False)
+            for pk in pks:
+                pipe.sismember(collection_key, pk)
+            for pk, exists in zip(pks, pipe.execute()):
+                if not exists:
+                    raise DoesNotExist("No %s found with pk %s" % (related_model.__name__, pk))
+
+        instances = []
+        for value in values:
+            if not isinstance(value, model.RedisModel):
+                value = related_model.lazy_connect(value)
+                # already checked, to avoid a new check on the first access
+                value._connected = True
+            instances.append(value)
+        return instances
+
     def _to_fields(self, *values):
         """
-        Take a list of values, which must be primary keys of the model linked
-        to the related collection, and return a list of related fields.
+        Take a list of values, which must be instances or primary keys of the
+        model linked to the related collection, and return a list of related
+        fields.
         """
-        result = []
-        for related_instance in values:
-            if not isinstance(related_instance, model.RedisModel):
-                related_instance = self.related_field._model(related_instance)
-            result.append(getattr(related_instance, self.related_field.name))
-        return result
+        return [getattr(related_instance, self.related_field.name)
+                for related_instance in self._to_instances(*values)]
 
     def _reverse_call(self, related_method, *values):
         """
@@ -44,6 +258,203 @@ class _RelatedCollectionWithMethods(RelatedCollection):
             else:
                 getattr(related_field, related_method)(self.instance._pk)
 
+    def _to_pks(self, *values):
+        """
+        Take a list of related instances or primary keys, and return the list
+        of their primary keys, normalized as returned by redis.
+        """
+        return [normalize(value._pk if isinstance(value, model.RedisModel) else value)
+                for value in values]
+
+    def _reverse_index_key(self, related_field=None):
+        """
+        Return the key of the set holding the pks of the related instances
+        linked to self.instance: the one of the equal index of the related
+        field (or the given one) for this value.
+        """
+        related_field = related_field or self.related_field
+        index = related_field.get_index(index_class=EqualIndex)
+        return index.get_storage_key(self.instance._pk)
+
+    def count(self):
+        """
+        Return the number of related instances linked to self.instance, in
+        O(1), with a SCARD on the reverse index, updated with each change of
+        the relations, done from any side.
+        """
+        return self.related_field.connection.scard(self._reverse_index_key())
+
+    def scan(self, cursor=0, count=None):
+        """
+        Return a page of the pks of the related instances linked to
+        self.instance, read with a SSCAN on the reverse index, as a tuple with
+        the cursor to pass to get the next page (0 when done), and the pks.
+        """
+        return self._scan(self._reverse_index_key(), cursor, count)
+
+    def iter_pks(self, cursor=0, count=None):
+        """
+        Iterate on the pks of the related instances linked to self.instance, in
+        constant memory, reading them page by page (see `scan`).
+        """
+        return self._iter_pks(self._reverse_index_key(), cursor, count)
+
+    def iter_instances(self, cursor=0, count=None):
+        """
+        Same as `iter_pks`, but yielding instances, not checked for existence.
+        """
+        for pk in self.iter_pks(cursor, count):
+            yield self.related_field._model.lazy_connect(pk)
+
+    def _reverse_relations(self):
+        """
+        Yield, for each related field linking instances to self.instance (only
+        self.related_field here), a tuple with this field and the key of its
+        reverse index for self.instance.
+        """
+        yield self.related_field, self._reverse_index_key()
+
+    def remove_instance(self):
+        """
+        Called when self.instance is deleted, to apply the `on_delete` policy
+        of the related field to the related instances, read by chunks from the
+        reverse index: remove self.instance from their related field with one
+        pipeline by chunk ("set_null", the default), delete them ("cascade"),
+        or refuse the deletion if there are some ("protect", checked by
+        `RelatedModel.delete` for all the related collections of self.instance
+        before any change, else here).
+        """
+        with _deletion() as deletion:
+            deletion.add(self.instance._name, self.instance._pk)
+            if (self.instance._name, self.instance._pk) not in deletion.checked:
+                _check_protected(self.instance, deletion.checked)
+            for related_field, key in self._reverse_relations():
+                with fields.FieldLock(related_field):
+                    if related_field.on_delete == 'cascade':
+                        self._cascade_delete(related_field, key, deletion)
+                    else:
+                        self._unlink_all(related_field, key)
+
+    def _iter_reverse_chunks(self, key):
+        """
+        Iterate on the pks of the related instances by chunks, with SSCAN on
+        the given reverse index (SSCAN returns all the entries that are present
+        from the start to the end of the iteration, so it's safe to remove the
+        ones returned).
+        """
+        cursor = 0
+        while True:
+            cursor, pks = self._scan(key, cursor, self.remove_chunk_size)
+            if pks:
+                yield pks
+            if not cursor:
+                break
+
+    def _unlink_all(self, related_field, key):
+        """
+        Remove self.instance from the given related field of all the related
+        instances, and from the indexes, without reading anything, with one
+        pipeline by chunk (`_after_unlink` is called for each field, in the
+        same pipeline).
+        """
+        value = self.instance._pk
+        for pks in self._iter_reverse_chunks(key):
+            instance_fields = [related_field._model.lazy_connect(pk).get_field(related_field.name)
+                               for pk in pks]
+            try:
+                with pipelined(related_field.database):
+                    for instance_field in instance_fields:
+                        instance_field._deindex([value])
+                        instance_field._unlink(value)
+                        instance_field._after_unlink()
+            finally:
+                for instance_field in instance_fields:
+                    instance_field._reset_indexes_rollback_caches(instance_field._instance._pk)
+
+    def _cascade_delete(self, related_field, key, deletion):
+        """
+        Delete all the related instances (applying their own `on_delete`
+        policies), by chunks (see `_delete_instances`), skipping the ones
+        already being deleted, so a cycle of cascades stops.
+        """
+        related_model = related_field._model
+        for pks in self._iter_reverse_chunks(key):
+            pks = [pk for pk in pks if not deletion.is_deleting(related_model._name, pk)]
+            if pks:
+                _delete_instances(related_model, pks, deletion)
+
+    def _scan(self, key, cursor, count):
+        cursor, pks = self.related_field.connection.sscan(key, cursor, count=count)
+        return int(cursor), pks
+
+    def _iter_pks(self, key, cursor, count):
+        while True:
+            cursor, pks = self._scan(key, cursor, count)
+            for pk in pks:
+                yield pk
+            if not cursor:
+                break
+
+    def _diff(self, values):
+        """
+        Return the pks of the given related instances (or pks) not yet linked
+        to self.instance, and the pks of the ones linked but not in the given
+        values, both computed by redis with SDIFF against the reverse index.
+        """
+        pks = set(self._to_pks(*values))
+        reverse_key = self._reverse_index_key()
+        connection = self.related_field.connection
+        if not pks:
+            return set(), connection.smembers(reverse_key)
+        index = self.related_field.get_index(index_class=EqualIndex)
+        tmp_key = index._unique_key('tmp')
+        pipe = connection.pipeline(transaction=False)
+        pipe.sadd(tmp_key, *pks)
+        pipe.sdiff(tmp_key, reverse_key)
+        pipe.sdiff(reverse_key, tmp_key)
+        pipe.delete(tmp_key)
+        __, to_add, to_remove, __ = pipe.execute()
+        return to_add, to_remove
+
+    def _add_values(self, values):
+        raise NotImplementedError
+
+    def _remove_values(self, values):
+        raise NotImplementedError
+
+    def set_to(self, *values):
+        """
+        Make the related instances linked to self.instance be exactly the given
+        ones (instances or primary keys of the related model): the differences
+        with the current ones are computed by redis, and only the needed
+        changes are applied, in a batch (see `limpyd_extensions.batch`).
+        Return the pks of the added and removed related instances.
+        """
+        return self._apply_diff(values)
+
+    def _apply_diff(self, values, **add_kwargs):
+        """
+        Compute the differences between the given values and the related
+        instances currently linked, and apply them in a batch, passing the
+        `add_kwargs` to `_add_values` for the ones to add.
+        """
+        to_add, to_remove = self._diff(values)
+        # check the existence of all the instances to add at once
+        pks = list(to_add)
+        instances = dict(zip(pks, self._to_instances(*pks)))
+        # the ones to remove are not checked: they may have been deleted
+        # outside limpyd, and must still be unlinked
+        related_model = self.related_field._model
+        for pk in to_remove:
+            instances[pk] = related_model.lazy_connect(pk)
+            instances[pk]._connected = True
+        with batch():
+            if to_remove:
+                self._remove_values([instances[pk] for pk in to_remove])
+            if to_add:
+                self._add_values([instances[pk] for pk in to_add], **add_kwargs)
+        return to_add, to_remove
+
 
 class _RelatedCollectionForFK(_RelatedCollectionWithMethods):
     _set_method = None
@@ -62,6 +473,12 @@ class _RelatedCollectionForFK(_RelatedCollectionWithMethods):
         """
         self._reverse_call(lambda related_field, value: related_field.delete(), *values)
 
+    def _add_values(self, values):
+        self.sadd(*values)
+
+    def _remove_values(self, values):
+        self.srem(*values)
+
 
 class RelatedCollectionForString(_RelatedCollectionForFK):
     """
@@ -99,6 +516,12 @@ class RelatedCollectionForSet(_RelatedCollectionWithMethods):
         """
         self._reverse_call('srem', *values)
 
+    def _add_values(self, values):
+        self.sadd(*values)
+
+    def _remove_values(self, values):
+        self.srem(*values)
+
 
 class RelatedCollectionForList(_RelatedCollectionWithMethods):
     """
@@ -129,6 +552,12 @@ class RelatedCollectionForList(_RelatedCollectionWithMethods):
         """
         self._reverse_call(lambda related_field, value: related_field.lrem(0, value), *values)
 
+    def _add_values(self, values):
+        self.rpush(*values)
+
+    def _remove_values(self, values):
+        self.lrem(*values)
+
 
 class RelatedCollectionForSortedSet(_RelatedCollectionWithMethods):
     """
@@ -158,22 +587,585 @@ class RelatedCollectionForSortedSet(_RelatedCollectionWithMethods):
         """
         self._reverse_call('zrem', *values)
 
+    def set_to(self, *args, **kwargs):
+        """
+        Same as `set_to` for the other related collections, but taking the
+        same arguments as `zadd`: the scores are used for the related instances
+        to add. The ones already linked keep their scores.
+        """
+        mapping = fields.SortedSetField.coerce_zadd_args(*args, **kwargs)[1]['mapping']
+        scores = dict(zip(self._to_pks(*mapping.keys()), mapping.values()))
+        return self._apply_diff(scores, scores=scores)
+
+    def _add_values(self, values, scores=None):
+        """
+        Add the given related instances, with their score taken from the
+        `scores` dict (by pk), or 0 if not found.
+        """
+        scores = scores or {}
+        self.zadd({instance: scores.get(instance._pk, 0) for instance in values})
+
+    def _remove_values(self, values):
+        self.zrem(*values)
+
+
+class _OnDeleteFieldMixin(object):
+    """
+    A mixin for related fields, handling the "on_delete" argument, telling what
+    to do with the instances having the field pointing to an instance being
+    deleted: "set_null" (the default) to simply remove it from the field,
+    "cascade" to delete them, and "protect" to refuse the deletion.
+    """
+
+    on_delete_policies = ('set_null', 'cascade', 'protect')
+
+    def __init__(self, *args, **kwargs):
+        self.on_delete = kwargs.pop('on_delete', 'set_null')
+        if self.on_delete not in self.on_delete_policies:
+            raise ImplementationError('Invalid on_delete "%s" for a related field' % self.on_delete)
+        super(_OnDeleteFieldMixin, self).__init__(*args, **kwargs)
+
+    def __copy__(self):
+        new_copy = super(_OnDeleteFieldMixin, self).__copy__()
+        new_copy.on_delete = self.on_delete
+        return new_copy
+
+    def _unlink(self, value):
+        """
+        Remove the given value from the field, without updating indexes.
+        """
+        raise NotImplementedError
+
+    def _after_unlink(self):
+        """
+        Called after `_unlink`, in the same pipeline, to update what depends on
+        the value of the field. Nothing to do here.
+        """
+        pass
 
-class FKStringField(BaseFKStringField):
+    def _unlink_if_unchanged(self, values):
+        """
+        For foreign keys: unlink the value of the field, and deindex it, only if
+        it's still the one in `values` (a set with the value read before),
+        checked under WATCH in a transaction (starting again if the field is
+        updated in the meantime). Return the number of removed references.
+        """
+        value = normalize(list(values)[0])
+        try:
+            with self.database.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        pipe.watch(self.key)
+                        if normalize(self.proxy_get()) != value:
+                            return 0
+                        pipe.multi()
+                        self._deindex([value])
+                        self._unlink(value)
+                        self._after_unlink()
+                        pipe.execute()
+                        return 1
+                    except WatchError:
+                        continue
+        finally:
+            self._reset_indexes_rollback_caches(self._instance._pk)
+
+
+class FKStringField(BatchableFieldMixin, _OnDeleteFieldMixin, BaseFKStringField):
     related_collection_class = RelatedCollectionForString
+    traversal_kind = 'string'
+
+    def _prefetch(self, pipe):
+        pipe.get(self.key)
 
+    def _remove_dangling(self, values):
+        return self._unlink_if_unchanged(values)
 
-class FKInstanceHashField(BaseFKInstanceHashField):
+    def _unlink(self, value):
+        self.connection.delete(self.key)
+
+
+class FKInstanceHashField(BatchableFieldMixin, _OnDeleteFieldMixin, BaseFKInstanceHashField):
     related_collection_class = RelatedCollectionForInstanceHash
+    traversal_kind = 'hash'
+
+    def _prefetch(self, pipe):
+        pipe.hget(self.key, self.name)
 
+    def _remove_dangling(self, values):
+        return self._unlink_if_unchanged(values)
 
-class M2MSetField(BaseM2MSetField):
+    def _unlink(self, value):
+        self.connection.hdel(self.key, self.name)
+
+
+class M2MSetField(BatchableFieldMixin, _OnDeleteFieldMixin, BaseM2MSetField):
     related_collection_class = RelatedCollectionForSet
+    traversal_kind = 'set'
+
+    def _prefetch(self, pipe):
+        pipe.smembers(self.key)
 
+    def _remove_dangling(self, values):
+        self.srem(*values)
+        return len(values)
 
-class M2MListField(BaseM2MListField):
+    def _unlink(self, value):
+        self.connection.srem(self.key, value)
+
+
+class M2MListField(BatchableFieldMixin, _OnDeleteFieldMixin, BaseM2MListField):
     related_collection_class = RelatedCollectionForList
+    traversal_kind = 'list'
+
+    def _prefetch(self, pipe):
+        pipe.lrange(self.key, 0, -1)
+
+    def _remove_dangling(self, values):
+        for value in values:
+            self.lrem(0, value)
+        return len(values)
 
+    def _unlink(self, value):
+        self.connection.lrem(self.key, 0, value)
 
-class M2MSortedSetField(BaseM2MSortedSetFiel):
+
+class M2MSortedSetField(BatchableFieldMixin, _OnDeleteFieldMixin, BaseM2MSortedSetFiel):
     related_collection_class = RelatedCollectionForSortedSet
+    traversal_kind = 'zset'
+
+    def _prefetch(self, pipe):
+        pipe.zrange(self.key, 0, -1)
+
+    def _remove_dangling(self, values):
+        self.zrem(*values)
+        return len(values)
+
+    def _unlink(self, value):
+        self.connection.zrem(self.key, value)
+
+
+def prefetch_related(instances, field_name, fields=None):
+    """
+    Fetch, for all the given instances (a list of instances, or a collection),
+    the related instances linked by the related field `field_name`, with
+    one pipeline reading the field of all instances, and, if `fields` (a list
+    of names of StringField or InstanceHashField of the related model) is
+    given, one more pipeline reading these fields for all related instances
+    (the primary key field can be asked too).
+    Return the list of instances, each one having a `prefetched_related`
+    dict, with, for `field_name`, the related instance (or None) for a
+    foreign key, or the list of related instances for a many-to-many field.
+    Related instances are not checked for existence, and have, if `fields`
+    is given, a `prefetched_values` dict with the values of these fields.
+    """
+    if isinstance(instances, CollectionManager):
+        collection_model = instances.model
+        instances = [instance if isinstance(instance, collection_model)
+                     else collection_model.lazy_connect(instance)
+                     for instance in instances]
+    else:
+        instances = list(instances)
+    if not instances:
+        return instances
+
+    related_fields = [instance.get_field(field_name) for instance in instances]
+    if not isinstance(related_fields[0], RelatedFieldMixin) \
+            or not hasattr(related_fields[0], '_prefetch'):
+        raise ValueError('"%s" is not a related field from limpyd_extensions' % field_name)
+    many = isinstance(related_fields[0], MultiValuesRelatedFieldMixin)
+    related_model = related_fields[0].database._models[related_fields[0].related_to]
+
+    pipe = related_fields[0].connection.pipeline(transaction=False)
+    for related_field in related_fields:
+        related_field._prefetch(pipe)
+    results = pipe.execute()
+
+    related_instances = {}
+
+    def get_related_instance(pk):
+        if pk not in related_instances:
+            related_instances[pk] = related_model.lazy_connect(pk)
+        return related_instances[pk]
+
+    for instance, result in zip(instances, results):
+        if many:
+            related = [get_related_instance(pk) for pk in result]
+        else:
+            related = get_related_instance(result) if result is not None else None
+        if not hasattr(instance, 'prefetched_related'):
+            instance.prefetched_related = {}
+        instance.prefetched_related[field_name] = related
+
+    if fields and related_instances:
+        _prefetch_values(list(related_instances.values()), fields)
+
+    return instances
+
+
+def _prefetch_values(instances, field_names):
+    """
+    Read, in one pipeline, the given single value fields of all the given
+    instances (of the same model), and save them in a `prefetched_values`
+    dict on each instance.
+    """
+    model_class = instances[0].__class__
+    hash_fields, string_fields, pk_fields = [], [], []
+    for name in field_names:
+        field = model_class.get_field(name)
+        if isinstance(field, fields.PKField):
+            pk_fields.append(name)
+        elif isinstance(field, fields.InstanceHashField):
+            hash_fields.append(name)
+        elif isinstance(field, fields.StringField):
+            string_fields.append(name)
+        else:
+            raise ValueError('Only StringField and InstanceHashField can be '
+                             'prefetched ("%s" is not one of them)' % name)
+
+    pipe = model_class.get_connection().pipeline(transaction=False)
+    for instance in instances:
+        if hash_fields:
+            pipe.hmget(instance.get_field(hash_fields[0]).key, *hash_fields)
+        for name in string_fields:
+            pipe.get(instance.get_field(name).key)
+    results = iter(pipe.execute())
+
+    for instance in instances:
+        values = dict(zip(hash_fields, next(results))) if hash_fields else {}
+        for name in string_fields:
+            values[name] = next(results)
+        for name in pk_fields:
+            values[name] = instance._pk
+        instance.prefetched_values = values
+
+
+def collect_dangling_references(model, field_names=None, chunk_size=1000, sleep=0):
+    """
+    Remove from the related fields of all the instances of the given model
+    (only the ones from limpyd_extensions, and only the given ones if
+    `field_names` is set) the references to instances that don't exist anymore
+    (deleted outside of limpyd...), with their index entries.
+    For dynamic related fields, all the dynamic versions listed in the
+    inventory of each instance are checked (one more read by instance).
+    Instances are read by chunks of `chunk_size` with SSCAN on the collection
+    of the model, and for each chunk, one pipeline reads the values of each
+    field, and one more checks the existence of the referenced instances.
+    A foreign key is only removed if it still holds the dangling reference
+    (checked under WATCH), as it may have been set to a valid one since.
+    To limit the load on a server in production, the process sleeps for
+    `sleep` seconds between chunks.
+    Return a dict with the number of removed references for each field (the
+    base field for dynamic versions).
+    """
+    related_fields = [
+        field for field in model.get_class_fields()
+        if isinstance(field, RelatedFieldMixin) and hasattr(field, '_remove_dangling')
+        # dynamic versions are found via the inventories of the base fields
+        and getattr(field, 'dynamic_version_of', None) is None
+        and (field_names is None or field.name in field_names)
+    ]
+    removed = dict((field.name, 0) for field in related_fields)
+    if not related_fields:
+        return removed
+
+    chunk = []
+    for pk in model.get_connection().sscan_iter(model.get_field('pk').collection_key, count=chunk_size):
+        chunk.append(pk)
+        if len(chunk) >= chunk_size:
+            _collect_dangling_references_in_chunk(model, related_fields, chunk, removed)
+            chunk = []
+            if sleep:
+                time_sleep(sleep)
+    if chunk:
+        _collect_dangling_references_in_chunk(model, related_fields, chunk, removed)
+
+    return removed
+
+
+def _collect_dangling_references_in_chunk(model, related_fields, pks, removed):
+    """
+    Remove the dangling references from the given fields of the instances with
+    the given pks, and update the counts in `removed`.
+    """
+    instances = [model.lazy_connect(pk) for pk in pks]
+    connection = model.get_connection()
+
+    for related_field in related_fields:
+        name = related_field.name
+        if hasattr(related_field, 'dynamic_version_of'):
+            instance_fields = []
+            for instance in instances:
+                field = instance.get_field(name)
+                instance_fields.extend(field.get_for(dynamic_part)
+                                       for dynamic_part in field._inventory.scan_versions())
+        else:
+            instance_fields = [instance.get_field(name) for instance in instances]
+        if not instance_fields:
+            continue
+
+        pipe = connection.pipeline(transaction=False)
+        for instance_field in instance_fields:
+            instance_field._prefetch(pipe)
+        if isinstance(related_field, MultiValuesRelatedFieldMixin):
+            values = [set(result) for result in pipe.execute()]
+        else:
+            values = [{result} if result is not None else set() for result in pipe.execute()]
+
+        targets = list(set().union(*values))
+        if not targets:
+            continue
+        related_model = related_field.database._models[related_field.related_to]
+        pipe = related_model.get_connection().pipeline(transaction=False)
+        for target in targets:
+            pipe.sismember(related_model.get_field('pk').collection_key, target)
+        dangling = set(target for target, exists in zip(targets, pipe.execute()) if not exists)
+        if not dangling:
+            continue
+
+        to_remove = [(instance_field, instance_values & dangling)
+                     for instance_field, instance_values in zip(instance_fields, values)
+                     if instance_values & dangling]
+        if isinstance(related_field, MultiValuesRelatedFieldMixin):
+            with batch():
+                for instance_field, instance_values in to_remove:
+                    removed[name] += instance_field._remove_dangling(instance_values)
+        else:
+            # each one in its own transaction, see `_unlink_if_unchanged`
+            for instance_field, instance_values in to_remove:
+                removed[name] += instance_field._remove_dangling(instance_values)
+
+
+class RelatedTraversal(object):
+    """
+    A path of relations, from a model, to follow hop by hop to get the pks of
+    the instances at the end of the path, each level being kept in a
+    temporary set in redis:
+    - a foreign key hop is done by redis only, with a SORT of the current set
+      getting the values of the foreign keys (GET pattern) in a list, then
+      added to the next set by a lua script
+    - for the other hops (many-to-many fields and related names), the keys of
+      the relations cannot be computed by redis, so the pks of the current
+      level are read with SSCAN by chunks of `chunk_size`, and the relations
+      of each chunk are added to the next set by SUNIONSTORE (or the lua
+      script for lists and sorted sets)
+    If a level has more than `max_pks` pks, the traversal is aborted.
+    Each step of the path is the name of a related field on the current model
+    (from limpyd_extensions), or a related name (the reverse side of a related
+    field). Example, for "tags of the posts of the users I follow":
+
+        RelatedTraversal(User, 'following', 'posts', 'tags').pks(me)
+
+    The resulting model is available in the `model` attribute.
+    """
+
+    # a value, unlikely to be in keys, used to compute the keys templates
+    _pk_placeholder = '__limpyd_traversal_pk__'
+
+    # maximum number of pks in a level of the path, above which the traversal
+    # is aborted with TraversalLimitExceeded (None for no limit)
+    max_pks = 100000
+
+    # number of pks of a level read at once to follow many-to-many relations
+    chunk_size = 1000
+
+    # add to the set KEYS[1] the members of the lists (ARGV[1] = "list") or
+    # sorted sets (ARGV[1] = "zset") KEYS[2...], ignoring empty strings (nil
+    # values got by SORT), and return the cardinality of the set
+    union_script = {
+        'lua': """
+            local dest = KEYS[1]
+            for i = 2, #KEYS do
+                local values
+                if ARGV[1] == 'list' then
+                    values = redis.call('lrange', KEYS[i], 0, -1)
+                else
+                    values = redis.call('zrange', KEYS[i], 0, -1)
+                end
+                local chunk = {}
+                for _, value in ipairs(values) do
+                    if value ~= '' then
+                        chunk[#chunk + 1] = value
+                        if #chunk == 1000 then
+                            redis.call('sadd', dest, unpack(chunk))
+                            chunk = {}
+                        end
+                    end
+                end
+                if #chunk > 0 then
+                    redis.call('sadd', dest, unpack(chunk))
+                end
+            end
+            return redis.call('scard', dest)
+        """,
+    }
+
+    def __init__(self, model, *path):
+        if not path:
+            raise ImplementationError('A traversal needs at least one relation')
+        self.start_model = model
+        self.database = model.database
+        self._hops = []
+        for name in path:
+            model = self._add_hop(model, name)
+        self.model = model
+
+    def _key_template(self, key):
+        """
+        Split the given key, computed with `_pk_placeholder` as pk, to return
+        the parts before and after the pk.
+        """
+        prefix, suffix = key.split(self._pk_placeholder)
+        return prefix, suffix
+
+    def _add_hop(self, model, name):
+        """
+        Add to the path the hop from `model` via the relation `name` and return
+        the model at the end of it.
+        """
+        field = model.get_class_field(name) if model.has_field(name) else None
+        if field is not None:
+            if not isinstance(field, RelatedFieldMixin) or not hasattr(field, 'traversal_kind'):
+                raise ImplementationError('"%s" is not a related field from limpyd_extensions' % name)
+            instance_field = model.lazy_connect(self._pk_placeholder).get_field(name)
+            prefix, suffix = self._key_template(instance_field.key)
+            self._hops.append((field.traversal_kind, prefix, suffix, name))
+            return self.database._models[field.related_to]
+
+        # relations are registered by lower-cased model names
+        relations = getattr(self.database, '_relations', {}).get(model._name.lower(), [])
+        for model_name, field_name, related_name in relations:
+            if related_name == name:
+                field = self.database._models[model_name].get_class_field(field_name)
+                index = field.get_index(index_class=EqualIndex)
+                prefix, suffix = self._key_template(index.get_storage_key(self._pk_placeholder))
+                self._hops.append(('set', prefix, suffix, ''))
+                return field._model
+
+        raise ImplementationError('"%s" is not a relation of the model "%s"' % (name, model.__name__))
+
+    def _tmp_key(self):
+        return unique_key(self.database.connection, make_key(self.start_model._name, 'traversal', 'tmp'))
+
+    def _check_limit(self, count, position):
+        if self.max_pks is not None and count > self.max_pks:
+            raise TraversalLimitExceeded('More than %d pks found at the hop %d of '
+                                         'the traversal' % (self.max_pks, position))
+
+    def _follow(self, start, dest):
+        """
+        Follow the path from the given start (an instance or pk, or a list of
+        them), level by level, each one in a temporary set (deleted at the
+        end), and store the pks at the end of the path in the set `dest`.
+        Return the number of these pks.
+        """
+        if not isinstance(start, (list, tuple, set)):
+            start = [start]
+        pks = set(normalize(value._pk if isinstance(value, model.RedisModel) else value)
+                  for value in start)
+        connection = self.database.connection
+        connection.delete(dest)
+        if not pks:
+            return 0
+
+        current = self._tmp_key()
+        tmp_keys = [current]
+        try:
+            connection.sadd(current, *pks)
+            for position, (kind, prefix, suffix, hash_field) in enumerate(self._hops, 1):
+                if position == len(self._hops):
+                    next_key = dest
+                else:
+                    next_key = self._tmp_key()
+                    tmp_keys.append(next_key)
+                if kind in ('string', 'hash'):
+                    count = self._follow_foreign_keys(current, next_key, kind, prefix, suffix, hash_field)
+                    self._check_limit(count, position)
+                else:
+                    self._follow_many(current, next_key, kind, prefix, suffix, position)
+                current = next_key
+        except TraversalLimitExceeded:
+            connection.delete(dest)
+            raise
+        finally:
+            connection.delete(*tmp_keys)
+
+        return connection.scard(dest)
+
+    def _follow_foreign_keys(self, current, next_key, kind, prefix, suffix, hash_field):
+        """
+        Store in the set `next_key` the values of the foreign keys of the
+        instances with the pks in the set `current`, without reading anything:
+        the values are got in a temporary list with SORT ... GET, then added to
+        the set with `union_script`. Return the number of pks in the set.
+        """
+        pattern = '%s*%s' % (prefix, suffix)
+        if kind == 'hash':
+            pattern = '%s->%s' % (pattern, hash_field)
+        tmp_key = self._tmp_key()
+        with self.database.pipeline(transaction=False) as pipe:
+            pipe.sort(current, by='nosort', get=pattern, store=tmp_key)
+            self.database.call_script(
+                # be sure to use the script dict at the class level
+                # to avoid registering it many times
+                script_dict=RelatedTraversal.union_script,
+                keys=[next_key, tmp_key],
+                args=['list'],
+            )
+            pipe.delete(tmp_key)
+            return pipe.execute()[1]
+
+    def _follow_many(self, current, next_key, kind, prefix, suffix, position):
+        """
+        Add to the set `next_key` the pks in the relations of the instances
+        with the pks in the set `current`, read by chunks with SSCAN to compute
+        the keys of these relations, added with SUNIONSTORE (or `union_script`
+        for lists and sorted sets).
+        """
+        connection = self.database.connection
+        cursor = 0
+        while True:
+            cursor, pks = connection.sscan(current, cursor, count=self.chunk_size)
+            if pks:
+                keys = ['%s%s%s' % (prefix, pk, suffix) for pk in pks]
+                if kind == 'set':
+                    count = connection.sunionstore(next_key, [next_key] + keys)
+                else:
+                    count = self.database.call_script(
+                        # be sure to use the script dict at the class level
+                        # to avoid registering it many times
+                        script_dict=RelatedTraversal.union_script,
+                        keys=[next_key] + keys,
+                        args=[kind],
+                    )
+                self._check_limit(count, position)
+            if not int(cursor):
+                break
+
+    def store(self, start, key=None, ttl=60):
+        """
+        Follow the path from the given start (an instance or pk, or a list of
+        them), and store the pks of the final instances in a set, expiring
+        after `ttl` seconds (if set). Return the key of this set (a new
+        temporary one if `key` is not given) and the number of pks in it.
+        """
+        if key is None:
+            key = unique_key(self.database.connection, make_key(self.model._name, 'traversal'))
+        count = self._follow(start, key)
+        if count and ttl:
+            self.database.connection.expire(key, ttl)
+        return key, count
+
+    def pks(self, start, offset=0, limit=None):
+        """
+        Follow the path from the given start (an instance or pk, or a list of
+        them), and return the list of the pks of the final instances, sorted,
+        and limited to `limit` pks from `offset` if given (applied by redis).
+        """
+        key, count = self.store(start, key=self._tmp_key(), ttl=None)
+        try:
+            if not count:
+                return []
+            return self.database.connection.sort(key, start=offset, num=-1 if limit is None else limit,
+                                                 alpha=True)
+        finally:
+            self.database.connection.delete(key)
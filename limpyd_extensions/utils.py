@@ -0,0 +1,34 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+
+from redis.client import Pipeline
+
+from limpyd.contrib.database import PipelineDatabase
+
+
+def in_pipeline(database):
+    """
+    Return True if the calls done via the connection of the given database are
+    currently grouped in a pipeline.
+    """
+    return isinstance(database.connection, Pipeline)
+
+
+@contextmanager
+def pipelined(database, transaction=False):
+    """
+    A context manager to group all the redis calls done in the `with` block via
+    the connection of the given database (so calls done by fields and indexes
+    too) in one pipeline, executed when leaving the block.
+    If we are already in a pipeline, calls are simply added to it, and if the
+    database is not a `PipelineDatabase`, calls are executed directly.
+    """
+    if in_pipeline(database) or not isinstance(database, PipelineDatabase):
+        yield
+        return
+
+    with database.pipeline(transaction=transaction) as pipe:
+        yield
+        pipe.execute()
@@ -6,8 +6,9 @@ import unittest
 
 import argparse
 
-from tests import base, related
-from tests.dynamic import fields as dyn_fields, related as dyn_related
+from tests import base, batch, related
+from tests.dynamic import (export as dyn_export, fields as dyn_fields, memory as dyn_memory,
+                           related as dyn_related)
 
 
 if __name__ == "__main__":
@@ -39,7 +40,7 @@ if __name__ == "__main__":
     else:
         # Run all the tests
         suites = []
-        for mod in [base, related, dyn_fields, dyn_related]:
+        for mod in [base, related, batch, dyn_fields, dyn_related, dyn_export, dyn_memory]:
             suite = unittest.TestLoader().loadTestsFromModule(mod)
             suites.append(suite)
         suite = unittest.TestSuite(suites)
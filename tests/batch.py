@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+from limpyd import fields
+from limpyd_extensions import related
+from limpyd_extensions.batch import batch, current_batch
+from limpyd_extensions.dynamic.fields import DynamicStringField, DynamicHashField
+from limpyd_extensions.dynamic.model import ModelWithDynamicFieldMixin
+
+from .base import LimpydBaseTest
+
+
+class TestRedisModel(related.RelatedModel):
+    """
+    Use it as a base for all RelatedModel created for tests
+    """
+    database = LimpydBaseTest.database
+    abstract = True
+    namespace = "batch-tests"
+
+
+class Person(ModelWithDynamicFieldMixin, TestRedisModel):
+    name = fields.PKField()
+    prefered_group = related.FKStringField('Group', related_name='prefered_for')
+    visits = DynamicStringField()
+    scores = DynamicHashField(indexable=True)
+
+
+class Group(TestRedisModel):
+    name = fields.PKField()
+    members = related.M2MSetField(Person, related_name='membership')
+    zmembers = related.M2MSortedSetField(Person, related_name='zmembership')
+
+
+class BatchTest(LimpydBaseTest):
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.core_devs = Group(name='limpyd core devs')
+        self.fan_boys = Group(name='limpyd fan boys')
+        self.ybon = Person(name='ybon')
+        self.twidi = Person(name='twidi')
+
+    def test_writes_should_be_coalesced(self):
+        with batch() as current:
+            with self.assertNumCommands(0):
+                self.core_devs.members.sadd(self.ybon, self.twidi)
+                self.twidi.membership.sadd(self.fan_boys)
+                self.core_devs.members.srem(self.ybon)
+                self.ybon.zmembership.zadd({self.core_devs: 1})
+                self.core_devs.zmembers.zadd({self.ybon: 2})
+            self.assertIs(current_batch(), current)
+            self.assertSetEqual(set(self.core_devs.members()), set())
+            self.assertEqual(len(current), 3)
+            # multi, sadd+index and srem+deindex for the first set, sadd+index
+            # for the second one, zadd+index for the sorted set, exec
+            with self.assertNumCommands(10):
+                current.flush()
+            self.assertEqual(len(current), 0)
+        self.assertIsNone(current_batch())
+
+        self.assertSetEqual(set(self.core_devs.members()), {self.twidi._pk})
+        self.assertSetEqual(set(self.fan_boys.members()), {self.twidi._pk})
+        self.assertSetEqual(set(self.ybon.membership()), set())
+        self.assertSetEqual(set(self.twidi.membership()), {self.core_devs._pk, self.fan_boys._pk})
+        self.assertEqual(self.core_devs.zmembers.zscore(self.ybon), 2)
+        self.assertSetEqual(set(self.ybon.zmembership()), {self.core_devs._pk})
+
+    def test_indexes_of_single_values_should_be_updated(self):
+        self.twidi.prefered_group.set(self.fan_boys)
+        with batch():
+            self.twidi.prefered_group.set(self.core_devs)
+            self.twidi.prefered_group.set(self.fan_boys)
+            self.ybon.prefered_group.set(self.fan_boys)
+            self.core_devs.prefered_for.sadd(self.twidi)
+            self.assertEqual(self.twidi.prefered_group.get(), self.fan_boys._pk)
+        self.assertEqual(self.twidi.prefered_group.get(), self.core_devs._pk)
+        self.assertSetEqual(set(self.core_devs.prefered_for()), {self.twidi._pk})
+        self.assertSetEqual(set(self.fan_boys.prefered_for()), {self.ybon._pk})
+
+        with batch():
+            self.twidi.scores('2020').hmset(math=10, art=12)
+            self.twidi.scores('2020').hdel('art')
+            self.twidi.scores('2020').hset('math', 15)
+        self.assertEqual(self.twidi.scores('2020').hgetall(), {'math': '15'})
+        self.assertSetEqual(set(Person.collection(scores_2020__math='15')), {self.twidi._pk})
+        self.assertSetEqual(set(Person.collection(scores_2020__math='10')), set())
+        self.assertSetEqual(set(Person.collection(scores_2020__art='12')), set())
+
+    def test_inventory_of_dynamic_fields_should_be_updated_once(self):
+        with batch() as current:
+            self.twidi.visits('home').incr()
+            self.twidi.visits('home').incrby(2)
+            self.twidi.visits('about').incr()
+            self.ybon.visits('home').set(1)
+            self.ybon.visits('home').delete()  # not captured: pending writes are flushed
+            self.assertEqual(self.twidi.visits('home').get(), '3')
+            self.twidi.visits('home').incr()
+            self.assertEqual(len(current), 3)
+        self.assertEqual(self.twidi.visits('home').get(), '4')
+        self.assertEqual(self.twidi.visits._inventory.smembers(), {'home', 'about'})
+        self.assertIsNone(self.ybon.visits('home').get())
+        self.assertEqual(self.ybon.visits._inventory.smembers(), set())
+
+    def test_batches_can_be_nested(self):
+        with batch() as outer:
+            self.core_devs.members.sadd(self.ybon)
+            with batch() as inner:
+                self.assertIs(inner, outer)
+                self.core_devs.members.sadd(self.twidi)
+            self.assertSetEqual(set(self.core_devs.members()), set())
+        self.assertSetEqual(set(self.core_devs.members()), {self.ybon._pk, self.twidi._pk})
+
+    def test_writes_should_be_discarded_on_error(self):
+        with self.assertRaises(ValueError):
+            with batch():
+                self.core_devs.members.sadd(self.ybon)
+                raise ValueError()
+        self.assertIsNone(current_batch())
+        self.assertSetEqual(set(self.core_devs.members()), set())
+
+    def test_batch_should_be_stopped_on_interruption(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with batch():
+                self.core_devs.members.sadd(self.ybon)
+                raise KeyboardInterrupt()
+        self.assertIsNone(current_batch())
+        self.assertSetEqual(set(self.core_devs.members()), set())
+        # next writes are not captured anymore
+        self.core_devs.members.sadd(self.ybon)
+        self.assertSetEqual(set(self.core_devs.members()), {self.ybon._pk})
@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+
+from limpyd import fields as limpyd_fields
+from limpyd.exceptions import ImplementationError
+from limpyd.model import RedisModel
+
+from limpyd_extensions.dynamic import export, fields
+
+from ..base import LimpydBaseTest
+
+
+class TestRedisModel(fields.ModelWithDynamicFieldMixin, RedisModel):
+    database = LimpydBaseTest.database
+    abstract = True
+    namespace = "dynamic-export-tests"
+
+
+class Player(TestRedisModel):
+    name = limpyd_fields.PKField()
+    scores = fields.DynamicSortedSetField()
+    stats = fields.DynamicHashField()
+
+
+@unittest.skipIf(export.numpy is None, 'numpy is not installed')
+class ExportTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.foo = Player(name='foo')
+        self.bar = Player(name='bar')
+        self.foo.scores('2026').zadd({'a': 1, 'b': 2.5})
+        self.foo.scores('2025').zadd({'c': 3})
+        self.bar.scores('2026').zadd({'d': 4})
+        self.foo.stats('2026').hmset(hits=10, time=1.5)
+        self.bar.stats('2026').hmset(hits=20)
+
+    def test_sorted_sets_should_be_exported(self):
+        with self.assertNumCommands(12):  # ZCARD, then ZRANGE, for each version
+            result = export.export_sorted_sets(Player.scores, [self.foo, 'bar'],
+                                               ['2026', '2025', '2024'], chunk_size=2)
+        self.assertEqual(result['versions'], [('foo', '2026'), ('foo', '2025'), ('foo', '2024'),
+                                              ('bar', '2026'), ('bar', '2025'), ('bar', '2024')])
+        self.assertEqual(result['version'].tolist(), [0, 0, 1, 3])
+        self.assertEqual(result['members'].tolist(), ['a', 'b', 'c', 'd'])
+        self.assertEqual(result['scores'].tolist(), [1.0, 2.5, 3.0, 4.0])
+        self.assertEqual(str(result['scores'].dtype), 'float64')
+
+    def test_hashes_should_be_exported(self):
+        result = export.export_hashes(Player.stats, ['foo', 'bar'], ['2026'])
+        self.assertEqual(result['versions'], [('foo', '2026'), ('bar', '2026')])
+        entries = sorted(zip(result['version'].tolist(), result['keys'].tolist(),
+                             result['values'].tolist()))
+        self.assertEqual(entries, [(0, 'hits', 10.0), (0, 'time', 1.5), (1, 'hits', 20.0)])
+
+        # only some keys
+        result = export.export_hashes(Player.stats, ['foo', 'bar'], ['2026'], hash_keys=['time', 'hits'])
+        self.assertEqual(result['version'].tolist(), [0, 0, 1, 1])
+        self.assertEqual(result['keys'].tolist(), ['time', 'hits', 'time', 'hits'])
+        values = result['values'].tolist()
+        self.assertEqual(values[:2] + values[3:], [1.5, 10.0, 20.0])
+        self.assertTrue(export.numpy.isnan(values[2]))
+
+    def test_only_base_fields_of_the_right_class_can_be_exported(self):
+        with self.assertRaises(ImplementationError):
+            export.export_sorted_sets(Player.stats, ['foo'], ['2026'])
+        with self.assertRaises(ImplementationError):
+            export.export_hashes(self.foo.stats('2026'), ['foo'], ['2026'])
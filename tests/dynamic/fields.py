@@ -1,13 +1,20 @@
 # -*- coding:utf-8 -*-
 from __future__ import unicode_literals
 
+from datetime import datetime, timedelta
+import time
 
 from limpyd.model import RedisModel
 from limpyd import fields as limpyd_fields
-from limpyd.exceptions import ImplementationError
-from limpyd.indexes import TextRangeIndex
+from limpyd.exceptions import ImplementationError, UniquenessError
+from limpyd.indexes import NumberRangeIndex, TextRangeIndex
+import redis
+from redis.exceptions import ResponseError
 
 from limpyd_extensions.dynamic import fields
+from limpyd_extensions.dynamic.buffer import CounterBuffer
+from limpyd_extensions.dynamic.cache import VersionCache
+from limpyd_extensions.dynamic.inventory import BitmapInventory
 
 from ..base import LimpydBaseTest
 
@@ -382,3 +389,894 @@ class DynamicFieldsTest(LimpydBaseTest):
             set(obj.foo.scan_versions('a*')),
             {'aa'}
         )
+
+
+class DynamicFieldsWithTTLTest(LimpydBaseTest):
+
+    class Counter(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-fields-with-ttl'
+        name = limpyd_fields.PKField()
+        hits = fields.DynamicStringField(ttl=100)
+
+    def test_ttl_cannot_be_used_with_indexable_or_instancehash_fields(self):
+        with self.assertRaises(ImplementationError):
+            fields.DynamicStringField(ttl=10, indexable=True)
+        with self.assertRaises(ImplementationError):
+            fields.DynamicInstanceHashField(ttl=10)
+
+    def test_versions_should_expire(self):
+        counter = self.Counter(name='foo')
+        counter.hits('2020-01-01').incr()
+        self.assertTrue(95 < counter.hits('2020-01-01').ttl() <= 100)
+
+        # an existing ttl is refreshed on each write
+        counter.hits('2020-01-01').expire(10)
+        counter.hits('2020-01-01').incr()
+        self.assertTrue(95 < counter.hits('2020-01-01').ttl() <= 100)
+
+        # the inventory is a sorted set scored by expiry times, expiring too
+        inventory = counter.hits._inventory
+        self.assertEqual(inventory.zrange(0, -1), ['2020-01-01'])
+        self.assertTrue(95 < inventory.zscore('2020-01-01') - time.time() <= 100)
+        self.assertTrue(95 < inventory.ttl() <= 100)
+
+    def test_expired_versions_should_be_ignored_and_swept(self):
+        counter = self.Counter(name='foo')
+        other_counter = self.Counter(name='bar')
+        for part in ('2020-01-01', '2020-01-02', '2020-01-03'):
+            counter.hits(part).incr()
+            other_counter.hits(part).incr()
+        self.assertSetEqual(set(counter.hits.scan_versions()), {'2020-01-01', '2020-01-02', '2020-01-03'})
+
+        # simulate the expiry of two versions
+        for instance in (counter, other_counter):
+            for part in ('2020-01-01', '2020-01-02'):
+                instance.hits(part).delete()
+                instance.hits._inventory.zadd({part: time.time() - 1})
+
+        inventory = counter.hits._inventory
+        self.assertEqual(inventory.versions(), {'2020-01-03'})
+        self.assertEqual(inventory.count_versions(), 1)
+        self.assertFalse(inventory.has_version('2020-01-01'))
+        self.assertTrue(inventory.has_version('2020-01-03'))
+        self.assertSetEqual(set(counter.hits.scan_versions()), {'2020-01-03'})
+        self.assertEqual(inventory.zcard(), 3)
+
+        # only on base fields with a ttl
+        with self.assertRaises(ImplementationError):
+            counter.hits('2020-01-03').sweep_expired_versions()
+        with self.assertRaises(ImplementationError):
+            Movie.get_field('personal_tags').sweep_expired_versions()
+
+        # sweep the inventory of one instance: zrangebyscore and
+        # zremrangebyscore in a multi/exec
+        with self.assertNumCommands(4):
+            self.assertEqual(counter.hits.sweep_expired_versions(), 2)
+        self.assertEqual(inventory.zrange(0, -1), ['2020-01-03'])
+        self.assertEqual(other_counter.hits._inventory.zcard(), 3)
+
+        # sweep the inventories of all instances
+        self.assertEqual(self.Counter.get_field('hits').sweep_expired_versions(chunk_size=1), 2)
+        self.assertEqual(other_counter.hits._inventory.zrange(0, -1), ['2020-01-03'])
+
+    def test_deleting_versions_should_clean_the_inventory(self):
+        counter = self.Counter(name='foo')
+        counter.hits('2020-01-01').incr()
+        counter.hits('2020-01-02').incr()
+        counter.hits('2020-01-01').delete()
+        self.assertEqual(counter.hits._inventory.zrange(0, -1), ['2020-01-02'])
+        counter.hits.delete()
+        self.assertEqual(counter.hits._inventory.zcard(), 0)
+        self.assertIsNone(counter.hits('2020-01-02').get())
+
+
+class DynamicFieldsWithBitmapInventoryTest(LimpydBaseTest):
+
+    class Player(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-fields-with-bitmap-inventory'
+        name = limpyd_fields.PKField()
+        scores = fields.DynamicStringField(inventory='bitmap')
+
+    def test_inventory_must_be_valid(self):
+        with self.assertRaises(ImplementationError):
+            fields.DynamicStringField(inventory='foo')
+        with self.assertRaises(ImplementationError):
+            fields.DynamicStringField(inventory='bitmap', ttl=10)
+
+    def test_only_non_negative_integers_are_accepted(self):
+        player = self.Player(name='foo')
+        player.get_field('scores_0')
+        player.get_field('scores_42')
+        player.scores(12)
+        for invalid_part in ('-1', '01', 'foo', '1.5', -1):
+            with self.assertRaises(ValueError):
+                player.scores(invalid_part)
+        with self.assertRaises(ValueError):
+            player.get_field('scores_01')
+
+    def test_offsets_too_high_for_redis_are_refused(self):
+        player = self.Player(name='foo')
+        # the highest one is accepted (not set here: it would use 512MB)
+        player.get_field('scores_%s' % (2 ** 32 - 1))
+        for invalid_part in (2 ** 32, '%s' % 2 ** 32):
+            with self.assertRaises(ValueError):
+                player.scores(invalid_part).set(1)
+        with self.assertRaises(ValueError):
+            player.get_field('scores_%s' % 2 ** 32)
+        # nothing was written
+        self.assertEqual(self.connection.keys('*scores_*'), [])
+
+    def test_inventory_should_be_filled_and_cleaned(self):
+        player = self.Player(name='foo')
+        inventory = player.scores._inventory
+        self.assertIsInstance(inventory, BitmapInventory)
+
+        for part in (3, 0, 100000, 31, 32, 33):
+            player.scores(part).set(part)
+        self.assertEqual(inventory.count_versions(), 6)
+        self.assertTrue(inventory.has_version('31'))
+        self.assertFalse(inventory.has_version('30'))
+        # one bit for each possible dynamic part
+        self.assertEqual(inventory.strlen(), 100000 // 8 + 1)
+
+        # ordered, jumping over empty regions, whatever the size of the chunks
+        expected = ['0', '3', '31', '32', '33', '100000']
+        self.assertEqual(list(player.scores.scan_versions()), expected)
+        self.assertEqual(list(player.scores.scan_versions(count=1)), expected)
+        self.assertEqual(list(player.scores.scan_versions('3*')), ['3', '31', '32', '33'])
+
+        player.scores(31).delete()
+        self.assertEqual(inventory.versions(), {'0', '3', '32', '33', '100000'})
+
+        player.scores.delete()
+        self.assertEqual(inventory.count_versions(), 0)
+        self.assertIsNone(player.scores(3).get())
+        self.assertEqual(list(player.scores.scan_versions()), [])
+
+
+counter_buffer = CounterBuffer(max_size=3, interval=3600, flush_at_exit=False)
+
+
+class DynamicFieldsWithReverseIndexTest(LimpydBaseTest):
+
+    class Player(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-fields-with-reverse-index'
+        name = limpyd_fields.PKField()
+        scores = fields.DynamicStringField(reverse_index=True)
+        hits = fields.DynamicStringField(ttl=100, reverse_index=True)
+        badges = fields.DynamicSetField()
+
+    def test_reverse_index_should_be_maintained(self):
+        foo = self.Player(name='foo')
+        bar = self.Player(name='bar')
+        foo.scores('2026_10').set(10)
+        bar.scores('2026_10').set(20)
+        bar.scores('2026_11').set(30)
+
+        self.assertEqual(self.Player.scores.instances_having('2026_10'), {'foo', 'bar'})
+        self.assertEqual(foo.scores.instances_having('2026_11'), {'bar'})
+        with self.assertNumCommands(1):
+            self.assertEqual(self.Player.scores.count_instances_having('2026_10'), 2)
+        self.assertEqual(self.Player.scores.count_instances_having('2026_12'), 0)
+
+        bar.scores('2026_10').delete()
+        self.assertEqual(self.Player.scores.instances_having('2026_10'), {'foo'})
+
+        bar.delete()
+        self.assertEqual(self.Player.scores.instances_having('2026_11'), set())
+
+        # only for fields with a reverse index
+        with self.assertRaises(ImplementationError):
+            self.Player.badges.instances_having('2026_10')
+
+    def test_reverse_index_should_be_usable_in_collections(self):
+        self.Player(name='foo').scores('2026_10').set(10)
+        self.Player(name='bar').scores('2026_11').set(20)
+        self.Player(name='baz').scores('2026_10').set(30)
+
+        self.assertEqual(set(self.Player.collection().having_version('scores', '2026_10')),
+                         {'foo', 'baz'})
+        self.assertEqual(list(self.Player.collection(name='bar').having_version('scores', '2026_10')),
+                         [])
+
+    def test_reverse_index_should_be_swept_with_expired_versions(self):
+        foo = self.Player(name='foo')
+        foo.hits('2026_10').incr()
+        foo.hits('2026_11').incr()
+        self.assertEqual(self.Player.hits.instances_having('2026_10'), {'foo'})
+
+        # simulate the expiry of a version
+        foo.hits._inventory.zadd({'2026_10': time.time() - 1})
+        self.assertEqual(self.Player.get_field('hits').sweep_expired_versions(), 1)
+        self.assertEqual(self.Player.hits.instances_having('2026_10'), set())
+        self.assertEqual(self.Player.hits.instances_having('2026_11'), {'foo'})
+
+    def test_versions_written_during_the_sweep_should_stay_in_the_reverse_index(self):
+        foo = self.Player(name='foo')
+        foo.hits('2026_10').incr()
+        foo.hits._inventory.zadd({'2026_10': time.time() - 1})
+
+        field = self.Player.get_field('hits')
+        reverse_index_key = field._reverse_index_key
+        written = []
+
+        def write_during_the_sweep(dynamic_part):
+            # the version is written again after its removal from the inventory
+            if not written:
+                written.append(dynamic_part)
+                foo.hits(dynamic_part).incr()
+            return reverse_index_key(dynamic_part)
+
+        field._reverse_index_key = write_during_the_sweep
+        try:
+            self.assertEqual(field.sweep_expired_versions(), 1)
+        finally:
+            del field._reverse_index_key
+        self.assertEqual(foo.hits('2026_10').get(), '2')
+        self.assertEqual(foo.hits._inventory.versions(), {'2026_10'})
+        self.assertEqual(self.Player.hits.instances_having('2026_10'), {'foo'})
+
+
+class DynamicFieldsWithHyperLogLogTest(LimpydBaseTest):
+
+    class Visitor(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-fields-with-hyperloglog'
+        name = limpyd_fields.PKField()
+        pages = fields.DynamicStringField(hyperloglog=True)
+        kept_pages = fields.DynamicStringField(hyperloglog=True, hyperloglog_retention=None)
+        other_pages = fields.DynamicStringField()
+
+    def test_distinct_parts_should_be_counted(self):
+        foo = self.Visitor(name='foo')
+        bar = self.Visitor(name='bar')
+        for page in ('home', 'about', 'contact'):
+            foo.pages(page).incr()
+        for page in ('home', 'faq'):
+            bar.pages(page).incr()
+
+        with self.assertNumCommands(1):
+            self.assertEqual(self.Visitor.pages.approximate_parts_count(), 4)
+
+        today = datetime.utcnow().date()
+        yesterday = today - timedelta(days=1)
+        self.assertEqual(foo.pages.approximate_parts_count(today), 4)
+        self.assertEqual(self.Visitor.pages.approximate_parts_count(today, yesterday), 4)
+        self.assertEqual(self.Visitor.pages.approximate_parts_count(yesterday), 0)
+        with self.assertNumCommands(2):  # in one pipeline
+            counts = self.Visitor.pages.approximate_parts_count_by_day(today, yesterday.strftime('%Y-%m-%d'))
+        self.assertEqual(counts, {today: 4, yesterday.strftime('%Y-%m-%d'): 0})
+
+        # only for fields with a hyperloglog
+        with self.assertRaises(ImplementationError):
+            self.Visitor.other_pages.approximate_parts_count()
+
+    def test_days_should_expire_after_the_retention(self):
+        foo = self.Visitor(name='foo')
+        foo.pages('home').incr()
+        foo.kept_pages('home').incr()
+        today = datetime.utcnow().date()
+        self.assertEqual(self.connection.ttl(self.Visitor.get_field('pages')._hyperloglog_key(today)),
+                         90 * 86400)
+        self.assertEqual(self.connection.ttl(self.Visitor.get_field('pages')._hyperloglog_key()), -1)
+        self.assertEqual(self.connection.ttl(self.Visitor.get_field('kept_pages')._hyperloglog_key(today)), -1)
+
+
+class DynamicFieldsWithFilterCacheTest(LimpydBaseTest):
+
+    class Page(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-fields-with-filter-cache'
+        name = limpyd_fields.PKField()
+        kind = limpyd_fields.StringField(indexable=True)
+        status = fields.DynamicStringField(indexable=True, indexes=[TextRangeIndex],
+                                           filter_cache_ttl=60)
+
+    def test_filter_cache_needs_an_indexable_field(self):
+        with self.assertRaises(ImplementationError):
+            fields.DynamicStringField(filter_cache_ttl=60)
+
+    def test_dynamic_filter_results_should_be_cached(self):
+        home = self.Page(name='home', kind='main', status_fr='online', status_en='draft')
+        about = self.Page(name='about', kind='other', status_fr='online')
+
+        self.assertEqual(set(self.Page.collection().dynamic_filter('status', 'fr', 'online')),
+                         {'home', 'about'})
+        self.assertEqual(self.Page.status.filter_cache_stats, {'hits': 0, 'misses': 1})
+
+        # the same filter (or with the "eq" suffix) uses the kept result
+        self.assertEqual(set(self.Page.collection().dynamic_filter('status', 'fr', 'online', 'eq')),
+                         {'home', 'about'})
+        self.assertEqual(self.Page.status.filter_cache_stats, {'hits': 1, 'misses': 1})
+
+        # and can be combined with other filters
+        self.assertEqual(list(self.Page.collection(kind='main').dynamic_filter('status', 'fr', 'online')),
+                         ['home'])
+        self.assertEqual(self.Page.status.filter_cache_stats, {'hits': 2, 'misses': 1})
+
+        # a write on the dynamic version invalidates the kept results
+        about.status('fr').set('draft')
+        self.assertEqual(set(self.Page.collection().dynamic_filter('status', 'fr', 'online')),
+                         {'home'})
+        self.assertEqual(set(self.Page.collection().dynamic_filter('status', 'fr', 'd', 'startswith')),
+                         {'about'})
+        self.assertEqual(self.Page.status.filter_cache_stats, {'hits': 2, 'misses': 3})
+
+        # but not a write on another one
+        home.status('en').set('online')
+        self.assertEqual(set(self.Page.collection().dynamic_filter('status', 'fr', 'online')),
+                         {'home'})
+        self.assertEqual(self.Page.status.filter_cache_stats, {'hits': 3, 'misses': 3})
+
+        # empty results are kept too
+        self.assertEqual(list(self.Page.collection().dynamic_filter('status', 'de', 'online')), [])
+        self.assertEqual(list(self.Page.collection().dynamic_filter('status', 'de', 'online')), [])
+        self.assertEqual(self.Page.status.filter_cache_stats, {'hits': 4, 'misses': 4})
+
+        # deleting an instance invalidates them too
+        home.delete()
+        self.assertEqual(set(self.Page.collection().dynamic_filter('status', 'fr', 'online')),
+                         set())
+
+    def test_invalidation_should_be_sent_with_the_tracking(self):
+        home = self.Page(name='home', kind='main')
+        version = home.get_field('status').get_for('fr')
+        track_version = version._track_version
+        queued = []
+
+        def track_in_the_transaction(expire_at=None):
+            queued.extend(tuple(args[:2]) for args, options in version.connection.command_stack)
+            return track_version(expire_at)
+
+        version._track_version = track_in_the_transaction
+        try:
+            version.set('online')
+        finally:
+            del version._track_version
+        self.assertEqual(queued, [('INCRBY', version._filter_cache_generation_key())])
+
+    def test_reindexing_should_invalidate_cached_filters(self):
+        home = self.Page(name='home', kind='main')
+        misses = self.Page.status.filter_cache_stats['misses']
+        # a value not indexed yet
+        self.connection.set(home.get_field('status_fr').key, 'online')
+        self.assertEqual(list(self.Page.collection().dynamic_filter('status', 'fr', 'online')), [])
+        home.get_field('status')._inventory.sadd('fr')
+
+        self.Page.get_field('status').reindex_dynamic_versions()
+        self.assertEqual(list(self.Page.collection().dynamic_filter('status', 'fr', 'online')),
+                         ['home'])
+        self.assertEqual(self.Page.status.filter_cache_stats['misses'], misses + 2)
+
+
+class DynamicSortTest(LimpydBaseTest):
+
+    class Player(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-sort'
+        name = limpyd_fields.PKField()
+        team = limpyd_fields.StringField(indexable=True)
+        score = fields.DynamicStringField()
+        rank = fields.DynamicStringField(indexable=True, indexes=[NumberRangeIndex])
+
+    def setUp(self):
+        super(DynamicSortTest, self).setUp()
+        for name, team, score in (('foo', 'a', 20), ('bar', 'b', 5), ('baz', 'a', 10), ('qux', 'b', 30)):
+            self.Player(name=name, team=team, score_2026=score, rank_2026=score, score_2025=-score)
+
+    def test_sort_by_dynamic_version(self):
+        collection = self.Player.collection().dynamic_sort_by('score', '2026')
+        self.assertEqual(list(collection), ['bar', 'baz', 'foo', 'qux'])
+        collection = self.Player.collection().dynamic_sort_by('score', '2026', desc=True)
+        self.assertEqual(list(collection), ['qux', 'foo', 'baz', 'bar'])
+        collection = self.Player.collection(team='a').dynamic_sort_by('score', '2025')
+        self.assertEqual(list(collection), ['foo', 'baz'])
+        collection = self.Player.collection().dynamic_sort_by('score', '2026', alpha=True)
+        self.assertEqual(list(collection), ['baz', 'foo', 'qux', 'bar'])
+
+        # limits are applied by redis
+        collection = self.Player.collection().dynamic_sort_by('score', '2026', desc=True)
+        self.assertEqual(collection[1:3], ['foo', 'baz'])
+        self.assertEqual(collection[0], 'qux')
+        self.assertEqual(collection[-1], 'bar')
+
+        # with values
+        collection = self.Player.collection(team='b').dynamic_sort_by('score', '2026').values_list('name', 'score_2026')
+        self.assertEqual(list(collection), [('bar', '5'), ('qux', '30')])
+
+    def test_instances_without_the_version_should_be_kept(self):
+        self.Player(name='quux', team='a', score_2025=1, rank_2025=1)
+        for field_name in ('score', 'rank'):
+            collection = self.Player.collection().dynamic_sort_by(field_name, '2026')
+            self.assertEqual(list(collection), ['quux', 'bar', 'baz', 'foo', 'qux'])
+            self.assertEqual(len(collection), 5)
+            collection = self.Player.collection(team='a').dynamic_sort_by(field_name, '2026', desc=True)
+            self.assertEqual(list(collection), ['foo', 'baz', 'quux'])
+            self.assertEqual(collection[-1], 'quux')
+
+    def test_sort_by_dynamic_version_with_a_number_range_index(self):
+        collection = self.Player.collection().dynamic_sort_by('rank', '2026')
+        self.assertEqual(list(collection), ['bar', 'baz', 'foo', 'qux'])
+        self.assertEqual(len(collection), 4)
+        collection = self.Player.collection().dynamic_sort_by('rank', '2026', desc=True)
+        self.assertEqual(list(collection), ['qux', 'foo', 'baz', 'bar'])
+        collection = self.Player.collection(team='a').dynamic_sort_by('rank', '2026', desc=True)
+        self.assertEqual(list(collection), ['foo', 'baz'])
+
+        # limits are applied by redis
+        collection = self.Player.collection().dynamic_sort_by('rank', '2026', desc=True)
+        self.assertEqual(collection[1:3], ['foo', 'baz'])
+        self.assertEqual(collection[0], 'qux')
+        self.assertEqual(collection[-1], 'bar')
+        collection = self.Player.collection().dynamic_sort_by('rank', '2026')
+        self.assertEqual(collection[-1], 'qux')
+
+        # with values
+        collection = self.Player.collection(team='b').dynamic_sort_by('rank', '2026', desc=True)
+        collection = collection.values_list('name', 'rank_2026')
+        self.assertEqual(list(collection), [('qux', '30'), ('bar', '5')])
+
+
+class BulkCreateTest(LimpydBaseTest):
+
+    class Player(TestRedisModelWithDynamicField):
+        namespace = 'bulk-create'
+        name = limpyd_fields.PKField()
+        team = limpyd_fields.StringField(indexable=True)
+        friends = limpyd_fields.SetField(indexable=True)
+        score = fields.DynamicStringField(indexable=True, reverse_index=True)
+        stats = fields.DynamicHashField()
+        games = fields.DynamicListField()
+
+    class Event(TestRedisModelWithDynamicField):
+        namespace = 'bulk-create'
+        kind = limpyd_fields.InstanceHashField(indexable=True)
+        count = fields.DynamicStringField()
+
+    def test_instances_should_be_created(self):
+        rows = [
+            {'name': 'foo', 'team': 'a', 'friends': ['bar'], 'score': {'2026': 10, '2025': 5},
+             'stats_2026': {'hits': 3}, 'games': {'2026': ['x', 'y']}},
+            {'name': 'bar', 'team': 'b', 'score_2026': 20},
+            {'name': 'baz', 'team': 'a'},
+        ]
+        pks = self.Player.bulk_create(rows, chunk_size=2)
+        self.assertEqual(pks, ['foo', 'bar', 'baz'])
+
+        self.assertEqual(set(self.Player.collection()), {'foo', 'bar', 'baz'})
+        self.assertEqual(set(self.Player.collection(team='a')), {'foo', 'baz'})
+        self.assertEqual(set(self.Player.collection(friends='bar')), {'foo'})
+        self.assertEqual(set(self.Player.collection(score_2026='20')), {'bar'})
+        foo = self.Player('foo')
+        self.assertEqual(foo.team.get(), 'a')
+        self.assertEqual(foo.score('2025').get(), '5')
+        self.assertEqual(foo.stats('2026').hgetall(), {'hits': '3'})
+        self.assertEqual(foo.games('2026').lrange(0, -1), ['x', 'y'])
+        self.assertEqual(foo.score._inventory.smembers(), {'2025', '2026'})
+        self.assertEqual(self.Player.score.instances_having('2026'), {'foo', 'bar'})
+
+        # values can then be updated the normal way
+        foo.score('2026').set(30)
+        self.assertEqual(set(self.Player.collection(score_2026='10')), set())
+
+    def test_pks_should_be_checked_or_reserved(self):
+        self.Player(name='foo')
+        with self.assertRaises(UniquenessError):
+            self.Player.bulk_create([{'name': 'bar'}, {'name': 'foo'}])
+        # the pks reserved in previous chunks are released too
+        with self.assertRaises(UniquenessError):
+            self.Player.bulk_create([{'name': 'bar'}, {'name': 'baz'}, {'name': 'foo'}], chunk_size=2)
+        with self.assertRaises(UniquenessError):
+            self.Player.bulk_create([{'name': 'bar'}, {'name': 'bar'}])
+        with self.assertRaises(ValueError):
+            self.Player.bulk_create([{'team': 'a'}])
+        self.assertEqual(set(self.Player.collection()), {'foo'})
+
+        self.Event(kind='first')
+        self.assertEqual(self.Event.bulk_create([{'kind': 'a', 'count_x': 1}, {'kind': 'b'}]), ['2', '3'])
+        self.assertEqual(self.Event('2').kind.hget(), 'a')
+        self.assertEqual(set(self.Event.collection(kind='b')), {'3'})
+        self.assertEqual(self.Event(kind='c').pk.get(), '4')
+
+    def test_chunks_can_be_written_by_many_processes(self):
+        rows = [{'name': 'player-%d' % index, 'team': 'a', 'score': {'2026': index}}
+                for index in range(20)]
+        self.Player.bulk_create(rows, chunk_size=5, processes=2)
+        self.assertEqual(len(self.Player.collection(team='a')), 20)
+        self.assertEqual(self.Player('player-7').score('2026').get(), '7')
+        self.assertEqual(self.Player.score.count_instances_having('2026'), 20)
+
+
+class ReindexTest(LimpydBaseTest):
+
+    class Player(TestRedisModelWithDynamicField):
+        namespace = 'reindex'
+        name = limpyd_fields.PKField()
+        score = fields.DynamicStringField(indexable=True)
+        tags = fields.DynamicSetField(indexable=True)
+
+    def setUp(self):
+        super(ReindexTest, self).setUp()
+        for index in range(10):
+            player = self.Player(name='player-%d' % index)
+            player.score('2026').set(index % 3)
+            player.tags('2026').sadd('tag-%d' % (index % 2), 'all')
+        player.score('2025').set(5)
+        # remove all the index keys
+        self.connection.delete(*self.connection.keys('reindex:player:score_*'))
+        self.connection.delete(*self.connection.keys('reindex:player:tags_*'))
+        self.assertEqual(len(self.Player.collection(score_2026=0)), 0)
+
+    def assert_indexed(self, count=10):
+        self.assertEqual(len(self.Player.collection(score_2026=0)), 4 if count == 10 else 0)
+        self.assertEqual(set(self.Player.collection(score_2025=5)), {'player-9'} if count == 10 else set())
+        self.assertEqual(len(self.Player.collection(tags_2026='all')), count)
+        self.assertEqual(len(self.Player.collection(tags_2026='tag-1')), count // 2)
+
+    def test_only_indexable_base_fields_can_be_reindexed(self):
+        with self.assertRaises(ImplementationError):
+            self.Player('player-1').score.reindex_dynamic_versions()
+        with self.assertRaises(ImplementationError):
+            self.Player.get_field('score_2026').reindex_dynamic_versions()
+
+    def test_versions_should_be_reindexed(self):
+        calls = []
+        self.assertEqual(self.Player.get_field('score').reindex_dynamic_versions(
+            chunk_size=4, progress=lambda done, total: calls.append((done, total))), 10)
+        self.assertEqual(calls, [(4, 10), (8, 10), (10, 10)])
+        self.assertEqual(self.Player.get_field('tags').reindex_dynamic_versions(), 10)
+        self.assert_indexed()
+        self.assertEqual(self.connection.keys('reindex:player:*:reindex:*'), [])
+
+    def test_versions_written_during_the_reindex_should_be_read_again(self):
+        other_client = redis.StrictRedis(connection_pool=self.connection.connection_pool)
+        key = self.Player('player-1').score('2026').key
+        reads = []
+
+        def proxy_get(field):
+            reads.append(field.key)
+            if field.key == key and reads.count(key) == 1:
+                # written by another client after the WATCH
+                other_client.set(key, 7)
+            return limpyd_fields.RedisField.proxy_get(field)
+
+        fields.DynamicStringField.proxy_get = proxy_get
+        try:
+            self.assertEqual(self.Player.get_field('score').reindex_dynamic_versions(), 10)
+        finally:
+            del fields.DynamicStringField.proxy_get
+        self.assertEqual(reads.count(key), 2)
+        self.assertEqual(set(self.Player.collection(score_2026=7)), {'player-1'})
+        self.assertEqual(len(self.Player.collection(score_2026=1)), 2)
+
+    def test_reindex_can_be_resumed(self):
+        field = self.Player.get_field('score')
+        done_key = field.make_key('reindex:player', 'score', 'reindex', 'done')
+        self.connection.sadd(done_key, *['player-%d' % index for index in range(10) if index % 3])
+        self.assertEqual(field.reindex_dynamic_versions(resume=True), 4)
+        self.assertEqual(len(self.Player.collection(score_2026=0)), 4)
+        self.assertEqual(len(self.Player.collection(score_2026=1)), 0)
+
+    def test_versions_can_be_reindexed_by_many_processes(self):
+        self.assertEqual(self.Player.get_field('score').reindex_dynamic_versions(chunk_size=3, processes=2), 10)
+        self.assertEqual(self.Player.get_field('tags').reindex_dynamic_versions(chunk_size=3, processes=2), 10)
+        self.assert_indexed()
+
+
+class CloneTest(LimpydBaseTest):
+
+    class Page(TestRedisModelWithDynamicField):
+        namespace = 'clone'
+        name = limpyd_fields.PKField()
+        kind = limpyd_fields.StringField(indexable=True)
+        author = limpyd_fields.InstanceHashField(indexable=True)
+        tags = limpyd_fields.SetField(indexable=True)
+        title = fields.DynamicStringField(indexable=True, reverse_index=True)
+        extra = fields.DynamicInstanceHashField()
+        blocks = fields.DynamicListField()
+        hits = fields.DynamicStringField(ttl=100)
+
+    class Draft(TestRedisModelWithDynamicField):
+        namespace = 'clone'
+        content = fields.DynamicHashField(indexable=True)
+        slug = limpyd_fields.StringField(unique=True)
+
+    def test_instance_should_be_cloned(self):
+        page = self.Page(name='home', kind='main', author='me', tags=['a', 'b'])
+        page.title('fr').set('Accueil')
+        page.title('en').set('Home')
+        page.extra('fr').hset('x')
+        page.blocks('fr').rpush('one', 'two')
+        page.hits('2026').incr()
+
+        copy = page.clone('home-copy')
+        self.assertEqual(copy.pk.get(), 'home-copy')
+        self.assertEqual(set(self.Page.collection()), {'home', 'home-copy'})
+        self.assertEqual(copy.kind.get(), 'main')
+        self.assertEqual(copy.author.hget(), 'me')
+        self.assertEqual(copy.tags.smembers(), {'a', 'b'})
+        self.assertEqual(copy.title('fr').get(), 'Accueil')
+        self.assertEqual(copy.extra('fr').hget(), 'x')
+        self.assertEqual(copy.blocks('fr').lrange(0, -1), ['one', 'two'])
+        self.assertEqual(copy.hits('2026').get(), '1')
+        self.assertTrue(0 < copy.hits('2026').ttl() <= 100)
+
+        # inventories and indexes are rebuilt
+        self.assertEqual(copy.title._inventory.smembers(), {'fr', 'en'})
+        self.assertEqual(copy.blocks._inventory.smembers(), {'fr'})
+        self.assertEqual(set(self.Page.collection(kind='main')), {'home', 'home-copy'})
+        self.assertEqual(set(self.Page.collection(author='me')), {'home', 'home-copy'})
+        self.assertEqual(set(self.Page.collection(tags='b')), {'home', 'home-copy'})
+        self.assertEqual(set(self.Page.collection(title_en='Home')), {'home', 'home-copy'})
+        self.assertEqual(self.Page.title.instances_having('en'), {'home', 'home-copy'})
+
+        # the copy is independent
+        copy.title('fr').set('Copie')
+        self.assertEqual(page.title('fr').get(), 'Accueil')
+        self.assertEqual(set(self.Page.collection(title_fr='Accueil')), {'home'})
+
+        # the pk must be new
+        with self.assertRaises(UniquenessError):
+            page.clone('home-copy')
+        with self.assertRaises(ValueError):
+            page.clone()
+
+    def test_remaining_ttl_should_be_kept(self):
+        page = self.Page(name='home')
+        page.hits('2026').incr()
+        page.hits('2026').expire(5)
+        page.hits('2025').incr()
+
+        copy = page.clone('home-copy')
+        self.assertTrue(0 < copy.hits('2026').ttl() <= 5)
+        self.assertTrue(5 < copy.hits('2025').ttl() <= 100)
+        expire_at = copy.hits._inventory.zscore('2026')
+        self.assertTrue(time.time() < expire_at <= time.time() + 5)
+        self.assertEqual(copy.hits._inventory.versions(), {'2025', '2026'})
+
+    def test_unique_fields_are_not_supported(self):
+        draft = self.Draft(slug='foo')
+        with self.assertRaises(ImplementationError):
+            draft.clone()
+
+
+class DynamicFieldsWithBufferTest(LimpydBaseTest):
+
+    class Page(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-fields-with-buffer'
+        name = limpyd_fields.PKField()
+        hits = fields.DynamicStringField(buffer=counter_buffer)
+        visits = fields.DynamicHashField(buffer=counter_buffer)
+
+    def setUp(self):
+        super(DynamicFieldsWithBufferTest, self).setUp()
+        self.buffer = counter_buffer
+        self.buffer.flush()
+
+    def test_buffer_cannot_be_used_with_indexable_or_other_fields(self):
+        with self.assertRaises(ImplementationError):
+            fields.DynamicStringField(buffer=self.buffer, indexable=True)
+        with self.assertRaises(ImplementationError):
+            fields.DynamicSetField(buffer=self.buffer)
+
+    def test_increments_should_be_coalesced(self):
+        home = self.Page(name='home')
+        about = self.Page(name='about')
+
+        with self.assertNumCommands(0):
+            self.assertIsNone(home.hits('2020-01-01').incr())
+            home.hits('2020-01-01').incrby(5)
+            home.hits('2020-01-01').decr()
+            home.visits('2020-01-01').hincrby('fr', 2)
+            home.visits('2020-01-01').hincrby('fr')
+        self.assertEqual(len(self.buffer), 2)
+        self.assertIsNone(home.hits('2020-01-01').get())
+
+        # other commands are not buffered
+        about.hits('2020-01-01').set(10)
+        self.assertEqual(about.hits('2020-01-01').get(), '10')
+
+        # multi/exec + 2 increments + 2 inventory updates
+        with self.assertNumCommands(6):
+            self.buffer.flush()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(home.hits('2020-01-01').get(), '5')
+        self.assertEqual(home.visits('2020-01-01').hget('fr'), '3')
+        self.assertEqual(home.hits._inventory.smembers(), {'2020-01-01'})
+        self.assertEqual(home.visits._inventory.smembers(), {'2020-01-01'})
+
+    def test_increments_cancelling_out_should_be_sent(self):
+        home = self.Page(name='home')
+        home.hits('a').incr()
+        home.hits('a').decr()
+        home.visits('a').hincrby('fr', 2)
+        home.visits('a').hincrby('fr', -2)
+        self.buffer.flush()
+        # same as without buffer
+        self.assertEqual(home.hits('a').get(), '0')
+        self.assertEqual(home.visits('a').hget('fr'), '0')
+        self.assertEqual(home.hits._inventory.smembers(), {'a'})
+        self.assertEqual(home.visits._inventory.smembers(), {'a'})
+
+    def test_buffer_should_flush_when_full(self):
+        home = self.Page(name='home')
+        home.hits('1').incr()
+        home.hits('2').incr()
+        self.assertIsNone(home.hits('1').get())
+        home.hits('3').incr()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(home.hits('1').get(), '1')
+        self.assertEqual(home.hits._inventory.smembers(), {'1', '2', '3'})
+
+    def test_only_failed_increments_should_be_put_back(self):
+        home = self.Page(name='home')
+        home.hits('b').set('foo')
+        home.hits('a').incr()
+        home.hits('b').incrby(2)
+        with self.assertRaises(ResponseError):
+            self.buffer.flush()
+        self.assertEqual(home.hits('a').get(), '1')
+        self.assertEqual(len(self.buffer), 1)
+
+        home.hits('b').set(5)
+        self.buffer.flush()
+        self.assertEqual(home.hits('a').get(), '1')
+        self.assertEqual(home.hits('b').get(), '7')
+
+
+version_cache = VersionCache(max_size=3)
+tracking_cache = VersionCache(tracking=True)
+
+
+class DynamicFieldsWithCacheTest(LimpydBaseTest):
+
+    class Config(TestRedisModelWithDynamicField):
+        namespace = 'dynamic-fields-with-cache'
+        name = limpyd_fields.PKField()
+        title = fields.DynamicStringField(cache=version_cache)
+        settings = fields.DynamicHashField(cache=version_cache)
+        labels = fields.DynamicHashField(cache=tracking_cache)
+
+    def setUp(self):
+        super(DynamicFieldsWithCacheTest, self).setUp()
+        for cache in (version_cache, tracking_cache):
+            cache.clear()
+            cache.hits = cache.misses = cache.evictions = cache.invalidations = 0
+
+    def test_reads_should_be_cached_and_invalidated_on_write(self):
+        site = self.Config(name='site')
+        site.settings('fr').hmset(color='blue', size='10')
+
+        self.assertEqual(site.settings('fr').hgetall(), {'color': 'blue', 'size': '10'})
+        with self.assertNumCommands(0):
+            self.assertEqual(site.settings('fr').hgetall(), {'color': 'blue', 'size': '10'})
+            self.assertEqual(site.settings('fr').hgetall(), {'color': 'blue', 'size': '10'})
+        # returned values are copies
+        site.settings('fr').hgetall()['color'] = 'red'
+        self.assertEqual(site.settings('fr').hget('color'), 'blue')
+        self.assertEqual(site.settings('fr').hget('color'), 'blue')
+
+        site.settings('fr').hset('color', 'green')
+        self.assertEqual(site.settings('fr').hgetall(), {'color': 'green', 'size': '10'})
+        site.settings('fr').delete()
+        self.assertEqual(site.settings('fr').hgetall(), {})
+
+        stats = version_cache.stats()
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertGreaterEqual(stats['invalidations'], 3)
+
+    def test_cache_should_be_limited_in_size(self):
+        site = self.Config(name='site')
+        for lang in ('fr', 'en', 'de', 'it'):
+            site.title(lang).set(lang)
+            site.title(lang).get()
+        self.assertEqual(len(version_cache), 3)
+        self.assertEqual(version_cache.evictions, 1)
+        # the least recently used was evicted
+        with self.assertNumCommands(1):
+            site.title('fr').get()
+
+    def test_result_read_before_a_write_should_not_be_kept(self):
+        site = self.Config(name='site')
+        site.title('fr').set('Bienvenue')
+        field = site.title('fr')
+
+        def read_then_write():
+            # another thread writes between the read and the save in the cache
+            result = field.connection.get(field.key)
+            self.Config.get('site').title('fr').set('Salut')
+            return result
+
+        self.assertEqual(version_cache.fetch(field, 'get', (), {}, read_then_write), 'Bienvenue')
+        self.assertEqual(len(version_cache), 0)
+        self.assertEqual(version_cache._in_flight, {})
+        self.assertEqual(site.title('fr').get(), 'Salut')
+
+    def test_entries_should_expire_with_a_ttl(self):
+        cache = VersionCache(ttl=0.1)
+
+        class Page(TestRedisModelWithDynamicField):
+            namespace = 'dynamic-fields-with-cache-ttl'
+            name = limpyd_fields.PKField()
+            title = fields.DynamicStringField(cache=cache)
+
+        home = Page(name='home')
+        home.title('fr').set('Accueil')
+        home.title('fr').get()
+        self.connection.set(home.title('fr').key, 'Maison')
+        self.assertEqual(home.title('fr').get(), 'Accueil')
+        time.sleep(0.15)
+        self.assertEqual(home.title('fr').get(), 'Maison')
+
+    def test_cache_should_be_invalidated_by_tracking(self):
+        site = self.Config(name='site')
+        site.labels('fr').hset('ok', 'Valider')
+        self.assertEqual(site.labels('fr').hget('ok'), 'Valider')
+        self.assertEqual(site.labels('fr').hget('ok'), 'Valider')
+        self.assertEqual(tracking_cache.hits, 1)
+
+        # write done by another client
+        self.connection.hset(site.labels('fr').key, 'ok', 'OK')
+        time.sleep(0.05)
+        self.assertEqual(site.labels('fr').hget('ok'), 'OK')
+        self.assertEqual(tracking_cache.hits, 1)
+
+
+class ShardedDynamicFieldsTest(LimpydBaseTest):
+
+    class Page(TestRedisModelWithDynamicField):
+        namespace = 'sharded-dynamic-fields'
+        name = limpyd_fields.PKField()
+        views = fields.DynamicShardedStringField(shards=4)
+        countries = fields.DynamicShardedHashField(shards=3, shard_by='process')
+
+    def test_sharded_fields_cannot_be_indexable(self):
+        with self.assertRaises(ImplementationError):
+            fields.DynamicShardedStringField(indexable=True)
+        with self.assertRaises(ImplementationError):
+            fields.DynamicShardedStringField(shard_by='foo')
+
+    def test_string_increments_should_be_spread_and_summed(self):
+        home = self.Page(name='home')
+        self.assertIsNone(home.views('today').get())
+        for __ in range(40):
+            home.views('today').incr()
+        home.views('today').incrby(5)
+        home.views('today').decr()
+
+        shard_values = [self.connection.get(key) for key in home.views('today')._version_keys()]
+        self.assertGreater(len([value for value in shard_values if value is not None]), 1)
+        self.assertEqual(sum(int(value) for value in shard_values), 44)
+        with self.assertNumCommands(1):
+            self.assertEqual(home.views('today').get(), '44')
+        self.assertEqual(home.views._inventory.smembers(), {'today'})
+
+        home.views('today').set(10)
+        self.assertEqual(home.views('today').get(), '10')
+
+        home.views('today').delete()
+        self.assertIsNone(home.views('today').get())
+        self.assertEqual(self.connection.keys('sharded-dynamic-fields:page:home:views_today*'), [])
+        self.assertEqual(home.views._inventory.smembers(), set())
+
+        with self.assertRaises(AttributeError):
+            home.views('today').append('foo')
+
+    def test_hash_increments_should_be_spread_and_summed(self):
+        home = self.Page(name='home')
+        home.countries('today').hincrby('fr', 2)
+        home.countries('today').hincrby('us', 1)
+        # simulate increments from other processes
+        keys = home.countries('today')._version_keys()
+        self.connection.hincrby(keys[0], 'fr', 1)
+        self.connection.hincrby(keys[1], 'fr', 1)
+        self.connection.hincrby(keys[2], 'de', 1)
+
+        with self.assertNumCommands(3):
+            self.assertEqual(home.countries('today').hget('fr'), '4')
+        self.assertEqual(home.countries('today').hmget('fr', 'de', 'it'), ['4', '1', None])
+        self.assertEqual(home.countries('today').hgetall(), {'fr': '4', 'us': '1', 'de': '1'})
+
+        home.countries('today').hdel('fr')
+        self.assertEqual(home.countries('today').hgetall(), {'us': '1', 'de': '1'})
+        home.countries('today').hmset(us=5)
+        self.assertEqual(home.countries('today').hgetall(), {'us': '5', 'de': '1'})
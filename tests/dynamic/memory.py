@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+from limpyd import fields as limpyd_fields
+from limpyd.exceptions import ImplementationError
+
+from limpyd_extensions import related
+from limpyd_extensions.dynamic import fields, memory, related as dyn_related
+
+from ..base import LimpydBaseTest
+
+
+class TestRedisModel(fields.ModelWithDynamicFieldMixin, related.RelatedModel):
+    database = LimpydBaseTest.database
+    abstract = True
+    namespace = "dynamic-memory-tests"
+
+
+class Team(TestRedisModel):
+    name = limpyd_fields.PKField()
+
+
+class Player(TestRedisModel):
+    name = limpyd_fields.PKField()
+    team = related.FKStringField(Team, related_name='players')
+    nickname = limpyd_fields.InstanceHashField()
+    scores = fields.DynamicStringField(indexable=True, reverse_index=True)
+    history = fields.DynamicListField()
+    stats = fields.DynamicInstanceHashField()
+    coaches = dyn_related.DynamicM2MSetField(Team, related_name='coached_players')
+
+
+class MemoryUsageReportTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(MemoryUsageReportTest, self).setUp()
+        Team(name='a')
+        Team(name='b')
+        for index in range(4):
+            player = Player(name='p%d' % index, team='a' if index < 3 else 'b',
+                            nickname='n%d' % index)
+            for version in range(index):
+                player.scores(version).set(10)
+                player.history(version).rpush('x', 'y')
+            player.stats(1).hset(index)
+        Player.get('p0').coaches('2025').sadd('a', 'b')
+        Player.get('p0').coaches('2026').sadd('a')
+        Player.get('p1').coaches('2026').sadd('a')
+
+    def test_all_instances_should_be_reported(self):
+        report = memory.memory_usage_report(Player, sample_size=10, chunk_size=3)
+        self.assertEqual(report['instances'], 4)
+        self.assertEqual(report['sampled'], 4)
+
+        scores = report['fields']['scores']
+        self.assertEqual(scores['versions'], 6)
+        self.assertEqual(scores['versions_per_instance'],
+                         {'min': 0, 'max': 3, 'mean': 1.5, 'median': 2})
+        self.assertEqual(scores['keys'], 9)  # 6 versions and 3 inventories
+        self.assertGreater(scores['data'], 0)
+        self.assertGreater(scores['inventory'], 0)
+        self.assertGreater(scores['indexes'], 0)
+        self.assertEqual(scores['memory'], scores['data'] + scores['inventory'] + scores['indexes'])
+        self.assertEqual(report['fields']['history']['keys'], 9)
+        self.assertEqual(report['fields']['history']['indexes'], 0)
+
+        # instance hash fields, and their versions, are all in one hash
+        self.assertEqual(report['fields']['stats']['versions'], 4)
+        self.assertEqual(report['fields']['stats']['keys'], 4)  # inventories
+        self.assertEqual(report['fields']['nickname']['keys'], 0)
+        self.assertEqual(report['instancehash']['keys'], 4)
+
+        # the team is indexed, and the players of each team are in the
+        # reverse relation of the team
+        self.assertEqual(report['fields']['team']['keys'], 4)
+        self.assertGreater(report['fields']['team']['indexes'], 0)
+        team_report = memory.memory_usage_report(Team)
+        self.assertEqual(team_report['related']['players']['keys'], 2)
+        # a set of players by dynamic part, and the set of the dynamic parts,
+        # for each team
+        coached = team_report['related']['coached_players']
+        self.assertEqual(coached['keys'], 3 + 2)
+        self.assertEqual(coached['versions'], 3)
+        self.assertEqual(coached['versions_per_instance']['max'], 2)
+        self.assertGreater(coached['inventory'], 0)
+
+        self.assertEqual(report['memory'],
+                         sum(stats['memory'] for stats in report['fields'].values())
+                         + report['instancehash']['memory'])
+
+    def test_shared_keys_should_be_counted_by_share(self):
+        # the index of the value and the reverse index of each dynamic part
+        # are shared by all the instances having them
+        indexes = memory.memory_usage_report(Player, field_names=['scores'])['fields']['scores']['indexes']
+        connection = self.database.connection
+        keys = [Player.get_field('scores_%d' % version).get_index().get_storage_key(10)
+                for version in range(3)]
+        keys += [Player.get_field('scores')._reverse_index_key(version) for version in range(3)]
+        self.assertEqual(indexes, sum(connection.memory_usage(key) for key in keys))
+
+    def test_sample_should_be_extrapolated(self):
+        report = memory.memory_usage_report(Player, sample_size=2)
+        self.assertEqual(report['instances'], 4)
+        self.assertEqual(report['sampled'], 2)
+        self.assertEqual(report['instancehash']['keys'], 4)
+        self.assertEqual(report['fields']['team']['keys'], 4)
+        self.assertEqual(report['fields']['scores']['versions'] % 2, 0)
+
+    def test_fields_could_be_limited(self):
+        report = memory.memory_usage_report(Player, field_names=['history'])
+        self.assertEqual(list(report['fields']), ['history'])
+        self.assertIsNone(report['instancehash'])
+
+    def test_empty_model_should_be_reported(self):
+        for player in Player.collection().instances():
+            player.delete()
+        report = memory.memory_usage_report(Player)
+        self.assertEqual(report['instances'], 0)
+        self.assertEqual(report['sampled'], 0)
+        self.assertEqual(report['memory'], 0)
+        self.assertEqual(report['fields']['scores']['versions_per_instance']['max'], 0)
+
+    def test_sizes_should_be_positive(self):
+        with self.assertRaises(ImplementationError):
+            memory.memory_usage_report(Player, chunk_size=0)
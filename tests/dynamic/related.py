@@ -3,9 +3,12 @@ from __future__ import unicode_literals
 
 
 from limpyd import fields as limpyd_fields
+from limpyd.exceptions import ImplementationError
+from limpyd.indexes import EqualIndex, TextRangeIndex
 
 from limpyd_extensions import related
 from limpyd_extensions.dynamic import fields as dyn_fields, related as dyn_related
+from limpyd_extensions.dynamic.cache import VersionCache
 
 from ..base import LimpydBaseTest
 
@@ -144,6 +147,21 @@ class TestDynamicRelatedFields(LimpydBaseTest):
         attended = {self.fight_club.pk.get()}
         self.assertSetEqual(set(collection), attended)
 
+    def test_related_collection_count_and_scan_for_each_dynamic_variation(self):
+        self.fight_club.personal_tags(self.somebody).sadd(self.tags['fight'], self.tags['cool'])
+        self.matrix.personal_tags(self.somebody).sadd(self.tags['sf'], self.tags['cool'])
+        self.matrix.personal_tags(self.someone_else).sadd(self.tags['cool'])
+
+        with self.assertNumCommands(1):
+            self.assertEqual(self.tags['cool'].movies_for_people.count(self.somebody), 2)
+        self.assertEqual(self.tags['cool'].movies_for_people.count(self.someone_else), 1)
+        self.assertEqual(self.tags['sf'].movies_for_people.count(self.someone_else), 0)
+
+        self.assertSetEqual(set(self.tags['cool'].movies_for_people.iter_pks(self.somebody)),
+                            {'Fight club', 'Matrix'})
+        cursor, pks = self.tags['cool'].movies_for_people.scan(self.someone_else)
+        self.assertEqual((cursor, pks), (0, ['Matrix']))
+
     def test_dynamic_related_field_should_work_with_fkstringfield(self):
         class Tag(TestRedisModel):
             namespace = 'test_dynamic_related_field_should_work_with_fkstringfield'
@@ -312,3 +330,203 @@ class TestDynamicRelatedFields(LimpydBaseTest):
         self.fight_club.personal_tags.delete()
         self.assertEqual(fight_club_inventory.smembers(), set())
         self.assertEqual(matrix_inventory.smembers(), set())
+
+    def test_dynamic_versions_should_share_the_relation(self):
+        relations = self.database._relations[Tag._name]
+        nb_relations = len(relations)
+        for index in range(10):
+            self.fight_club.personal_tags('part%d' % index).sadd(self.tags['cool'])
+        self.assertEqual(len(self.database._relations[Tag._name]), nb_relations)
+        self.assertEqual([relation for relation in relations if relation[1].startswith('personal_tags')],
+                         [(Movie._name, 'personal_tags', 'movies_for_people')])
+        self.assertEqual(self.tags['cool'].related_collections, ['movies', 'movies_for_people'])
+
+    def test_deleting_a_related_instance_should_clean_all_dynamic_versions(self):
+        self.fight_club.personal_tags(self.somebody).sadd(self.tags['fight'], self.tags['cool'])
+        self.matrix.personal_tags(self.somebody).sadd(self.tags['sf'], self.tags['cool'])
+        self.matrix.personal_tags(self.someone_else).sadd(self.tags['cool'])
+
+        self.tags['cool'].delete()
+
+        self.assertEqual(self.fight_club.personal_tags(self.somebody).smembers(), {'fight'})
+        self.assertEqual(self.matrix.personal_tags(self.somebody).smembers(), {'sf'})
+        self.assertEqual(self.matrix.personal_tags(self.someone_else).smembers(), set())
+        cool = Tag.lazy_connect('cool')
+        self.assertEqual(cool.movies_for_people.count(self.somebody), 0)
+        self.assertEqual(cool.movies_for_people.count(self.someone_else), 0)
+
+    def test_deleting_a_related_instance_should_untrack_foreign_keys(self):
+        class Group(TestRedisModel):
+            namespace = 'test_deleting_a_related_instance_should_untrack_foreign_keys'
+            name = limpyd_fields.PKField()
+
+        class Project(TestRedisModelWithDynamicField):
+            namespace = 'test_deleting_a_related_instance_should_untrack_foreign_keys'
+            name = limpyd_fields.PKField()
+            owner = dyn_related.DynamicFKStringField(Group, related_name='owned',
+                                                     cache=VersionCache(),
+                                                     filter_cache_ttl=60)
+
+        group, other = Group(name='group'), Group(name='other')
+        project = Project(name='project')
+        project.owner.get_for('x').set(group)
+        project.owner.get_for('y').set(other)
+        self.assertEqual(project.owner.get_for('x').get(), 'group')
+        self.assertEqual(list(Project.collection().dynamic_filter('owner', 'x', 'group')), ['project'])
+        generation_key = project.owner.get_for('x')._filter_cache_generation_key()
+        generation = self.connection.get(generation_key)
+
+        group.delete()
+
+        self.assertIsNone(project.owner.get_for('x').get())
+        self.assertSetEqual(project.owner._inventory.smembers(), {'y'})
+        self.assertNotEqual(self.connection.get(generation_key), generation)
+        self.assertEqual(list(Project.collection().dynamic_filter('owner', 'x', 'group')), [])
+        self.assertEqual(project.owner.get_for('y').get(), 'other')
+
+    def test_dangling_references_should_be_collected_in_dynamic_versions(self):
+        class Group(TestRedisModel):
+            namespace = 'test_dangling_references_should_be_collected_in_dynamic_versions'
+            name = limpyd_fields.PKField()
+
+        class Project(TestRedisModelWithDynamicField):
+            namespace = 'test_dangling_references_should_be_collected_in_dynamic_versions'
+            name = limpyd_fields.PKField()
+            owner = dyn_related.DynamicFKStringField(Group, related_name='owned')
+            members = dyn_related.DynamicM2MSetField(Group, related_name='member_of')
+
+        group, other = Group(name='group'), Group(name='other')
+        project = Project(name='project')
+        project.owner.get_for('x').set(group)
+        project.owner.get_for('y').set(other)
+        project.members.get_for('x').sadd(group, other)
+        self.connection.srem(Group.get_field('pk').collection_key, group._pk)
+
+        removed = related.collect_dangling_references(Project)
+        self.assertEqual(removed, {'owner': 1, 'members': 1})
+
+        self.assertIsNone(project.owner.get_for('x').get())
+        self.assertSetEqual(project.owner._inventory.smembers(), {'y'})
+        self.assertEqual(project.owner.get_for('y').get(), 'other')
+        self.assertSetEqual(set(Project.collection().dynamic_filter('owner', 'x', 'group')), set())
+        self.assertSetEqual(project.members.get_for('x').smembers(), {'other'})
+        self.assertSetEqual(set(Project.collection().dynamic_filter('members', 'x', 'group')), set())
+
+    def test_reverse_relations_should_be_found_without_scanning_keys(self):
+        somebody_pk, someone_else_pk = self.somebody.pk.get(), self.someone_else.pk.get()
+        self.fight_club.personal_tags(self.somebody).sadd(self.tags['fight'], self.tags['cool'])
+        self.matrix.personal_tags(self.somebody).sadd(self.tags['cool'])
+        self.matrix.personal_tags(self.someone_else).sadd(self.tags['cool'])
+        parts_key = Movie.get_field('personal_tags')._parts_key('cool')
+        self.assertSetEqual(self.connection.smembers(parts_key), {somebody_pk, someone_else_pk})
+
+        # a dynamic part is removed when no instance is linked via its version
+        self.matrix.personal_tags(self.somebody).srem(self.tags['cool'])
+        self.assertSetEqual(self.connection.smembers(parts_key), {somebody_pk, someone_else_pk})
+        self.fight_club.personal_tags(self.somebody).delete()
+        self.assertSetEqual(self.connection.smembers(parts_key), {someone_else_pk})
+
+        def scan_calls():
+            return self.connection.info('commandstats').get('cmdstat_scan', {}).get('calls', 0)
+
+        scans = scan_calls()
+        self.tags['cool'].delete()
+        self.assertEqual(scan_calls(), scans)
+        self.assertEqual(self.matrix.personal_tags(self.someone_else).smembers(), set())
+        self.assertFalse(self.connection.exists(parts_key))
+
+    def test_dynamic_related_equal_index_should_always_be_used(self):
+        field = dyn_related.DynamicM2MSetField(Tag, indexes=[EqualIndex])
+        self.assertEqual(field.index_classes, [dyn_related.DynamicRelatedEqualIndex])
+        with self.assertRaises(ImplementationError):
+            dyn_related.DynamicM2MSetField(Tag, indexes=[TextRangeIndex])
+
+    def test_parts_should_be_rebuilt_for_existing_data(self):
+        self.fight_club.personal_tags(self.somebody).sadd(self.tags['fight'], self.tags['cool'])
+        self.matrix.personal_tags(self.someone_else).sadd(self.tags['cool'])
+        # as written before the parts sets existed
+        parts_key = Movie.get_field('personal_tags')._parts_key('cool')
+        self.connection.delete(parts_key)
+
+        self.assertEqual(Movie.get_field('personal_tags').rebuild_parts(), 2)
+        self.assertSetEqual(self.connection.smembers(parts_key),
+                            {self.somebody.pk.get(), self.someone_else.pk.get()})
+        self.tags['cool'].delete()
+        self.assertEqual(self.fight_club.personal_tags(self.somebody).smembers(), {'fight'})
+        self.assertEqual(self.matrix.personal_tags(self.someone_else).smembers(), set())
+
+    def test_related_collection_for_many_dynamic_parts(self):
+        self.fight_club.personal_tags(self.somebody).sadd(self.tags['fight'], self.tags['cool'])
+        self.matrix.personal_tags(self.somebody).sadd(self.tags['sf'])
+        self.matrix.personal_tags(self.someone_else).sadd(self.tags['cool'])
+        self.fight_club.personal_tags(self.someone_else).sadd(self.tags['cool'])
+        nobody = Person(name='nobody')
+
+        cool = self.tags['cool']
+        self.assertSetEqual(set(cool.movies_for_people.for_any([self.somebody, self.someone_else, nobody])),
+                            {'Fight club', 'Matrix'})
+        self.assertSetEqual(set(cool.movies_for_people([self.somebody, nobody])), {'Fight club'})
+        self.assertSetEqual(set(cool.movies_for_people.for_any([self.somebody, self.someone_else],
+                                                               tags=self.tags['action'])),
+                            {'Matrix'})
+        self.assertSetEqual(set(cool.movies_for_people.for_all([self.somebody, self.someone_else])),
+                            {'Fight club'})
+        self.assertSetEqual(set(cool.movies_for_people.for_all([self.somebody, nobody])), set())
+        with self.assertRaises(ValueError):
+            cool.movies_for_people.for_any([])
+
+    def test_for_any_should_compute_the_union_when_fetched(self):
+        cool = self.tags['cool']
+        self.fight_club.personal_tags(self.somebody).sadd(cool)
+        keys_before = set(self.connection.keys())
+        collection = cool.movies_for_people.for_any([self.somebody, self.someone_else])
+        # nothing computed yet
+        self.assertSetEqual(set(self.connection.keys()), keys_before)
+        self.matrix.personal_tags(self.someone_else).sadd(cool)
+        keys_before = set(self.connection.keys())
+        self.assertSetEqual(set(collection), {'Fight club', 'Matrix'})
+        # computed again, and the temporary key is deleted
+        self.assertSetEqual(set(collection), {'Fight club', 'Matrix'})
+        self.assertSetEqual(set(self.connection.keys()), keys_before)
+
+    def test_bulk_set_should_write_many_dynamic_versions(self):
+        cool, sf, fight = self.tags['cool'], self.tags['sf'], self.tags['fight']
+        self.matrix.personal_tags.bulk_set({
+            self.somebody: [cool, sf],
+            self.someone_else: [fight.pk.get()],
+        })
+
+        self.assertSetEqual(self.matrix.personal_tags(self.somebody).smembers(),
+                            {cool.pk.get(), sf.pk.get()})
+        self.assertSetEqual(self.matrix.personal_tags(self.someone_else).smembers(),
+                            {fight.pk.get()})
+        self.assertSetEqual(self.matrix.personal_tags._inventory.smembers(),
+                            {self.somebody.pk.get(), self.someone_else.pk.get()})
+        self.assertSetEqual(set(cool.movies_for_people(self.somebody)), {self.matrix.pk.get()})
+        self.assertSetEqual(set(fight.movies_for_people(self.someone_else)), {self.matrix.pk.get()})
+
+        with self.assertRaises(ImplementationError):
+            Movie.personal_tags.bulk_set({self.somebody: [cool]})
+
+    def test_bulk_set_should_set_foreign_keys(self):
+        class Tag(TestRedisModel):
+            namespace = 'test_bulk_set_should_set_foreign_keys'
+            slug = limpyd_fields.PKField()
+
+        class Movie(TestRedisModelWithDynamicField):
+            namespace = 'test_bulk_set_should_set_foreign_keys'
+            name = limpyd_fields.PKField()
+            main_tag = dyn_related.DynamicFKStringField(Tag, related_name='main_movies_for_people')
+
+        fight, sf, cool = Tag(slug='fight'), Tag(slug='sf'), Tag(slug='cool')
+        matrix = Movie(name='Matrix')
+        matrix.main_tag(self.somebody).set(fight)
+        matrix.main_tag.bulk_set({
+            self.somebody: sf,
+            self.someone_else: cool,
+        })
+
+        self.assertEqual(matrix.main_tag(self.somebody).get(), 'sf')
+        self.assertEqual(matrix.main_tag(self.someone_else).get(), 'cool')
+        self.assertEqual(set(fight.main_movies_for_people(self.somebody)), set())
+        self.assertEqual(set(sf.main_movies_for_people(self.somebody)), {'Matrix'})
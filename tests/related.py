@@ -4,6 +4,8 @@ from __future__ import unicode_literals
 import time
 
 from limpyd import fields
+from limpyd.contrib import related as limpyd_related
+from limpyd.exceptions import DoesNotExist, ImplementationError
 from limpyd_extensions import related
 
 from .base import LimpydBaseTest
@@ -199,3 +201,472 @@ class ReverseMethodsTest(LimpydBaseTest):
         self.assertSetEqual(set(self.core_devs.zmembers()), set())
         self.assertSetEqual(set(self.fan_boys.zmembers()), set())
         self.assertSetEqual(set(self.twidi.zmembership()), set())
+
+
+class CountTest(LimpydBaseTest):
+    def setUp(self):
+        super(CountTest, self).setUp()
+        self.main_group = Group(name='limpyd groups')
+        self.core_devs = Group(name='limpyd core devs')
+        self.ybon = Person(name='ybon')
+        self.twidi = Person(name='twidi')
+
+    def test_count_should_follow_changes_done_from_both_sides(self):
+        self.assertEqual(self.main_group.children.count(), 0)
+        self.main_group.children.sadd(self.core_devs)
+        with self.assertNumCommands(1):
+            self.assertEqual(self.main_group.children.count(), 1)
+
+        self.core_devs.prefered_for.sadd(self.ybon, self.twidi)
+        self.assertEqual(self.core_devs.prefered_for.count(), 2)
+        self.twidi.prefered_group.delete()
+        self.assertEqual(self.core_devs.prefered_for.count(), 1)
+
+        self.twidi.membership.sadd(self.main_group, self.core_devs)
+        self.main_group.members.srem(self.twidi)
+        self.assertEqual(self.twidi.membership.count(), 1)
+
+        # a list can have the same value many times, but it's counted once
+        self.main_group.lmembers.rpush(self.twidi, self.twidi)
+        self.core_devs.lmembers.rpush(self.twidi)
+        self.assertEqual(self.twidi.lmembership.count(), 2)
+
+        self.twidi.zmembership.zadd({self.main_group: 1})
+        self.assertEqual(self.twidi.zmembership.count(), 1)
+
+
+class ScanTest(LimpydBaseTest):
+    def setUp(self):
+        super(ScanTest, self).setUp()
+        self.twidi = Person(name='twidi')
+        self.groups = [Group(name='group %d' % index) for index in range(300)]
+        self.twidi.membership.sadd(*self.groups)
+
+    def test_scan_should_return_pages_with_a_cursor(self):
+        pks = set()
+        cursor, page = self.twidi.membership.scan(count=50)
+        pages = 1
+        pks.update(page)
+        while cursor:
+            cursor, page = self.twidi.membership.scan(cursor, count=50)
+            pages += 1
+            pks.update(page)
+        self.assertGreater(pages, 1)
+        self.assertSetEqual(pks, set(group._pk for group in self.groups))
+
+    def test_iter_pks_and_instances(self):
+        self.assertSetEqual(set(self.twidi.membership.iter_pks(count=50)),
+                            set(group._pk for group in self.groups))
+        instances = list(self.twidi.membership.iter_instances(count=50))
+        self.assertEqual(len(instances), 300)
+        self.assertIsInstance(instances[0], Group)
+
+
+class SetToTest(LimpydBaseTest):
+    def setUp(self):
+        super(SetToTest, self).setUp()
+        self.core_devs = Group(name='limpyd core devs')
+        self.ybon = Person(name='ybon')
+        self.twidi = Person(name='twidi')
+        self.foo = Person(name='foo')
+
+    def test_fk_set_to(self):
+        self.core_devs.prefered_for.sadd(self.ybon, self.twidi)
+        added, removed = self.core_devs.prefered_for.set_to(self.twidi, 'foo')
+        self.assertSetEqual(added, {'foo'})
+        self.assertSetEqual(removed, {'ybon'})
+        self.assertSetEqual(set(self.core_devs.prefered_for()), {'twidi', 'foo'})
+        self.assertIsNone(self.ybon.prefered_group.get())
+
+        self.core_devs.prefered_for.set_to()
+        self.assertSetEqual(set(self.core_devs.prefered_for()), set())
+
+    def test_m2mset_set_to_should_only_apply_changes(self):
+        fan_boys = Group(name='limpyd fan boys')
+        others = Group(name='others')
+        self.twidi.membership.sadd(self.core_devs, fan_boys)
+        # 5 commands to compute the diff (with the check that the temporary key
+        # does not exist), one pipeline to check that the groups to add exist
+        # (one sismember each), then the batch: multi/exec, and for each
+        # change a sadd/srem on the field and on the index
+        with self.assertNumCommands(12):
+            added, removed = self.twidi.membership.set_to(fan_boys, others)
+        self.assertSetEqual(added, {'others'})
+        self.assertSetEqual(removed, {'limpyd core devs'})
+        self.assertSetEqual(set(self.twidi.membership()), {'limpyd fan boys', 'others'})
+        self.assertSetEqual(self.core_devs.members.smembers(), set())
+        self.assertSetEqual(others.members.smembers(), {'twidi'})
+
+        # nothing to do
+        with self.assertNumCommands(5):
+            self.twidi.membership.set_to(fan_boys, others)
+
+    def test_set_to_should_refuse_missing_instances(self):
+        with self.assertRaises(DoesNotExist):
+            self.twidi.membership.set_to(self.core_devs, 'missing')
+        self.assertSetEqual(set(self.twidi.membership()), set())
+
+    def test_set_to_should_remove_instances_deleted_outside_limpyd(self):
+        fan_boys = Group(name='limpyd fan boys')
+        others = Group(name='others')
+        self.twidi.membership.sadd(self.core_devs, fan_boys)
+        self.connection.srem(fan_boys.get_field('pk').collection_key, fan_boys._pk)
+        added, removed = self.twidi.membership.set_to(others)
+        self.assertSetEqual(added, {'others'})
+        self.assertSetEqual(removed, {'limpyd core devs', 'limpyd fan boys'})
+        self.assertSetEqual(set(self.twidi.membership()), {'others'})
+        self.assertSetEqual(self.connection.smembers(fan_boys.members.key), set())
+
+    def test_m2mlist_set_to(self):
+        fan_boys = Group(name='limpyd fan boys')
+        self.twidi.lmembership.rpush(self.core_devs)
+        self.twidi.lmembership.set_to(fan_boys)
+        self.assertSetEqual(set(self.twidi.lmembership()), {'limpyd fan boys'})
+        self.assertEqual(self.core_devs.lmembers.lrange(0, -1), [])
+
+    def test_m2msortedset_set_to_should_keep_existing_scores(self):
+        fan_boys = Group(name='limpyd fan boys')
+        others = Group(name='others')
+        self.twidi.zmembership.zadd({self.core_devs: 1, fan_boys: 2})
+        self.twidi.zmembership.set_to({fan_boys: 20, others: 30})
+        self.assertSetEqual(set(self.twidi.zmembership()), {'limpyd fan boys', 'others'})
+        self.assertEqual(fan_boys.zmembers.zscore('twidi'), 2)
+        self.assertEqual(others.zmembers.zscore('twidi'), 30)
+        self.assertEqual(self.core_devs.zmembers.zcard(), 0)
+
+    def test_m2msortedset_add_values_should_default_to_a_zero_score(self):
+        fan_boys = Group(name='limpyd fan boys')
+        self.twidi.zmembership._add_values([self.core_devs, fan_boys], scores={fan_boys._pk: 5})
+        self.assertEqual(self.core_devs.zmembers.zscore('twidi'), 0)
+        self.assertEqual(fan_boys.zmembers.zscore('twidi'), 5)
+
+
+class PrefetchRelatedTest(LimpydBaseTest):
+    def setUp(self):
+        super(PrefetchRelatedTest, self).setUp()
+        self.main_group = Group(name='limpyd groups')
+        self.core_devs = Group(name='limpyd core devs', parent=self.main_group)
+        self.fan_boys = Group(name='limpyd fan boys', parent=self.main_group)
+        self.alone = Group(name='alone')
+        self.ybon = Person(name='ybon')
+        self.twidi = Person(name='twidi')
+        self.core_devs.members.sadd(self.ybon, self.twidi)
+        self.fan_boys.members.sadd(self.twidi)
+
+    def test_prefetch_fk(self):
+        # one pipeline with a hget for each group, and one with a hmget for the
+        # only parent
+        with self.assertNumCommands(4):
+            groups = related.prefetch_related([self.core_devs, self.fan_boys, self.alone],
+                                              'parent', fields=['name', 'parent'])
+        self.assertEqual(len(groups), 3)
+        by_name = {group._pk: group for group in groups}
+        parent = by_name['limpyd core devs'].prefetched_related['parent']
+        self.assertEqual(parent._pk, 'limpyd groups')
+        self.assertIs(by_name['limpyd fan boys'].prefetched_related['parent'], parent)
+        self.assertIsNone(by_name['alone'].prefetched_related['parent'])
+        self.assertEqual(parent.prefetched_values, {'name': 'limpyd groups', 'parent': None})
+
+    def test_prefetch_m2m_from_pks(self):
+        groups = related.prefetch_related(Group.collection(), 'members')
+        self.assertEqual(len(groups), 4)
+        by_name = {group._pk: group for group in groups}
+        self.assertSetEqual(set(person._pk for person in by_name['limpyd core devs'].prefetched_related['members']),
+                            {'ybon', 'twidi'})
+        self.assertEqual([person._pk for person in by_name['limpyd fan boys'].prefetched_related['members']],
+                         ['twidi'])
+
+    def test_only_related_and_single_value_fields_can_be_prefetched(self):
+        with self.assertRaises(ValueError):
+            related.prefetch_related([self.core_devs], 'name')
+        with self.assertRaises(ValueError):
+            related.prefetch_related([self.core_devs], 'parent', fields=['members'])
+
+
+class Post(TestRedisModel):
+    title = fields.PKField()
+    author = related.FKInstanceHashField(Person, related_name='posts')
+    tags = related.M2MListField('Tag', related_name='posts')
+
+
+class Tag(TestRedisModel):
+    slug = fields.PKField()
+
+
+class Follow(TestRedisModel):
+    pk = fields.AutoPKField()
+    who = related.FKStringField(Person, related_name='following')
+    whom = related.FKStringField(Person, related_name='followers')
+
+
+class RelatedTraversalTest(LimpydBaseTest):
+    def setUp(self):
+        super(RelatedTraversalTest, self).setUp()
+        self.me = Person(name='me')
+        self.ybon = Person(name='ybon')
+        self.twidi = Person(name='twidi')
+        Follow(who=self.me, whom=self.ybon)
+        Follow(who=self.me, whom=self.twidi)
+        for slug in ('python', 'redis', 'limpyd', 'cooking'):
+            Tag(slug=slug)
+        Post(title='p1', author=self.ybon).tags.rpush('python', 'redis')
+        Post(title='p2', author=self.twidi).tags.rpush('redis', 'limpyd')
+        Post(title='p3', author=self.me).tags.rpush('cooking')
+
+    def test_traversal_should_follow_the_path(self):
+        traversal = related.RelatedTraversal(Person, 'following', 'whom', 'posts', 'tags')
+        self.assertIs(traversal.model, Tag)
+        self.assertEqual(traversal.pks(self.me), ['limpyd', 'python', 'redis'])
+        self.assertEqual(traversal.pks(self.me, limit=2), ['limpyd', 'python'])
+        self.assertEqual(traversal.pks(self.me, offset=1), ['python', 'redis'])
+        self.assertEqual(traversal.pks(self.twidi), [])
+
+        # many starting points
+        traversal = related.RelatedTraversal(Person, 'posts', 'tags')
+        self.assertEqual(traversal.pks(['ybon', self.me]), ['cooking', 'python', 'redis'])
+
+        # reverse path
+        traversal = related.RelatedTraversal(Tag, 'posts', 'author')
+        self.assertEqual(traversal.pks('redis'), ['twidi', 'ybon'])
+
+    def test_traversal_should_store_the_result(self):
+        traversal = related.RelatedTraversal(Person, 'following', 'whom')
+        key, count = traversal.store(self.me, key='my-followed', ttl=10)
+        self.assertEqual((key, count), ('my-followed', 2))
+        self.assertSetEqual(self.connection.smembers(key), {'ybon', 'twidi'})
+        self.assertGreater(self.connection.ttl(key), 0)
+
+    def test_foreign_keys_should_be_followed_by_redis(self):
+        traversal = related.RelatedTraversal(Person, 'following', 'whom')
+        with self.assertNumCommands(17):
+            traversal.store(self.me, key='my-followed')
+        for name in ('a', 'b', 'c'):
+            Follow(who=self.me, whom=Person(name=name))
+        # a follow without whom
+        Follow(who=self.me)
+        # the number of commands doesn't depend on the number of pks
+        with self.assertNumCommands(17):
+            key, count = traversal.store(self.me, key='my-followed')
+        self.assertEqual(count, 5)
+        self.assertSetEqual(self.connection.smembers(key), {'a', 'b', 'c', 'ybon', 'twidi'})
+
+    def test_temporary_keys_should_be_deleted(self):
+        traversal = related.RelatedTraversal(Person, 'following', 'whom', 'posts', 'tags')
+        traversal.pks(self.me)
+        traversal.max_pks = 1
+        with self.assertRaises(related.TraversalLimitExceeded):
+            traversal.pks(self.me)
+        self.assertEqual(self.connection.keys('*traversal*'), [])
+
+    def test_traversal_should_be_limited(self):
+        traversal = related.RelatedTraversal(Person, 'following', 'whom', 'posts', 'tags')
+        traversal.max_pks = 1
+        with self.assertRaises(related.TraversalLimitExceeded):
+            traversal.pks(self.me)
+        traversal.max_pks = 3
+        self.assertEqual(traversal.pks(self.me), ['limpyd', 'python', 'redis'])
+
+    def test_reverse_hops_should_work_with_mixed_case_names(self):
+        class BlogAuthor(related.RelatedModel):
+            database = LimpydBaseTest.database
+            namespace = 'Related-Tests'
+            name = fields.PKField()
+
+        class BlogPost(related.RelatedModel):
+            database = LimpydBaseTest.database
+            namespace = 'Related-Tests'
+            title = fields.PKField()
+            author = related.FKStringField(BlogAuthor, related_name='blog_posts')
+
+        BlogPost(title='p1', author=BlogAuthor(name='me'))
+        traversal = related.RelatedTraversal(BlogAuthor, 'blog_posts')
+        self.assertIs(traversal.model, BlogPost)
+        self.assertEqual(traversal.pks('me'), ['p1'])
+
+    def test_traversal_path_must_be_valid(self):
+        with self.assertRaises(ImplementationError):
+            related.RelatedTraversal(Person, 'name')
+        with self.assertRaises(ImplementationError):
+            related.RelatedTraversal(Person, 'foo')
+
+
+class DanglingReferencesTest(LimpydBaseTest):
+    def setUp(self):
+        super(DanglingReferencesTest, self).setUp()
+        self.main_group = Group(name='limpyd groups')
+        self.core_devs = Group(name='limpyd core devs', parent=self.main_group)
+        self.fan_boys = Group(name='limpyd fan boys', parent=self.main_group)
+        self.ybon = Person(name='ybon', prefered_group=self.core_devs)
+        self.twidi = Person(name='twidi', prefered_group=self.core_devs)
+        self.core_devs.members.sadd(self.ybon, self.twidi)
+        self.core_devs.lmembers.rpush(self.ybon, self.twidi, self.ybon)
+        self.core_devs.zmembers.zadd({self.ybon: 1, self.twidi: 2})
+        self.fan_boys.members.sadd(self.ybon)
+
+    def delete_outside_limpyd(self, instance):
+        self.connection.srem(instance.get_field('pk').collection_key, instance._pk)
+
+    def test_dangling_references_should_be_removed(self):
+        self.delete_outside_limpyd(self.main_group)
+        self.delete_outside_limpyd(self.ybon)
+
+        removed = related.collect_dangling_references(Group, chunk_size=2)
+        self.assertEqual(removed, {'parent': 2, 'members': 2, 'lmembers': 1, 'zmembers': 1})
+
+        self.assertIsNone(self.core_devs.parent.hget())
+        self.assertSetEqual(set(Group.collection(parent=self.main_group._pk)), set())
+        self.assertSetEqual(self.core_devs.members.smembers(), {'twidi'})
+        self.assertSetEqual(set(Group.collection(members=self.ybon._pk)), set())
+        self.assertSetEqual(set(Group.collection(members=self.twidi._pk)), {'limpyd core devs'})
+        self.assertEqual(self.core_devs.lmembers.lrange(0, -1), ['twidi'])
+        self.assertEqual(self.core_devs.zmembers.zrange(0, -1), ['twidi'])
+
+        # nothing more to do
+        self.assertEqual(related.collect_dangling_references(Group),
+                         {'parent': 0, 'members': 0, 'lmembers': 0, 'zmembers': 0})
+
+    def test_foreign_keys_updated_since_read_should_be_kept(self):
+        self.delete_outside_limpyd(self.main_group)
+        # the value is read by the collection, then the field is updated
+        self.core_devs.parent.hset(self.fan_boys)
+        self.assertEqual(self.core_devs.get_field('parent')._remove_dangling({self.main_group._pk}), 0)
+        self.assertEqual(self.core_devs.parent.hget(), self.fan_boys._pk)
+        self.assertSetEqual(set(Group.collection(parent=self.fan_boys._pk)), {'limpyd core devs'})
+
+    def test_only_given_fields_should_be_collected(self):
+        self.delete_outside_limpyd(self.core_devs)
+        self.assertEqual(related.collect_dangling_references(Person, field_names=['prefered_group']),
+                         {'prefered_group': 2})
+        self.assertIsNone(self.ybon.prefered_group.get())
+
+
+class Author(TestRedisModel):
+    name = fields.PKField()
+
+
+class Book(TestRedisModel):
+    title = fields.PKField()
+    author = related.FKInstanceHashField(Author, related_name='books', on_delete='cascade')
+    editor = related.FKStringField(Author, related_name='edited_books')
+    reviewers = related.M2MSetField(Author, related_name='reviewed_books')
+
+
+class Chapter(TestRedisModel):
+    title = fields.PKField()
+    book = related.FKStringField(Book, related_name='chapters', on_delete='cascade')
+
+
+class Library(TestRedisModel):
+    name = fields.PKField()
+    books = related.M2MListField(Book, related_name='libraries', on_delete='protect')
+
+
+class Node(TestRedisModel):
+    name = fields.PKField()
+    parent = related.FKStringField('Node', related_name='children', on_delete='cascade')
+
+
+class OnDeleteTest(LimpydBaseTest):
+    def setUp(self):
+        super(OnDeleteTest, self).setUp()
+        self.author = Author(name='author')
+        self.other = Author(name='other')
+        self.books = [Book(title='book %d' % index, author=self.author, editor=self.other)
+                      for index in range(5)]
+        for book in self.books:
+            book.reviewers.sadd(self.author, self.other)
+        self.chapter = Chapter(title='chapter', book=self.books[0])
+
+    def test_on_delete_must_be_valid(self):
+        with self.assertRaises(ImplementationError):
+            related.FKStringField(Author, on_delete='foo')
+
+    def test_set_null_should_be_pipelined_by_chunk(self):
+        self.other.edited_books.remove_chunk_size = 2
+        self.other.reviewed_books.remove_chunk_size = 2
+        self.other.delete()
+        for book in self.books:
+            self.assertIsNone(book.editor.get())
+            self.assertSetEqual(book.reviewers.smembers(), {'author'})
+        self.assertEqual(self.author.edited_books.count(), 0)
+        self.assertSetEqual(set(Book.collection(reviewers='other')), set())
+        self.assertSetEqual(set(Book.collection(reviewers='author')), set(book._pk for book in self.books))
+
+    def test_set_null_should_only_write(self):
+        # the check of the relations with cascade (one sscan, none here), the
+        # lock on the field (4 commands, with the ones run by the lua script
+        # releasing it), one sscan, and for each book, a srem from the index
+        # and a delete of the field, all in one pipeline
+        with self.assertNumCommands(1 + 4 + 1 + 5 * 2):
+            self.other.edited_books.remove_instance()
+        self.assertEqual(self.other.edited_books.count(), 0)
+
+    def test_cascade_should_delete_related_instances(self):
+        self.author.delete()
+        self.assertEqual(len(Book.collection()), 0)
+        self.assertEqual(len(Chapter.collection()), 0)
+        self.assertEqual(self.other.edited_books.count(), 0)
+        self.assertSetEqual(set(Book.collection(reviewers='other')), set())
+
+    def test_protect_should_prevent_deletion(self):
+        library = Library(name='library')
+        library.books.rpush(self.books[1])
+        with self.assertRaises(related.ProtectedError):
+            self.author.delete()
+        # nothing was deleted
+        self.assertEqual(len(Book.collection()), 5)
+        self.assertEqual(self.author.books.count(), 5)
+
+        library.books.lrem(0, self.books[1])
+        self.author.delete()
+        self.assertEqual(len(Book.collection()), 0)
+
+    def test_cascade_should_be_done_by_chunks(self):
+        self.author.books.remove_chunk_size = 2
+        self.author.delete()
+        self.assertEqual(len(Book.collection()), 0)
+        self.assertEqual(len(Chapter.collection()), 0)
+        self.assertEqual(self.other.edited_books.count(), 0)
+        self.assertEqual(self.other.reviewed_books.count(), 0)
+        self.assertFalse(self.connection.exists(self.books[0].key))
+
+    def test_cascade_should_stop_in_a_cycle(self):
+        first, second = Node(name='first'), Node(name='second')
+        first.parent.set(second)
+        second.parent.set(first)
+        first.delete()
+        self.assertEqual(len(Node.collection()), 0)
+        self.assertEqual(len(Node.collection(parent='first')), 0)
+        self.assertEqual(len(Node.collection(parent='second')), 0)
+
+    def test_cascade_should_stop_on_a_self_reference(self):
+        node = Node(name='node')
+        node.parent.set(node)
+        child = Node(name='child', parent=node)
+        node.delete()
+        self.assertEqual(len(Node.collection()), 0)
+        self.assertEqual(len(Node.collection(parent='node')), 0)
+        self.assertFalse(self.connection.exists(child.key))
+
+    def test_protect_should_be_checked_before_any_change(self):
+        class Shelf(TestRedisModel):
+            namespace = 'test_protect_should_be_checked_before_any_change'
+            name = fields.PKField()
+
+        class Label(TestRedisModel):
+            namespace = 'test_protect_should_be_checked_before_any_change'
+            name = fields.PKField()
+            # a related field from limpyd, its collection being the first one
+            shelf = limpyd_related.FKStringField(Shelf, related_name='labels')
+
+        class Box(TestRedisModel):
+            namespace = 'test_protect_should_be_checked_before_any_change'
+            name = fields.PKField()
+            shelf = related.FKStringField(Shelf, related_name='boxes', on_delete='protect')
+
+        shelf = Shelf(name='shelf')
+        label = Label(name='label', shelf=shelf)
+        Box(name='box', shelf=shelf)
+        with self.assertRaises(related.ProtectedError):
+            shelf.delete()
+        self.assertEqual(label.shelf.get(), 'shelf')